@@ -20,5 +20,16 @@ def embed_learning(self):
           },
       },
       'missing_value_is_zero': self.force_missing_value_is_zero,
+      # compressed serving tables (embeddings/embedding_store.py)
+      'compression': {
+          'bits': 8,  # row-wise INT8 or INT4 with per-row scale / offset; None keeps FP32
+          'min_value': self.embed_range.min,
+          'max_value': self.embed_range.max,
+          'compositional': None,  # 'qr' or 'hash' for very-high-cardinality IDs
+          'qr_combiner': 'mult',
+          'num_hashes': 2,
+          'hot_cache_rows': 100000,  # float32 rows kept in RAM in front of the mmap cold store
+          'cache_policy': 'lfu',  # or 'lru'
+      },
   }
   
\ No newline at end of file
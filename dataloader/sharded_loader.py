@@ -0,0 +1,398 @@
+"""
+sharded_loader.py
+-----------------
+Sharded, columnar training data on disk and a multi-worker loader over it.
+
+The notebook builds tf.data.Dataset.from_tensor_slices((X_train, y_train)) from arrays
+held in memory and quantization_eval.py reads a pickled {"x", "y"} .npy, neither of
+which works for click logs that are far larger than RAM. Here:
+
+    - write_shards / ShardWriter store the feature matrix and the conv_prob / conv_value
+      labels column by column (one .npy per column per shard, features optionally
+      float16), and every column is opened memory-mapped
+    - the loader plans each epoch as a seeded permutation of fixed-size row blocks
+      (contiguous, so reads stay sequential within a block); the same (seed, epoch)
+      always produces the same batches, whatever the number of workers
+    - num_workers threads decode blocks in parallel (page the rows in and convert to
+      float32; NumPy releases the GIL for the copies), consumed in plan order
+    - a bounded shuffle buffer of shuffle_rows rows mixes rows across blocks: each batch
+      takes batch_size random slots out of the buffer and refills them from the stream
+    - batches are assembled by a background thread into a small ring of preallocated
+      batch buffers, so steady-state training does not allocate feature / label arrays;
+      a yielded batch stays valid until the next one is requested (copy it to keep it)
+    - rank / world_size give each data-parallel worker a disjoint slice of the blocks
+
+Layout:
+    <root>/manifest.json
+    <root>/shard_00000/{x, conv_prob, conv_value}.npy
+
+Usage (from the repo root):
+    write_shards("data/train_shards", {"x": X_train, "conv_prob": y_conv, "conv_value": y_count})
+    loader = ShardedLoader(ShardedDataset("data/train_shards"), batch_size=512, seed=42, num_workers=4)
+    for epoch in range(epochs):
+        for batch in loader.epoch(epoch):
+            model.train_on_batch(batch["x"], {"conv_prob": batch["conv_prob"], "conv_value": batch["conv_value"]})
+"""
+
+import json
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+MANIFEST = "manifest.json"
+FEATURES = "x"
+DEFAULT_SHARD_ROWS = 1 << 20
+DEFAULT_BLOCK_ROWS = 8192
+DEFAULT_SHUFFLE_ROWS = 1 << 16
+DEFAULT_PREFETCH = 2
+# on-disk dtype -> dtype handed to the model
+DECODED_DTYPES = {"float16": np.float32, "float32": np.float32, "float64": np.float32}
+
+
+
+# Writing shards
+class ShardWriter(object):
+    """Append column batches and cut them into shards of shard_rows rows."""
+
+    def __init__(self, root, shard_rows=DEFAULT_SHARD_ROWS, feature_dtype="float32"):
+        self.root = root
+        self.shard_rows = shard_rows
+        self.feature_dtype = feature_dtype
+        os.makedirs(root, exist_ok=True)
+        self.manifest = {"columns": None, "shards": [], "num_rows": 0}
+        self.pending = {}
+        self.pending_rows = 0
+
+    def _dtype(self, name, array):
+        return self.feature_dtype if name == FEATURES else np.asarray(array).dtype.name
+
+    def append(self, columns):
+        """columns: {name: array with the same number of rows}."""
+        rows = {len(a) for a in columns.values()}
+        if len(rows) != 1:
+            raise ValueError(f"Columns have different row counts: {sorted(rows)}")
+        if self.manifest["columns"] is None:
+            self.manifest["columns"] = {name: {"dtype": self._dtype(name, a), "shape": list(np.shape(a)[1:])}
+                                        for name, a in columns.items()}
+        elif set(columns) != set(self.manifest["columns"]):
+            raise ValueError(f"Expected columns {sorted(self.manifest['columns'])}, got {sorted(columns)}")
+        for name, a in columns.items():
+            self.pending.setdefault(name, []).append(np.asarray(a, dtype=self.manifest["columns"][name]["dtype"]))
+        self.pending_rows += rows.pop()
+        while self.pending_rows >= self.shard_rows:
+            self._write(self.shard_rows)
+
+    def _write(self, n):
+        shard = f"shard_{len(self.manifest['shards']):05d}"
+        os.makedirs(os.path.join(self.root, shard), exist_ok=True)
+        for name, parts in self.pending.items():
+            merged = np.concatenate(parts) if len(parts) > 1 else parts[0]
+            np.save(os.path.join(self.root, shard, f"{name}.npy"), np.ascontiguousarray(merged[:n]))
+            self.pending[name] = [merged[n:]] if len(merged) > n else []
+        self.pending_rows -= n
+        self.manifest["shards"].append({"dir": shard, "rows": n})
+        self.manifest["num_rows"] += n
+        # write-then-rename so readers never see a truncated manifest
+        tmp = os.path.join(self.root, MANIFEST + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp, os.path.join(self.root, MANIFEST))
+
+    def close(self):
+        if self.pending_rows:
+            self._write(self.pending_rows)
+
+
+def write_shards(root, columns, shard_rows=DEFAULT_SHARD_ROWS, feature_dtype="float32", chunk_rows=65536):
+    """Write in-memory (or memory-mapped) arrays as shards, chunk_rows at a time."""
+    writer = ShardWriter(root, shard_rows, feature_dtype)
+    n = len(next(iter(columns.values())))
+    for start in range(0, n, chunk_rows):
+        writer.append({name: a[start:start + chunk_rows] for name, a in columns.items()})
+    writer.close()
+    return root
+
+
+def is_shard_dir(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST))
+
+
+
+# Reading shards
+class ShardedDataset(object):
+    """Memory-mapped view over a shard directory."""
+
+    def __init__(self, root):
+        with open(os.path.join(root, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.root = root
+        self.columns = self.manifest["columns"]
+        self.shard_rows = [s["rows"] for s in self.manifest["shards"]]
+        self.num_rows = self.manifest["num_rows"]
+        self._maps = {}
+
+    def __len__(self):
+        return self.num_rows
+
+    def column(self, shard, name):
+        key = (shard, name)
+        if key not in self._maps:
+            path = os.path.join(self.root, self.manifest["shards"][shard]["dir"], f"{name}.npy")
+            self._maps[key] = np.load(path, mmap_mode="r")
+        return self._maps[key]
+
+    def blocks(self, block_rows=DEFAULT_BLOCK_ROWS):
+        """[(shard, start, stop)] covering every row."""
+        return [(s, start, min(start + block_rows, n))
+                for s, n in enumerate(self.shard_rows) for start in range(0, n, block_rows)]
+
+    def decoded_dtype(self, name):
+        dtype = self.columns[name]["dtype"]
+        return np.dtype(DECODED_DTYPES.get(dtype, dtype))
+
+    def decode(self, block, names, out=None):
+        """Rows of one block in their decoded dtypes (this is what pages them in).
+
+        With `out` ({name: preallocated array of >= block rows}), rows are converted into
+        it in place and views of it are returned.
+        """
+        shard, start, stop = block
+        decoded = {}
+        for name in names:
+            src = self.column(shard, name)[start:stop]
+            if out is None:
+                decoded[name] = np.ascontiguousarray(src, dtype=self.decoded_dtype(name))
+            else:
+                decoded[name] = out[name][:stop - start]
+                np.copyto(decoded[name], src, casting="same_kind")
+        return decoded
+
+    def iter_chunks(self, names=None, block_rows=DEFAULT_BLOCK_ROWS):
+        """Sequential (unshuffled) decoded blocks, e.g. for evaluation."""
+        names = tuple(names or self.columns)
+        for block in self.blocks(block_rows):
+            yield self.decode(block, names)
+
+
+
+# Loader
+_DONE = object()
+
+
+def _put(q, item, stop):
+    # give up if the consumer has gone away, so a producer never blocks on a full queue
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return None
+
+
+class ShardedLoader(object):
+    """Deterministic, shuffled, multi-worker batches with reusable batch buffers.
+
+    Only one epoch iterator may be active at a time (they share the buffers).
+    """
+
+    def __init__(self, dataset, batch_size, columns=None, seed=0, shuffle=True, shuffle_rows=DEFAULT_SHUFFLE_ROWS,
+                 block_rows=DEFAULT_BLOCK_ROWS, num_workers=2, prefetch=DEFAULT_PREFETCH, drop_last=False,
+                 rank=0, world_size=1, return_rows=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.names = tuple(columns or dataset.columns)
+        self.seed = seed
+        self.shuffle = shuffle
+        # whole batches, so the buffer is always refilled one incoming batch at a time
+        self.shuffle_rows = -(-max(shuffle_rows, batch_size) // batch_size) * batch_size if shuffle else 0
+        self.block_rows = block_rows
+        self.num_workers = max(num_workers, 1)
+        self.prefetch = max(prefetch, 1)
+        self.drop_last = drop_last
+        self.rank = rank
+        self.world_size = world_size
+        self.return_rows = return_rows
+        self.all_blocks = dataset.blocks(block_rows)
+        self.shard_offsets = np.concatenate([[0], np.cumsum(dataset.shard_rows)]).astype(np.int64)
+        self.fields = self.names + (("rows",) if return_rows else ())
+
+        # every array the steady state touches is allocated here, once
+        self.batches = [self._allocate(batch_size) for _ in range(self.prefetch + 1)]   # +1 held by the consumer
+        self.blocks = [self._allocate(block_rows) for _ in range(2 * self.num_workers + 1)]
+        self.stage = self._allocate(batch_size)
+        self.pool = self._allocate(self.shuffle_rows + batch_size) if shuffle else None
+        self.next_epoch = 0
+
+    def _allocate(self, n):
+        out = {name: np.empty((n,) + tuple(self.dataset.columns[name]["shape"]), dtype=self.dataset.decoded_dtype(name))
+               for name in self.names}
+        if self.return_rows:
+            out["rows"] = np.empty(n, dtype=np.int64)
+        return out
+
+    def _epoch_blocks(self, epoch):
+        blocks = self.all_blocks
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, epoch]).permutation(len(blocks))
+            blocks = [blocks[i] for i in order]
+        return blocks
+
+    def plan(self, epoch):
+        """This rank's blocks for an epoch, in the order they are read."""
+        return self._epoch_blocks(epoch)[self.rank::self.world_size]
+
+    def _batches(self, rows):
+        return rows // self.batch_size if self.drop_last else -(-rows // self.batch_size)
+
+    def __len__(self):
+        return self._batches(sum(stop - start for _, start, stop in self.plan(0)))
+
+    def min_batches(self, epoch):
+        """Batches the smallest rank gets this epoch; data-parallel ranks must all take this many steps."""
+        blocks = self._epoch_blocks(epoch)
+        return min(self._batches(sum(stop - start for _, start, stop in blocks[r::self.world_size]))
+                   for r in range(self.world_size))
+
+    def __iter__(self):
+        epoch = self.next_epoch
+        self.next_epoch += 1
+        return self.epoch(epoch)
+
+    def _decode(self, block, i):
+        out = self.dataset.decode(block, self.names, self.blocks[i])
+        if self.return_rows:
+            shard, start, stop = block
+            rows = out["rows"] = self.blocks[i]["rows"][:stop - start]
+            rows[:] = np.arange(self.shard_offsets[shard] + start, self.shard_offsets[shard] + stop)
+        return out
+
+    def _decoded(self, blocks, stop):
+        """Decoded blocks in plan order, with num_workers threads decoding ahead into block buffers."""
+        free = deque(range(len(self.blocks)))
+        pending = deque()
+        it = iter(blocks)
+        with ThreadPoolExecutor(self.num_workers, thread_name_prefix="decode") as pool:
+            def submit():
+                block = next(it, None)
+                if block is not None:
+                    i = free.popleft()
+                    pending.append((i, pool.submit(self._decode, block, i)))
+
+            for _ in range(len(self.blocks) - 1):
+                submit()
+            while pending and not stop.is_set():
+                i, future = pending.popleft()
+                yield future.result()
+                free.append(i)      # the assembler has copied the rows out
+                submit()
+            for _, future in pending:
+                future.cancel()
+
+    def _assemble(self, epoch, free, ready, stop):
+        """Background thread: decoded rows -> (shuffle buffer) -> batch buffers -> ready queue."""
+        B = self.batch_size
+        rng = np.random.default_rng([self.seed, epoch, 1])
+        pool, stage, fill, staged = self.pool, self.stage, 0, 0
+
+        def emit(n, fill_batch):
+            i = _get(free, stop)
+            if i is None:
+                return False
+            fill_batch(self.batches[i])
+            return _put(ready, (i, n), stop)
+
+        def push(rows):
+            # one incoming batch of `rows` staged rows
+            nonlocal fill
+            if not self.shuffle:
+                return emit(rows, lambda buf: [np.copyto(buf[k][:rows], stage[k][:rows]) for k in self.fields])
+            if fill < self.shuffle_rows:
+                for k in self.fields:
+                    pool[k][fill:fill + rows] = stage[k][:rows]
+                fill += rows
+                return True
+            # emit B random rows of the buffer and put the incoming batch in their place
+            slots = rng.choice(fill, rows, replace=False)
+
+            def swap(buf):
+                for k in self.fields:
+                    np.take(pool[k], slots, axis=0, out=buf[k][:rows])
+                    pool[k][slots] = stage[k][:rows]
+            return emit(rows, swap)
+
+        try:
+            for chunk in self._decoded(self.plan(epoch), stop):
+                n, pos = len(chunk[self.names[0]]), 0
+                while pos < n:
+                    take = min(B - staged, n - pos)
+                    for k in self.fields:
+                        stage[k][staged:staged + take] = chunk[k][pos:pos + take]
+                    staged += take
+                    pos += take
+                    if staged == B:
+                        staged = 0
+                        if not push(B):
+                            return
+            if stop.is_set():
+                return
+            if not self.shuffle:
+                if staged and not self.drop_last and not push(staged):
+                    return
+            else:
+                # drain the shuffle buffer (plus the partial batch) in random order
+                for k in self.fields:
+                    pool[k][fill:fill + staged] = stage[k][:staged]
+                fill += staged
+                order = rng.permutation(fill)
+                for b in range(0, fill, B):
+                    idx = order[b:b + B]
+                    if len(idx) < B and self.drop_last:
+                        break
+                    if not emit(len(idx), lambda buf, idx=idx: [np.take(pool[k], idx, axis=0, out=buf[k][:len(idx)])
+                                                                for k in self.fields]):
+                        return
+            _put(ready, _DONE, stop)
+        except BaseException as e:      # re-raised on the consumer side
+            _put(ready, e, stop)
+
+    def epoch(self, epoch):
+        """Batches of one epoch as {column: array} views into a reused buffer (valid until the next batch)."""
+        free = queue.Queue()
+        for i in range(len(self.batches)):
+            free.put(i)
+        ready = queue.Queue(maxsize=len(self.batches))
+        stop = threading.Event()
+        thread = threading.Thread(target=self._assemble, args=(epoch, free, ready, stop), daemon=True,
+                                  name="batch-assembler")
+        thread.start()
+        held = None
+        try:
+            while True:
+                item = ready.get()
+                if held is not None:
+                    free.put(held)
+                    held = None
+                if item is _DONE:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                held, n = item
+                buf = self.batches[held]
+                yield buf if n == self.batch_size else {k: a[:n] for k, a in buf.items()}
+        finally:
+            stop.set()
+            thread.join()
@@ -0,0 +1,320 @@
+"""
+embedding_store.py
+------------------
+Compressed embedding tables for the IdEmbeddings / Embeddings / UnifiedEmb path
+(model.py), configured by embed_learning in config_v1.py.
+
+quantization_v1.py only quantizes the dense student, but the sparse ID features'
+embedding tables are most of the model's bytes and most of its cache misses at serving
+time. This module provides pieces that compose:
+
+    QuantizedTable      row-wise INT8 or INT4 (two codes per byte) with a float32 scale
+                        and offset per row, clipped to embed_learning's
+                        [min_value, max_value]; saved as .npy files that are opened
+                        memory-mapped, so the cold table never has to fit in RAM
+    HashedEmbedding     hashing trick: k multiply-shift hashes into a shared bucket
+                        table, rows summed (for IDs whose cardinality has no useful bound)
+    QREmbedding         quotient-remainder compositional embedding: id -> (id // m,
+                        id % m), two tables of ~N/m and m rows combined by product or sum,
+                        so every ID still gets a unique vector
+    HotRowCache         bounded LRU / LFU cache of dequantized float32 rows in front of
+                        any of the above; a batch lookup dedups IDs, serves hits from a
+                        preallocated slot array and fetches all misses from the cold store
+                        in one vectorized gather
+
+Usage (from the repo root):
+    table = QuantizedTable.from_float(weights, bits=4, min_value=-1.0, max_value=1.0)
+    table.save("emb/query_id")
+    cold = QuantizedTable.open("emb/query_id")            # mmap
+    emb = HotRowCache(cold, capacity=100000, policy="lfu")
+    vectors = emb.lookup(ids)                               # (len(ids), dim) float32
+"""
+
+import heapq
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+
+
+BITS = (8, 4)
+CACHE_POLICIES = ("lru", "lfu")
+HEAP_COMPACT_FACTOR = 2   # lfu heap is rebuilt once it holds this many entries per cached row
+QR_COMBINERS = ("mult", "sum")
+META = "meta.json"
+
+
+
+# Row-wise quantization
+def quantize_rows(table, bits=8, min_value=None, max_value=None):
+    """Asymmetric per-row quantization. Returns (codes uint8, scale (rows,), offset (rows,)).
+
+    INT4 codes are packed two per byte (even column in the low nibble).
+    """
+    if bits not in BITS:
+        raise ValueError(f"Unsupported bits: {bits}")
+    table = np.asarray(table, dtype=np.float32)
+    if min_value is not None or max_value is not None:
+        table = np.clip(table, min_value, max_value)
+    qmax = (1 << bits) - 1
+    lo = table.min(axis=1)
+    hi = table.max(axis=1)
+    scale = np.where(hi > lo, (hi - lo) / qmax, 1.0).astype(np.float32)
+    codes = np.clip(np.round((table - lo[:, None]) / scale[:, None]), 0, qmax).astype(np.uint8)
+    if bits == 4:
+        if codes.shape[1] % 2:
+            codes = np.pad(codes, ((0, 0), (0, 1)))
+        codes = codes[:, 0::2] | (codes[:, 1::2] << 4)
+    return codes, scale, lo.astype(np.float32)
+
+
+def dequantize_rows(codes, scale, offset, bits, dim):
+    """Float32 rows from (gathered) codes and their per-row scale / offset."""
+    if bits == 4:
+        unpacked = np.empty((len(codes), codes.shape[1] * 2), dtype=np.uint8)
+        unpacked[:, 0::2] = codes & 0x0F
+        unpacked[:, 1::2] = codes >> 4
+        codes = unpacked[:, :dim]
+    return codes.astype(np.float32) * scale[:, None] + offset[:, None]
+
+
+class QuantizedTable(object):
+    """Row-wise INT8 / INT4 embedding table; arrays may be memory-mapped."""
+
+    def __init__(self, codes, scale, offset, bits, dim):
+        self.codes = codes
+        self.scale = scale
+        self.offset = offset
+        self.bits = bits
+        self.dim = dim
+
+    @classmethod
+    def from_float(cls, table, bits=8, min_value=None, max_value=None):
+        codes, scale, offset = quantize_rows(table, bits, min_value, max_value)
+        return cls(codes, scale, offset, bits, np.shape(table)[1])
+
+    def __len__(self):
+        return len(self.codes)
+
+    def lookup(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        return dequantize_rows(self.codes[ids], self.scale[ids], self.offset[ids], self.bits, self.dim)
+
+    def to_float(self):
+        return self.lookup(np.arange(len(self)))
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scale.nbytes + self.offset.nbytes
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in ("codes", "scale", "offset"):
+            np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(getattr(self, name)))
+        with open(os.path.join(path, META), "w") as f:
+            json.dump({"bits": self.bits, "dim": self.dim, "rows": len(self)}, f, indent=2)
+
+    @classmethod
+    def open(cls, path, mmap=True):
+        with open(os.path.join(path, META)) as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None)
+                  for name in ("codes", "scale", "offset")]
+        return cls(*arrays, meta["bits"], meta["dim"])
+
+
+class FloatTable(object):
+    """Uncompressed table with the same lookup interface (the FP32 baseline)."""
+
+    def __init__(self, table):
+        self.table = np.asarray(table, dtype=np.float32)
+        self.dim = self.table.shape[1]
+
+    def __len__(self):
+        return len(self.table)
+
+    def lookup(self, ids):
+        return self.table[np.asarray(ids, dtype=np.int64)]
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes
+
+
+def as_table(table, bits=None, min_value=None, max_value=None):
+    """Lookup table from a float array, an existing table, or a saved QuantizedTable path (mmap)."""
+    if isinstance(table, (str, os.PathLike)):
+        return QuantizedTable.open(table)
+    if bits is None:
+        return table if hasattr(table, "lookup") else FloatTable(table)
+    return QuantizedTable.from_float(table, bits, min_value, max_value)
+
+
+
+# Compositional embeddings
+class HashedEmbedding(object):
+    """Hashing trick: sum of `num_hashes` rows of a shared bucket table per ID."""
+
+    def __init__(self, table, num_hashes=2, seed=0):
+        self.table = as_table(table)
+        self.dim = self.table.dim
+        self.num_buckets = len(self.table)
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(0, 1 << 63, size=num_hashes, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = rng.integers(0, 1 << 63, size=num_hashes, dtype=np.uint64)
+
+    def buckets(self, ids):
+        """(len(ids), num_hashes) bucket indices: high 32 bits of (a * id + b) mod 2^64, mod num_buckets."""
+        ids = np.asarray(ids, dtype=np.int64).astype(np.uint64)[:, None]
+        with np.errstate(over="ignore"):
+            h = (self.a[None, :] * ids + self.b[None, :]) >> np.uint64(32)
+        return (h % np.uint64(self.num_buckets)).astype(np.int64)
+
+    def lookup(self, ids):
+        b = self.buckets(ids)
+        rows = self.table.lookup(b.ravel()).reshape(len(b), b.shape[1], self.dim)
+        return rows.sum(axis=1)
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes
+
+
+class QREmbedding(object):
+    """Quotient-remainder embedding: unique vector per ID from two small tables."""
+
+    def __init__(self, quotient_table, remainder_table, combiner="mult"):
+        if combiner not in QR_COMBINERS:
+            raise ValueError(f"Unknown combiner: {combiner}")
+        self.quotient = as_table(quotient_table)
+        self.remainder = as_table(remainder_table)
+        self.m = len(self.remainder)
+        self.combiner = combiner
+        self.dim = self.quotient.dim
+
+    @staticmethod
+    def table_shapes(num_ids, dim, num_collisions):
+        """Row counts of the (quotient, remainder) tables for num_ids IDs."""
+        return ((num_ids + num_collisions - 1) // num_collisions, dim), (num_collisions, dim)
+
+    def lookup(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        q = self.quotient.lookup(ids // self.m)
+        r = self.remainder.lookup(ids % self.m)
+        return q * r if self.combiner == "mult" else q + r
+
+    @property
+    def nbytes(self):
+        return self.quotient.nbytes + self.remainder.nbytes
+
+
+
+# Hot-row cache
+class HotRowCache(object):
+    """Bounded cache of float32 rows (LRU or LFU) in front of a cold table."""
+
+    def __init__(self, store, capacity, policy="lru"):
+        if policy not in CACHE_POLICIES:
+            raise ValueError(f"Unknown cache policy: {policy}")
+        self.store = store
+        self.dim = store.dim
+        self.capacity = capacity
+        self.policy = policy
+        self.rows = np.empty((capacity, self.dim), dtype=np.float32)
+        self.slots = OrderedDict() if policy == "lru" else {}    # id -> slot
+        self.free = list(range(capacity - 1, -1, -1))
+        self.counts = {}
+        self.heap = []            # lfu: (count, tick, id), stale entries skipped lazily
+        self.tick = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def _touch(self, i, n=1):
+        if self.policy == "lru":
+            self.slots.move_to_end(i)
+        else:
+            self.counts[i] += n
+            self.tick += 1
+            heapq.heappush(self.heap, (self.counts[i], self.tick, i))
+            if len(self.heap) > HEAP_COMPACT_FACTOR * max(self.capacity, 1):
+                self._compact()
+
+    def _compact(self):
+        """Drop stale lfu entries; each resident id keeps only its latest (current count) entry."""
+        self.heap = [e for e in self.heap if e[2] in self.slots and self.counts.get(e[2]) == e[0]]
+        heapq.heapify(self.heap)
+
+    def _evict(self):
+        if self.policy == "lru":
+            _, slot = self.slots.popitem(last=False)
+            self.evictions += 1
+            return slot
+        while True:
+            count, _, i = heapq.heappop(self.heap)
+            if i in self.slots and self.counts[i] == count:
+                del self.counts[i]
+                self.evictions += 1
+                return self.slots.pop(i)
+
+    def _insert(self, i, row, n):
+        slot = self.free.pop() if self.free else self._evict()
+        self.rows[slot] = row
+        self.slots[i] = slot
+        if self.policy == "lfu":
+            self.counts[i] = 0
+            self._touch(i, n)
+        return slot
+
+    def lookup(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        unique, inverse, counts = np.unique(ids, return_inverse=True, return_counts=True)
+        out = np.empty((len(unique), self.dim), dtype=np.float32)
+
+        missing = []
+        for j, (i, n) in enumerate(zip(unique.tolist(), counts.tolist())):
+            slot = self.slots.get(i)
+            if slot is None:
+                missing.append(j)
+            else:
+                out[j] = self.rows[slot]
+                self._touch(i, n)
+                self.hits += n
+        if missing:
+            missing = np.asarray(missing)
+            fetched = self.store.lookup(unique[missing])    # one gather from the cold store
+            out[missing] = fetched
+            for j, row in zip(missing.tolist(), fetched):
+                n = int(counts[j])
+                self.misses += 1
+                self.hits += n - 1
+                if self.capacity:
+                    self._insert(int(unique[j]), row, n)
+        return out[inverse]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0, "resident_rows": len(self.slots),
+                "resident_bytes": len(self.slots) * self.dim * 4}
+
+
+
+# Config
+def build_embedding(weights, config):
+    """Build a (possibly compositional, quantized, cached) embedding from embed_learning['compression'].
+
+    `weights` is a float table or saved-table path, or a (quotient, remainder) pair of
+    them for compositional='qr'.
+    """
+    bits = config.get("bits")
+    lo, hi = config.get("min_value"), config.get("max_value")
+    kind = config.get("compositional")
+    if kind == "qr":
+        emb = QREmbedding(as_table(weights[0], bits, lo, hi), as_table(weights[1], bits, lo, hi),
+                          config.get("qr_combiner", "mult"))
+    elif kind == "hash":
+        emb = HashedEmbedding(as_table(weights, bits, lo, hi), config.get("num_hashes", 2), config.get("seed", 0))
+    else:
+        emb = as_table(weights, bits, lo, hi)
+    if config.get("hot_cache_rows"):
+        emb = HotRowCache(emb, config["hot_cache_rows"], config.get("cache_policy", "lru"))
+    return emb
@@ -0,0 +1,449 @@
+"""Data-parallel distillation over several CPU processes / machines
+
+Distillation (distillation_v1.py / distillation_v2.py) runs in one process, and the
+nightly student retrain no longer fits its window as the logs grow. Here W worker
+processes, on one or more machines, each train on a disjoint slice of the data shards
+(ShardedLoader's rank / world_size) and average gradients every step:
+
+	- ring all-reduce over plain TCP sockets: reduce-scatter then all-gather, each rank
+	  sending to the next and receiving from the previous one, so every link carries
+	  2 (W - 1) / W of the gradient bytes per step regardless of W
+	- fp16 on the wire (half the bytes); sums are accumulated in float32, gradients are
+	  pre-scaled by 1 / W so partial sums stay in fp16 range, and the local rounding
+	  error is fed back into the next step's gradient (error feedback)
+	- the backward pass is split at the hidden-layer outputs (top segment first): as soon
+	  as a segment's gradients exist they are handed to a communication thread, which
+	  all-reduces them while TensorFlow computes the next segment's gradients
+	- every rank starts from rank 0's weights and takes the same number of steps per
+	  epoch (the smallest rank slice), so the all-reduces always line up
+
+Ranks listen on base_port + rank on their host. On one machine (loopback) the whole
+thing runs as local processes:
+
+	python -m knowledge_distillation.data_parallel --selftest 4
+
+Usage (in each worker process):
+	comm = RingComm(rank, world_size, hosts=['10.0.0.1', '10.0.0.2'])
+	distiller = DataParallelDistiller(build_student(), comm, distillation_params)
+	loader = ShardedLoader(ShardedDataset(shards), 512, seed=0, rank=rank, world_size=world_size, return_rows=True)
+	distiller.train(loader, open_teacher_cache(cache_dir, teacher_hash, shard_id_for(x_train)), epochs=3)
+"""
+
+import argparse
+import multiprocessing as mp
+import queue
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+DEFAULT_PORT = 29500
+DEFAULT_TIMEOUT = 60.0
+COMPRESSIONS = (None, 'fp16')
+FP16_MAX = float(np.finfo(np.float16).max)
+HEAD_LAYERS = ('prob_logits', 'conv_value', 'conv_prob')
+
+
+# Ring all-reduce
+class RingComm(object):
+	"""Socket ring between `world_size` ranks: this rank sends to rank + 1 and receives from rank - 1."""
+
+	def __init__(self, rank, world_size, hosts=None, base_port=DEFAULT_PORT, timeout=DEFAULT_TIMEOUT):
+		self.rank = rank
+		self.world_size = world_size
+		hosts = hosts or ['127.0.0.1']
+		if isinstance(hosts, str):
+			hosts = [hosts]		# a single host name, not a sequence of characters
+		self.hosts = list(hosts) * world_size if len(hosts) == 1 else list(hosts)
+		if len(self.hosts) != world_size:
+			raise ValueError(f'{len(self.hosts)} hosts for world_size {world_size}')
+		self.base_port = base_port
+		self.bytes_sent = 0
+		self.seconds = 0.0
+		self._wire = {}
+		self.sender = ThreadPoolExecutor(1, thread_name_prefix='ring-send')
+		if world_size > 1:
+			self._connect(timeout)
+
+	def _connect(self, timeout):
+		listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		listener.bind((self.hosts[self.rank], self.base_port + self.rank))
+		listener.listen(1)
+		listener.settimeout(timeout)
+
+		nxt = (self.rank + 1) % self.world_size
+		deadline = time.monotonic() + timeout
+		while True:
+			try:
+				self.send_sock = socket.create_connection((self.hosts[nxt], self.base_port + nxt), timeout=timeout)
+				break
+			except OSError:
+				if time.monotonic() > deadline:
+					raise
+				time.sleep(0.05)
+		self.send_sock.sendall(struct.pack('!i', self.rank))
+
+		self.recv_sock, _ = listener.accept()
+		listener.close()
+		peer = struct.unpack('!i', self._recv_exact(4))[0]
+		if peer != (self.rank - 1) % self.world_size:
+			raise ConnectionError(f'rank {self.rank} expected rank {(self.rank - 1) % self.world_size}, got {peer}')
+		for s in (self.send_sock, self.recv_sock):
+			s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			s.settimeout(None)
+
+	def _recv_exact(self, n):
+		buf = bytearray(n)
+		self._recv_into(memoryview(buf))
+		return bytes(buf)
+
+	def _recv_into(self, view):
+		got = 0
+		while got < len(view):
+			n = self.recv_sock.recv_into(view[got:])
+			if n == 0:
+				raise ConnectionError(f'rank {self.rank}: peer closed the ring')
+			got += n
+
+	def _buffers(self, dtype, n):
+		send, recv = self._wire.get(dtype, (None, None))
+		if send is None or len(send) < n:
+			send, recv = np.empty(n, dtype), np.empty(n, dtype)
+			self._wire[dtype] = (send, recv)
+		return send, recv
+
+	def _exchange(self, send, n_send, recv, n_recv):
+		# send to the next rank on the sender thread while receiving from the previous one
+		pending = self.sender.submit(self.send_sock.sendall, memoryview(send[:n_send]).cast('B'))
+		self._recv_into(memoryview(recv[:n_recv]).cast('B'))
+		pending.result()
+		self.bytes_sent += send.itemsize * n_send
+
+	def allreduce_(self, flat, compression=None, residual=None):
+		"""Average a float32 vector across ranks, in place.
+
+		With compression='fp16' and a `residual` buffer, this rank's rounding error is kept
+		in `residual` and added to the next call's input (error feedback).
+		"""
+		if compression not in COMPRESSIONS:
+			raise ValueError(f'Unknown compression: {compression}')
+		W = self.world_size
+		if W == 1:
+			return flat
+		start = time.perf_counter()
+		flat *= 1.0 / W
+		if compression == 'fp16' and residual is not None:
+			flat += residual
+			np.subtract(flat, np.clip(flat, -FP16_MAX, FP16_MAX).astype(np.float16), out=residual)
+		bounds = np.linspace(0, len(flat), W + 1).astype(np.int64)
+		chunks = [flat[bounds[i]:bounds[i + 1]] for i in range(W)]
+		wire = np.float16 if compression == 'fp16' else np.float32
+		send, recv = self._buffers(wire, int(np.diff(bounds).max()))
+
+		def pack(c):
+			if compression == 'fp16':
+				np.clip(c, -FP16_MAX, FP16_MAX, out=send[:len(c)], casting='same_kind')
+			else:
+				send[:len(c)] = c
+			return len(c)
+
+		# reduce-scatter: after W - 1 steps this rank holds the full sum of chunk rank + 1
+		for step in range(W - 1):
+			s, r = (self.rank - step) % W, (self.rank - step - 1) % W
+			self._exchange(send, pack(chunks[s]), recv, len(chunks[r]))
+			chunks[r] += recv[:len(chunks[r])]
+		if compression == 'fp16':
+			# every rank must end with bit-identical values, so the owner rounds its chunk too
+			own = chunks[(self.rank + 1) % W]
+			own[:] = np.clip(own, -FP16_MAX, FP16_MAX).astype(np.float16)
+		# all-gather
+		for step in range(W - 1):
+			s, r = (self.rank - step + 1) % W, (self.rank - step) % W
+			self._exchange(send, pack(chunks[s]), recv, len(chunks[r]))
+			chunks[r][:] = recv[:len(chunks[r])]
+		self.seconds += time.perf_counter() - start
+		return flat
+
+	def broadcast_(self, flat, root=0):
+		"""Copy root's float32 vector to every rank, in place (passed along the ring)."""
+		W = self.world_size
+		if W == 1:
+			return flat
+		view = memoryview(flat).cast('B')
+		if self.rank != root:
+			self._recv_into(view)
+		if (self.rank + 1) % W != root:
+			self.send_sock.sendall(view)
+		return flat
+
+	def barrier(self):
+		token = np.zeros(1, np.float32)
+		self.allreduce_(token)
+
+	def close(self):
+		self.sender.shutdown()
+		if self.world_size > 1:
+			self.send_sock.close()
+			self.recv_sock.close()
+
+
+class AsyncReducer(object):
+	"""Communication thread: all-reduces gradient buckets in submission order."""
+
+	def __init__(self, comm, compression='fp16', error_feedback=True):
+		self.comm = comm
+		self.compression = compression
+		self.error_feedback = error_feedback and compression == 'fp16'
+		self.residuals = {}
+		self.jobs = queue.Queue()
+		self.results = {}
+		self.pending = 0
+		self.done = threading.Condition()
+		self.wait_seconds = 0.0
+		self.thread = threading.Thread(target=self._run, name='allreduce', daemon=True)
+		self.thread.start()
+
+	def submit(self, key, arrays):
+		"""Queue one bucket (a list of float32 arrays). Every rank must submit the same keys in the same order."""
+		with self.done:
+			self.pending += 1
+		self.jobs.put((key, arrays))
+
+	def _run(self):
+		while True:
+			job = self.jobs.get()
+			if job is None:
+				return
+			key, arrays = job
+			try:
+				flat = np.concatenate([np.ravel(a).astype(np.float32, copy=False) for a in arrays])
+				residual = None
+				if self.error_feedback:
+					residual = self.residuals.setdefault(key, np.zeros_like(flat))
+				self.comm.allreduce_(flat, self.compression, residual)
+				out, offset = [], 0
+				for a in arrays:
+					out.append(flat[offset:offset + a.size].reshape(a.shape))
+					offset += a.size
+			except BaseException as e:      # re-raised by wait()
+				out = e
+			with self.done:
+				self.results[key] = out
+				self.pending -= 1
+				self.done.notify_all()
+
+	def wait(self):
+		"""{key: averaged arrays} for everything submitted since the last wait()."""
+		start = time.perf_counter()
+		with self.done:
+			while self.pending:
+				self.done.wait()
+			results, self.results = self.results, {}
+		self.wait_seconds += time.perf_counter() - start
+		for r in results.values():
+			if isinstance(r, BaseException):
+				raise r
+		return results
+
+	def close(self):
+		self.jobs.put(None)
+		self.thread.join()
+
+
+# Teacher outputs for a batch
+def gather_teacher_rows(cache, rows):
+	"""Teacher outputs (dict of arrays) for arbitrary global rows of a TeacherCache."""
+	rows = np.asarray(rows, dtype=np.int64)
+	chunk_ids = rows // cache.chunk_rows
+	out = None
+	for c in np.unique(chunk_ids):
+		mask = chunk_ids == c
+		local = rows[mask] - c * cache.chunk_rows
+		arrays = cache.chunk(int(c))
+		if out is None:
+			out = {k: np.empty((len(rows),) + a.shape[1:], dtype=a.dtype) for k, a in arrays.items()}
+		for k, a in arrays.items():
+			out[k][mask] = a[local]
+	return out
+
+
+# Trainer
+def _first(value):
+	return value[0] if isinstance(value, (list, tuple)) else value
+
+
+class _Segment(object):
+	__slots__ = ('variables', 'input')
+
+	def __init__(self, variables, input):
+		self.variables = variables
+		self.input = input      # name of the boundary activation below this segment (None at the bottom)
+
+
+class DataParallelDistiller(object):
+	"""One rank of data-parallel KD: local forward / segmented backward, ring-averaged gradients.
+
+	Uses 'temperature', 'alpha' and the first 'intermediate_losses' hint weight from
+	distillation_params (first value of sweep lists) with fused_loss.distillation_loss.
+	boundary_layers (default: every hidden Dense layer) are where the backward is split;
+	every path from the input to the loss must pass through each of them.
+	"""
+
+	def __init__(self, student_model, comm, distillation_params, learning_rate=1e-3, optimizer=None,
+		     boundary_layers=None, hint_layer='bottleneck', compression='fp16', error_feedback=True):
+		import tensorflow as tf
+
+		self.comm = comm
+		self.student = student_model
+		self.optimizer = optimizer or tf.keras.optimizers.Adam(learning_rate)
+		hints = distillation_params.get('intermediate_losses') or []
+		self.temperature = float(_first(distillation_params.get('temperature', 1.0)))
+		self.alpha = float(_first(distillation_params.get('alpha', 0.5)))
+		self.hint_weight = float(_first(hints[0].get('weight', 0.0))) if hints else 0.0
+		self.hint_layer = hint_layer
+
+		layers = student_model.layers
+		if boundary_layers is None:
+			boundary_layers = [l.name for l in layers
+					   if l.__class__.__name__ == 'Dense' and l.name not in HEAD_LAYERS]
+		index = {l.name: i for i, l in enumerate(layers)}
+		cuts = sorted(index[name] for name in boundary_layers)
+		# segments top -> bottom; segment k holds the layers above cut k - 1's output
+		self.segments = []
+		upper = len(layers)
+		for cut in reversed(cuts):
+			self.segments.append(_Segment([w for l in layers[cut + 1:upper] for w in l.trainable_weights],
+						      layers[cut].name))
+			upper = cut + 1
+		self.segments.append(_Segment([w for l in layers[:upper] for w in l.trainable_weights], None))
+		self.variables = [v for seg in self.segments for v in seg.variables]
+
+		outputs = {name: student_model.get_layer(name).output for name in ('conv_value', 'prob_logits')}
+		for name in boundary_layers + ([hint_layer] if self.hint_weight > 0 else []):
+			outputs[name] = student_model.get_layer(name).output
+		self.probe = tf.keras.Model(inputs=student_model.inputs, outputs=outputs)
+		self.reducer = AsyncReducer(comm, compression, error_feedback)
+		self.steps = 0
+		self.sync_weights()
+
+	def sync_weights(self, root=0):
+		"""Give every rank root's weights."""
+		weights = self.student.get_weights()
+		flat = np.concatenate([np.ravel(w).astype(np.float32) for w in weights])
+		self.comm.broadcast_(flat, root)
+		out, offset = [], 0
+		for w in weights:
+			out.append(flat[offset:offset + w.size].reshape(w.shape).astype(w.dtype))
+			offset += w.size
+		self.student.set_weights(out)
+
+	def step(self, x, labels, teacher_outputs):
+		"""One synchronous data-parallel step. Returns this rank's local loss."""
+		import tensorflow as tf
+		from knowledge_distillation.fused_loss import distillation_loss
+
+		with tf.GradientTape(persistent=True) as tape:
+			out = self.probe(x, training=True)
+			total, _ = distillation_loss(out, teacher_outputs, labels, [self.temperature], [self.alpha],
+						     [self.hint_weight], s_hint=out.get(self.hint_layer),
+						     t_hint=teacher_outputs.get(self.hint_layer), schedule=None)
+			loss = total[0]
+
+		# backward one segment at a time, top first; each segment's gradients go to the
+		# communication thread while the next segment's backward runs
+		target, upstream = loss, None
+		for k, seg in enumerate(self.segments):
+			sources = seg.variables + ([out[seg.input]] if seg.input else [])
+			grads = tape.gradient(target, sources, output_gradients=upstream)
+			self.reducer.submit(k, [np.zeros(v.shape, np.float32) if g is None else np.asarray(g)
+						for v, g in zip(seg.variables, grads)])
+			if seg.input:
+				target, upstream = out[seg.input], grads[-1]
+		del tape
+
+		averaged = self.reducer.wait()
+		grads = [g for k in range(len(self.segments)) for g in averaged[k]]
+		self.optimizer.apply_gradients(zip(grads, self.variables))
+		self.steps += 1
+		return float(loss)
+
+	def train(self, loader, teacher_cache, epochs=1, log_every=100):
+		"""Train on this rank's slice of `loader` (which must return rows) with teacher outputs from the cache."""
+		history = []
+		for epoch in range(epochs):
+			steps = loader.min_batches(epoch)
+			start, comm_start, wait_start = time.perf_counter(), self.comm.seconds, self.reducer.wait_seconds
+			for i, batch in enumerate(loader.epoch(epoch)):
+				if i == steps:
+					break
+				labels = {'conv_prob': batch['conv_prob'], 'conv_value': batch['conv_value']}
+				loss = self.step(batch['x'], labels, gather_teacher_rows(teacher_cache, batch['rows']))
+				if self.comm.rank == 0 and log_every and (i + 1) % log_every == 0:
+					print(f'[rank 0] epoch {epoch} step {i + 1}/{steps} loss {loss:.4f}')
+			elapsed = time.perf_counter() - start
+			comm = self.comm.seconds - comm_start
+			exposed = self.reducer.wait_seconds - wait_start
+			history.append({'epoch': epoch, 'steps': steps, 'seconds': elapsed, 'comm_seconds': comm,
+					'exposed_comm_seconds': exposed, 'overlap': 1 - exposed / comm if comm else 1.0})
+			if self.comm.rank == 0:
+				print(f"[rank 0] epoch {epoch}: {steps} steps in {elapsed:.1f}s, all-reduce {comm:.1f}s "
+				      f"({history[-1]['overlap']:.0%} hidden behind the backward pass)")
+		return history
+
+	def close(self):
+		self.reducer.close()
+
+
+# Local launch / loopback self-test
+def launch_local(target, world_size, *args):
+	"""Run target(rank, world_size, *args) in world_size spawned processes; returns their exit codes."""
+	ctx = mp.get_context('spawn')
+	procs = [ctx.Process(target=target, args=(rank, world_size) + args) for rank in range(world_size)]
+	for p in procs:
+		p.start()
+	for p in procs:
+		p.join()
+	return [p.exitcode for p in procs]
+
+
+def _selftest_vector(rank, size):
+	return np.random.default_rng(rank).standard_normal(size).astype(np.float32)
+
+
+def _selftest_worker(rank, world_size, base_port, size, iterations):
+	comm = RingComm(rank, world_size, base_port=base_port)
+	expected = np.mean([_selftest_vector(r, size) for r in range(world_size)], axis=0)
+	for compression in COMPRESSIONS:
+		flat = _selftest_vector(rank, size)
+		comm.allreduce_(flat, compression)
+		err = float(np.abs(flat - expected).max())
+		comm.barrier()
+		start, sent = time.perf_counter(), comm.bytes_sent
+		for _ in range(iterations):
+			comm.allreduce_(flat, compression)
+		seconds = (time.perf_counter() - start) / iterations
+		if rank == 0:
+			mb = (comm.bytes_sent - sent) / iterations / 1e6
+			print(f'{str(compression):<5} max |error| {err:.2e}  {seconds * 1e3:8.2f} ms / all-reduce  '
+			      f'{mb:.2f} MB sent per rank')
+	comm.close()
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Ring all-reduce self-test over loopback')
+	parser.add_argument('--selftest', type=int, default=4, metavar='WORLD_SIZE')
+	parser.add_argument('--size', type=int, default=1 << 20, help='float32 elements per all-reduce')
+	parser.add_argument('--iterations', type=int, default=20)
+	parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+	args = parser.parse_args()
+	codes = launch_local(_selftest_worker, args.selftest, args.port, args.size, args.iterations)
+	if any(codes):
+		raise SystemExit(f'worker exit codes: {codes}')
+
+
+if __name__ == '__main__':
+	main()
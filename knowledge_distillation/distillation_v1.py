@@ -46,4 +46,10 @@ def distillation_params(self):
 		'temperature': [1.5, 2, 3, 4, 6],
 		'alpha': [.3, .5, .7, .9],
 		'freeze_teacher': True,
+		# frozen teacher outputs + hint features are computed once and reused across the sweep
+		'teacher_cache': {
+			'dir': 'teacher_cache',
+			'chunk_rows': 65536,
+			'hint_layer': 'bottleneck',
+		},
 	}
\ No newline at end of file
@@ -44,6 +44,48 @@ def distillation_params(self):
 		'temperature': [1.5, 2, 3, 4, 6], 	        # sweep over different temperatures
 		'alpha': [.3, .5, .7, .9],		        # weight on soft targets vs. hard labels 
 		'freeze_teacher': True,
+		# frozen teacher outputs + hint features are computed once and reused across the sweep
+		'teacher_cache': {
+			'dir': 'teacher_cache',
+			'chunk_rows': 65536,
+			'hint_layer': 'bottleneck',
+		},
+		# online KD (online_kd.py): distill continuously from a stream of fresh events
+		'online': {
+			'source': 'events.jsonl',		# JSON-lines file tail (or an in-process queue)
+			'batch_size': 256,
+			'max_wait_ms': 200,			# flush a partial micro-batch after this long
+			'teacher_threads': 1,
+			'queue_size': 4,			# teacher batches buffered ahead of the student
+			'backpressure': 'block',		# or 'drop_oldest' to always train on the freshest traffic
+			'hint_layer': 'bottleneck',
+			'checkpoint_path': 'online_student/ckpt',
+			'checkpoint_every_s': 60,
+		},
+		# expert-aware sampling (moe_trace.py): distill on a subset picked from the teacher's routing trace
+		'moe_sampling': {
+			'trace_dir': 'moe_trace',
+			'gate_layers': [],			# REQUIRED: names of the GmoeStack gate (softmax) layers to record
+			'top_k': 2,
+			'strategy': 'stratified',		# or 'importance'
+			'sample_fraction': 0.25,
+			'layer': -1,				# MoE layer whose top-1 expert defines the strata
+			'uncertainty_bins': 4,
+			'allocation': 'equal',			# or 'proportional'
+			'importance_floor': 0.05,
+			'rarity_power': 0.5,
+			'seed': 0,
+		},
+		# data-parallel KD (data_parallel.py): one process per shard slice, ring all-reduce of gradients
+		'data_parallel': {
+			'world_size': 4,
+			'hosts': ['127.0.0.1'],			# one entry per rank, or a single host for all of them
+			'base_port': 29500,			# rank r listens on base_port + r
+			'compression': 'fp16',			# or None for float32 on the wire
+			'error_feedback': True,
+			'shards': 'data/train_shards',		# dataloader/sharded_loader.py format
+			'batch_size': 512,			# per rank; the effective batch is world_size x this
+		},
 
 		# Adding this for a FitNet-style intermediate loss
 		'intermediate_losses': [{
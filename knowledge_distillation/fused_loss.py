@@ -0,0 +1,143 @@
+"""Fused multi-head distillation loss
+
+The notebook's run_experiment builds the student loss from separate Keras losses:
+BCE + Poisson on the hard labels, MSE between sigmoid(logits / T) of teacher and
+student, and an MSE hint loss on the bottleneck features (the FitNet-style
+'intermediate_losses' entry in distillation_v2.py). Each op materializes its own
+softened probability tensor, and every (temperature, alpha, hint weight) sweep
+config pays for the whole thing again.
+
+distillation_loss computes every term in a single pass over one student forward:
+
+	- hard loss: BCE on prob_logits (from logits) + Poisson NLL on conv_value
+	- soft loss: temperature-scaled binary KL between teacher and student logits, in
+	  log space with no probability tensors:
+		KL(sigmoid(a) || sigmoid(b)) = softplus(b) - softplus(a) - sigmoid(a) * (b - a)
+	  with a = t_logits / T and b = s_logits / T, plus the notebook's MSE between
+	  teacher and student conv_value
+	- hint loss: MSE between the (optionally linearly projected, as in the config's
+	  'projection' block) student features and the teacher's hint features, weighted by
+	  a cosine-decayed schedule
+
+temperatures / alphas / hint_weights may be scalars or 1-D stacks of K values; the
+result is then a (K,) vector of total losses, one per sweep config. Only the KL term
+depends on the temperature, so the K configs cost one (K, batch) elementwise op on
+top of the shared terms.
+
+Usage:
+	params, configs = loss_params(distillation_params, total_steps)
+	total, parts = distillation_loss(s_out, t_out, y, step=step, **params)
+	loss = total[0]  # or tf.reduce_sum(total) to train on several configs at once
+"""
+
+import itertools
+import math
+
+
+DEFAULT_EPS = 1e-7   # tf.keras.losses.Poisson epsilon
+
+
+# Schedules
+def cosine_decay(step, decay_steps, final_fraction=0.0):
+	"""Multiplier decaying from 1 to final_fraction over decay_steps (the hint 'cosine decay' schedule)."""
+	import tensorflow as tf
+
+	if not decay_steps:
+		return tf.constant(1.0)
+	progress = tf.minimum(tf.cast(step, tf.float32) / float(decay_steps), 1.0)
+	return final_fraction + (1.0 - final_fraction) * 0.5 * (1.0 + tf.cos(math.pi * progress))
+
+
+SCHEDULES = {
+	None: lambda step, decay_steps: 1.0,
+	'constant': lambda step, decay_steps: 1.0,
+	'cosine decay': cosine_decay,
+}
+
+
+# Loss terms
+def binary_kl_with_logits(t_logits, s_logits, temperatures):
+	"""Mean KL(sigmoid(t / T) || sigmoid(s / T)) per temperature, computed from logits.
+
+	t_logits / s_logits have shape (batch,); temperatures shape (K,). Returns (K,).
+	"""
+	import tensorflow as tf
+
+	inv_t = 1.0 / tf.reshape(temperatures, (-1, 1))
+	a = t_logits[None, :] * inv_t
+	b = s_logits[None, :] * inv_t
+	kl = tf.math.softplus(b) - tf.math.softplus(a) - tf.sigmoid(a) * (b - a)
+	return tf.reduce_mean(kl, axis=1)
+
+
+def _flat(x):
+	import tensorflow as tf
+	return tf.reshape(tf.cast(x, tf.float32), (-1,))
+
+
+def distillation_loss(student, teacher, labels, temperatures, alphas, hint_weights=0.0,
+		      s_hint=None, t_hint=None, projection=None, step=0, decay_steps=None,
+		      schedule='cosine decay', eps=DEFAULT_EPS):
+	"""Total distillation loss for K stacked (temperature, alpha, hint weight) configs.
+
+	student / teacher: dicts with 'prob_logits' and 'conv_value' (any trailing 1-dim is
+	flattened). labels: dict with 'conv_prob' (0/1) and 'conv_value' (counts).
+	s_hint / t_hint: intermediate features; projection is an optional (s_dim, t_dim)
+	matrix (the config's bias-free linear projection).
+
+	Returns (total, parts): total has shape (K,); parts holds the shared scalar terms
+	and the (K,) KL vector.
+	"""
+	import tensorflow as tf
+
+	temperatures, alphas, hint_weights = _flat(temperatures), _flat(alphas), _flat(hint_weights)
+	s_logits, t_logits = _flat(student['prob_logits']), _flat(teacher['prob_logits'])
+	s_value, t_value = _flat(student['conv_value']), _flat(teacher['conv_value'])
+	y_prob, y_value = _flat(labels['conv_prob']), _flat(labels['conv_value'])
+
+	# hard: BCE from logits (softplus(s) - y * s) and Poisson NLL, shared by every config
+	bce = tf.reduce_mean(tf.math.softplus(s_logits) - y_prob * s_logits)
+	pll = tf.reduce_mean(s_value - y_value * tf.math.log(s_value + eps))
+	hard = bce + pll
+
+	# soft: one (K, batch) KL op; value matching does not depend on T
+	kl = binary_kl_with_logits(t_logits, s_logits, temperatures)
+	value_mse = tf.reduce_mean(tf.square(s_value - t_value))
+	soft = temperatures ** 2 * (kl + value_mse)
+
+	hint = tf.constant(0.0)
+	if s_hint is not None and t_hint is not None:
+		s_feat = tf.cast(s_hint, tf.float32)
+		if projection is not None:
+			s_feat = tf.matmul(s_feat, projection)
+		hint = tf.reduce_mean(tf.square(s_feat - tf.cast(t_hint, tf.float32)))
+	hint_scale = SCHEDULES[schedule](step, decay_steps)
+
+	total = (1.0 - alphas) * hard + alphas * soft + hint_weights * hint_scale * hint
+	parts = {'bce': bce, 'pll': pll, 'kl': kl, 'value_mse': value_mse, 'hint': hint, 'hint_scale': hint_scale}
+	return total, parts
+
+
+# Config
+def _as_list(v):
+	return list(v) if isinstance(v, (list, tuple)) else [v]
+
+
+def loss_params(distillation_params, total_steps=None, hint_index=0):
+	"""Stacked loss arguments for every (temperature, alpha, hint weight) in the config sweep.
+
+	Returns (kwargs for distillation_loss, [(T, alpha, weight), ...] in stack order).
+	"""
+	hints = distillation_params.get('intermediate_losses') or []
+	hint = hints[hint_index] if len(hints) > hint_index else {}
+	configs = list(itertools.product(_as_list(distillation_params.get('temperature', 1.0)),
+					 _as_list(distillation_params.get('alpha', 0.5)),
+					 _as_list(hint.get('weight', 0.0))))
+	params = {
+		'temperatures': [c[0] for c in configs],
+		'alphas': [c[1] for c in configs],
+		'hint_weights': [c[2] for c in configs],
+		'schedule': hint.get('schedule'),
+		'decay_steps': total_steps,
+	}
+	return params, configs
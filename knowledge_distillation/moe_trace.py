@@ -0,0 +1,331 @@
+"""MoE teacher routing trace and expert-aware distillation sampling
+
+The teacher's MoE layers (GmoeStack in model.py, "MoE Layers" in the README diagram)
+are what make teacher inference expensive, and distillation currently spends it
+uniformly on every example, although most examples route to a few popular experts
+and the teacher is confident on them.
+
+RoutingTraceWriter records, during a teacher inference pass, per example and per MoE
+layer the top-k expert ids and their gate weights, the gate entropy, and the teacher's
+uncertainty (binary entropy of conv_prob). The log is columnar and compact (uint8 /
+uint16 expert ids, float16 gates), one .npy file per column per chunk, so readers only
+touch the columns they need:
+
+	<trace_dir>/manifest.json
+	<trace_dir>/chunk_00000/{rows, experts, gates, gate_entropy, uncertainty}.npy
+
+Distillation then picks its training examples from the trace instead of the full set:
+
+	stratified_sample   strata = (top-1 expert at a layer) x (uncertainty quantile bin);
+			    'proportional' or 'equal' (rare experts up-weighted) allocation
+	importance_sample   p(row) ~ (uncertainty + floor) * expert_rarity ** rarity_power;
+			    Poisson sampling, row kept with probability min(1, c * p)
+
+Both return (rows, weights); the weights are inverse inclusion probabilities normalized
+to mean 1, so a weighted loss stays an unbiased estimate of the full-data loss. The
+teacher only has to be run (or its cache read) on the sampled rows.
+
+Usage:
+	writer = RoutingTraceWriter('traces/teacher_v3', top_k=2)
+	fn = TracingTeacher(keras_gated_teacher_fn(teacher, gate_layers), writer)
+	build_teacher_cache(fn, X_train, ...)          # trace is recorded as a side effect
+	writer.close()
+	rows, weights = stratified_sample(RoutingTrace('traces/teacher_v3'), n=len(X_train) // 4)
+"""
+
+import json
+import os
+import numpy as np
+
+from knowledge_distillation.teacher_cache import MANIFEST, TEACHER_FIELDS, _write_manifest
+
+
+COLUMNS = ('rows', 'experts', 'gates', 'gate_entropy', 'uncertainty')
+DEFAULT_TOP_K = 2
+DEFAULT_CHUNK_ROWS = 65536
+DEFAULT_UNCERTAINTY_BINS = 4
+GATE_PREFIX = 'gate:'
+EPS = 1e-7
+
+
+# Routing statistics
+def top_k_routing(gate_probs, k):
+	"""Top-k expert ids (descending weight) and their weights for a (n, num_experts) gate output."""
+	k = min(k, gate_probs.shape[1])
+	idx = np.argpartition(-gate_probs, k - 1, axis=1)[:, :k]
+	weights = np.take_along_axis(gate_probs, idx, axis=1)
+	order = np.argsort(-weights, axis=1)
+	return np.take_along_axis(idx, order, axis=1), np.take_along_axis(weights, order, axis=1)
+
+
+def gate_entropy(gate_probs):
+	p = np.clip(gate_probs, EPS, 1.0)
+	return -(p * np.log(p)).sum(axis=1)
+
+
+def teacher_uncertainty(outputs):
+	"""Binary entropy (nats) of the teacher's conv_prob; highest at p = 0.5."""
+	p = np.clip(np.reshape(outputs['conv_prob'], -1), EPS, 1 - EPS)
+	return -(p * np.log(p) + (1 - p) * np.log1p(-p))
+
+
+# Writing the trace
+class RoutingTraceWriter(object):
+	"""Buffer routing records and flush them as columnar chunks."""
+
+	def __init__(self, trace_dir, top_k=DEFAULT_TOP_K, chunk_rows=DEFAULT_CHUNK_ROWS):
+		self.trace_dir = trace_dir
+		self.top_k = top_k
+		self.chunk_rows = chunk_rows
+		os.makedirs(trace_dir, exist_ok=True)
+		self.manifest = {'top_k': top_k, 'num_rows': 0, 'chunks': [], 'num_experts': None, 'layers': None}
+		self.buffer = {c: [] for c in COLUMNS}
+		self.buffered = 0
+
+	def record(self, rows, gates, outputs):
+		"""rows: (n,) example ids; gates: {layer: (n, num_experts) probs}; outputs: teacher heads."""
+		layers = list(gates)
+		if not layers:
+			raise ValueError("No gate outputs to record; set moe_sampling['gate_layers'] to the teacher's MoE gate layers")
+		if self.manifest['layers'] is None:
+			self.manifest['layers'] = layers
+			self.manifest['num_experts'] = int(max(g.shape[1] for g in gates.values()))
+		id_dtype = np.uint8 if self.manifest['num_experts'] <= 256 else np.uint16
+		experts, weights, entropy = [], [], []
+		for name in self.manifest['layers']:
+			g = np.asarray(gates[name], dtype=np.float32)
+			e, w = top_k_routing(g, self.top_k)
+			experts.append(e.astype(id_dtype))
+			weights.append(w.astype(np.float16))
+			entropy.append(gate_entropy(g).astype(np.float16))
+		self.buffer['rows'].append(np.asarray(rows, dtype=np.int64))
+		self.buffer['experts'].append(np.stack(experts, axis=1))        # (n, layers, k)
+		self.buffer['gates'].append(np.stack(weights, axis=1))          # (n, layers, k)
+		self.buffer['gate_entropy'].append(np.stack(entropy, axis=1))   # (n, layers)
+		self.buffer['uncertainty'].append(teacher_uncertainty(outputs).astype(np.float32))
+		self.buffered += len(rows)
+		if self.buffered >= self.chunk_rows:
+			self.flush()
+
+	def flush(self):
+		if not self.buffered:
+			return
+		c = len(self.manifest['chunks'])
+		chunk_dir = os.path.join(self.trace_dir, f'chunk_{c:05d}')
+		os.makedirs(chunk_dir, exist_ok=True)
+		for name, parts in self.buffer.items():
+			np.save(os.path.join(chunk_dir, f'{name}.npy'), np.concatenate(parts))
+		self.manifest['chunks'].append({'dir': os.path.basename(chunk_dir), 'rows': self.buffered})
+		self.manifest['num_rows'] += self.buffered
+		self.buffer = {k: [] for k in COLUMNS}
+		self.buffered = 0
+		_write_manifest(self.trace_dir, self.manifest)
+
+	def close(self):
+		self.flush()
+
+
+class TracingTeacher(object):
+	"""Wrap a gated teacher fn: record its routing, return only the regular outputs.
+
+	gated_fn(x) must return the teacher outputs plus one 'gate:<layer>' entry per MoE
+	layer. build_teacher_cache passes the absolute row ids of every batch (takes_rows),
+	so a resumed build records correct ids for the chunks it runs; other callers must
+	pass `rows` too.
+	"""
+
+	takes_rows = True
+
+	def __init__(self, gated_fn, writer):
+		self.gated_fn = gated_fn
+		self.writer = writer
+
+	def __call__(self, x, rows=None):
+		if rows is None:
+			raise ValueError('TracingTeacher needs the absolute row ids of the batch (rows=)')
+		out = self.gated_fn(x)
+		gates = {k[len(GATE_PREFIX):]: v for k, v in out.items() if k.startswith(GATE_PREFIX)}
+		outputs = {k: v for k, v in out.items() if not k.startswith(GATE_PREFIX)}
+		self.writer.record(rows, gates, outputs)
+		return outputs
+
+
+def keras_gated_teacher_fn(teacher_model, gate_layers, hint_layer='bottleneck'):
+	"""Like teacher_cache.keras_teacher_fn, plus the softmax output of every MoE gate layer."""
+	import tensorflow as tf
+
+	if not gate_layers:
+		raise ValueError("gate_layers is empty; set moe_sampling['gate_layers'] to the teacher's MoE gate layers")
+	outputs = {name: teacher_model.get_layer(name).output for name in TEACHER_FIELDS}
+	outputs[hint_layer] = teacher_model.get_layer(hint_layer).output
+	for name in gate_layers:
+		outputs[GATE_PREFIX + name] = teacher_model.get_layer(name).output
+	multi = tf.keras.Model(inputs=teacher_model.inputs, outputs=outputs)
+
+	def fn(x):
+		return {k: np.asarray(v) for k, v in multi(x, training=False).items()}
+	return fn
+
+
+# Reading the trace
+class RoutingTrace(object):
+	"""Read-only view over a routing trace; columns are loaded (memory-mapped) on demand."""
+
+	def __init__(self, trace_dir):
+		with open(os.path.join(trace_dir, MANIFEST)) as f:
+			self.manifest = json.load(f)
+		self.trace_dir = trace_dir
+		self.layers = self.manifest['layers']
+		self.num_experts = self.manifest['num_experts']
+		self.num_rows = self.manifest['num_rows']
+		self._columns = {}
+
+	def __len__(self):
+		return self.num_rows
+
+	def column(self, name):
+		if name not in self._columns:
+			parts = [np.load(os.path.join(self.trace_dir, c['dir'], f'{name}.npy'), mmap_mode='r')
+				 for c in self.manifest['chunks']]
+			self._columns[name] = np.concatenate(parts) if len(parts) > 1 else np.asarray(parts[0])
+		return self._columns[name]
+
+	def primary_expert(self, layer=-1):
+		"""Top-1 expert per row at a MoE layer (index or name)."""
+		if isinstance(layer, str):
+			layer = self.layers.index(layer)
+		return self.column('experts')[:, layer, 0].astype(np.int64)
+
+	def expert_load(self, layer=-1):
+		"""Fraction of rows whose top-1 expert is each expert."""
+		counts = np.bincount(self.primary_expert(layer), minlength=self.num_experts)
+		return counts / max(counts.sum(), 1)
+
+
+# Sampling
+def _normalized(weights):
+	return weights / weights.mean()
+
+
+def uncertainty_bins(uncertainty, num_bins=DEFAULT_UNCERTAINTY_BINS):
+	edges = np.quantile(uncertainty, np.linspace(0, 1, num_bins + 1)[1:-1])
+	return np.searchsorted(edges, uncertainty, side='right')
+
+
+def stratified_sample(trace, n, layer=-1, num_bins=DEFAULT_UNCERTAINTY_BINS, allocation='equal', seed=0):
+	"""Sample n rows stratified by (top-1 expert, uncertainty bin). Returns (rows, weights).
+
+	'proportional' keeps the data distribution; 'equal' gives every stratum the same
+	share (capped at its size, leftovers redistributed), so rare experts and uncertain
+	examples are over-represented and down-weighted.
+	"""
+	rng = np.random.default_rng(seed)
+	row_ids = trace.column('rows')
+	strata = trace.primary_expert(layer) * num_bins + uncertainty_bins(trace.column('uncertainty'), num_bins)
+	keys, inverse, sizes = np.unique(strata, return_inverse=True, return_counts=True)
+	n = min(n, len(strata))
+
+	if allocation == 'proportional':
+		quota = np.floor(n * sizes / sizes.sum()).astype(np.int64)
+		rest = n - quota.sum()
+		quota[np.argsort(-(n * sizes / sizes.sum() - quota))[:rest]] += 1
+	elif allocation == 'equal':
+		quota = np.zeros(len(keys), dtype=np.int64)
+		remaining, open_ = n, np.ones(len(keys), dtype=bool)
+		while remaining > 0 and open_.any():
+			share = max(remaining // int(open_.sum()), 1)
+			for s in np.flatnonzero(open_):
+				take = min(share, sizes[s] - quota[s], remaining)
+				quota[s] += take
+				remaining -= take
+				if quota[s] == sizes[s]:
+					open_[s] = False
+				if remaining == 0:
+					break
+	else:
+		raise ValueError(f'Unknown allocation: {allocation}')
+
+	order = np.argsort(inverse, kind='stable')
+	starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+	rows, weights = [], []
+	for s in range(len(keys)):
+		if quota[s] == 0:
+			continue
+		members = order[starts[s]:starts[s] + sizes[s]]
+		chosen = rng.choice(members, quota[s], replace=False)
+		rows.append(row_ids[chosen])
+		weights.append(np.full(quota[s], sizes[s] / quota[s]))   # inverse inclusion probability
+	rows, weights = np.concatenate(rows), np.concatenate(weights)
+	order = np.argsort(rows)
+	return rows[order], _normalized(weights[order])
+
+
+def inclusion_probabilities(p, n, max_iterations=100):
+	"""pi = min(1, c * p) with c chosen so that sum(pi) == n (rows capped at 1 free up budget)."""
+	pi = np.minimum(1.0, n * p)
+	for _ in range(max_iterations):
+		capped = pi >= 1.0
+		free = p[~capped].sum()
+		if free <= 0:
+			break
+		c = (n - capped.sum()) / free
+		new = np.where(capped, 1.0, np.minimum(1.0, c * p))
+		if np.allclose(new, pi):
+			break
+		pi = new
+	return pi
+
+
+def importance_sample(trace, n, layer=-1, floor=0.05, rarity_power=0.5, seed=0):
+	"""Poisson-sample about n rows with p ~ (uncertainty + floor) * rarity ** rarity_power.
+
+	Each row is kept independently with probability pi = min(1, c * p), sum(pi) = n.
+	(Drawing exactly n rows with rng.choice(replace=False, p=p) does not give inclusion
+	probabilities proportional to p, so 1 / (N * p) weights would be biased.) Returns
+	(rows, weights) with weights = 1 / pi, normalized to mean 1.
+	"""
+	rng = np.random.default_rng(seed)
+	row_ids = trace.column('rows')
+	uncertainty = np.asarray(trace.column('uncertainty'), dtype=np.float64)
+	uncertainty = uncertainty / max(uncertainty.max(), EPS)
+	load = trace.expert_load(layer)
+	rarity = 1.0 / np.maximum(load[trace.primary_expert(layer)], EPS)
+	score = (uncertainty + floor) * rarity ** rarity_power
+	p = score / score.sum()
+	pi = inclusion_probabilities(p, min(n, len(p)))
+	chosen = np.flatnonzero(rng.random(len(p)) < pi)
+	return row_ids[chosen], _normalized(1.0 / pi[chosen])
+
+
+def sample_rows(trace, config, num_rows=None):
+	"""(rows, weights) for the distillation_params['moe_sampling'] block."""
+	n = int(config.get('sample_fraction', 1.0) * (num_rows or len(trace)))
+	if config.get('strategy', 'stratified') == 'importance':
+		return importance_sample(trace, n, config.get('layer', -1), config.get('importance_floor', 0.05),
+					 config.get('rarity_power', 0.5), config.get('seed', 0))
+	return stratified_sample(trace, n, config.get('layer', -1), config.get('uncertainty_bins', DEFAULT_UNCERTAINTY_BINS),
+				 config.get('allocation', 'equal'), config.get('seed', 0))
+
+
+def iter_weighted_batches(rows, weights, batch_size, shuffle=True, seed=None):
+	"""Yield (rows, weights) batches over a sample, e.g. to index X_train / a teacher cache build."""
+	rng = np.random.default_rng(seed)
+	order = rng.permutation(len(rows)) if shuffle else np.arange(len(rows))
+	for b in range(0, len(order), batch_size):
+		idx = np.sort(order[b:b + batch_size])
+		yield rows[idx], weights[idx]
+
+
+def print_expert_summary(trace, rows=None, layer=-1):
+	"""Per-expert share of the full trace vs. a sample, with mean teacher uncertainty."""
+	experts = trace.primary_expert(layer)
+	uncertainty = trace.column('uncertainty')
+	full = np.bincount(experts, minlength=trace.num_experts)
+	sampled = np.zeros_like(full)
+	if rows is not None:
+		sampled = np.bincount(experts[np.isin(trace.column('rows'), rows)], minlength=trace.num_experts)
+	print(f"{'Expert':<7} | {'Full share':>10} | {'Sample share':>12} | {'Mean unc.':>9}")
+	print('-' * 48)
+	for e in range(trace.num_experts):
+		mean_u = float(uncertainty[experts == e].mean()) if full[e] else 0.0
+		print(f'{e:<7} | {full[e] / max(full.sum(), 1):>10.3%} | {sampled[e] / max(sampled.sum(), 1):>12.3%} | {mean_u:>9.4f}')
@@ -0,0 +1,387 @@
+"""Online knowledge distillation with an asynchronous teacher pipeline
+
+The configs in this directory describe offline KD: a frozen teacher, a fixed training
+set, a few epochs. In serving, the student then lags behind traffic until the next
+retrain (README: Future Work). Here the student is distilled continuously from a
+stream of fresh labeled events:
+
+	source -> [teacher threads] -> bounded queue -> student gradient steps
+
+	- the source is a file tail (JSON lines appended by a log writer) or an in-process
+	  queue; it is read in micro-batches of batch_size events or max_wait_ms, whichever
+	  comes first
+	- teacher inference runs on background threads (TensorFlow releases the GIL inside
+	  ops), overlapping with the student's gradient steps
+	- teacher output goes through a bounded queue. When it is full the teacher threads
+	  block ('block', no event is lost) or the oldest pending batch is dropped
+	  ('drop_oldest', the student always trains on the freshest traffic); either way the
+	  student never waits on more than one teacher batch
+	- the student is updated one micro-batch at a time, and its Poisson log loss on each
+	  batch is measured *before* the update with an inference-mode forward (prequential
+	  evaluation, no dropout), so its EWMA tracks how well the deployed student follows
+	  the current traffic
+
+Soft targets follow the README's loss diagram: the teacher's modeled conversions fill in
+for clicks without an observed conversion yet, so the conv_prob target is
+observed + (1 - observed) * teacher_prob (the "augmented soft target"). The loss itself
+is fused_loss.distillation_loss, with the augmented target passed as teacher logits and
+the hint's 'projection' block as a trainable bias-free matrix.
+
+Event format (one JSON object per line / queue item):
+	{"x": [f0, f1, ...], "conv_prob": 0 or 1, "conv_value": count}
+
+Usage:
+	source = FileTailSource('events.jsonl')
+	pipeline = TeacherPipeline(keras_teacher_fn(teacher), source, distillation_params['online'])
+	distiller = OnlineDistiller(student, distillation_params)
+	distiller.train(pipeline, max_seconds=600)
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+from knowledge_distillation.fused_loss import DEFAULT_EPS, distillation_loss
+
+
+LABEL_FIELDS = ('conv_prob', 'conv_value')
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_MAX_WAIT_MS = 200
+DEFAULT_QUEUE_SIZE = 4
+DEFAULT_TEACHER_THREADS = 1
+DEFAULT_EWMA = 0.02
+TARGET_EPS = 1e-6     # keeps the augmented target's logit finite where a conversion was observed
+BACKPRESSURE_POLICIES = ('block', 'drop_oldest')
+
+
+# Event sources
+class QueueSource(object):
+	"""In-process stand-in for a message queue: producers call put(event)."""
+
+	def __init__(self, maxsize=0):
+		self.events = queue.Queue(maxsize)
+		self.closed = threading.Event()
+
+	def put(self, event):
+		self.events.put(event)
+
+	def close(self):
+		self.closed.set()
+
+	def poll(self, timeout):
+		"""Next event, or None after `timeout` seconds without one."""
+		try:
+			return self.events.get(timeout=timeout)
+		except queue.Empty:
+			return None
+
+
+class FileTailSource(object):
+	"""Follow a JSON-lines file as it grows (like `tail -f`), starting at `offset` bytes.
+
+	Lines that are not valid JSON are skipped and counted in bad_lines.
+	"""
+
+	def __init__(self, path, offset=0, poll_interval=0.05):
+		self.path = path
+		self.offset = offset
+		self.poll_interval = poll_interval
+		self.closed = threading.Event()
+		self._file = None
+		self._partial = ''
+		self.bad_lines = 0
+
+	def close(self):
+		self.closed.set()
+
+	def poll(self, timeout):
+		deadline = time.monotonic() + timeout
+		while True:
+			if self._file is None and os.path.exists(self.path):
+				self._file = open(self.path)
+				self._file.seek(self.offset)
+			line = self._file.readline() if self._file is not None else ''
+			if line:
+				self.offset = self._file.tell()
+				# a writer may be mid-line; keep the fragment until its newline arrives
+				if not line.endswith('\n'):
+					self._partial += line
+					continue
+				line, self._partial = self._partial + line, ''
+				if line.strip():
+					try:
+						return json.loads(line)
+					except ValueError:
+						self.bad_lines += 1
+						print(f'Skipping malformed event line in {self.path} ({self.bad_lines} so far)')
+				continue
+			remaining = deadline - time.monotonic()
+			if remaining <= 0 or self.closed.is_set():
+				return None
+			time.sleep(min(self.poll_interval, remaining))
+
+
+def next_batch(source, batch_size=DEFAULT_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS):
+	"""Collect up to batch_size events, waiting at most max_wait_ms after the first one.
+
+	Returns (x, labels) or None if nothing arrived.
+	"""
+	first = source.poll(max_wait_ms / 1e3)
+	if first is None:
+		return None
+	events = [first]
+	deadline = time.monotonic() + max_wait_ms / 1e3
+	while len(events) < batch_size:
+		remaining = deadline - time.monotonic()
+		if remaining <= 0:
+			break
+		event = source.poll(remaining)
+		if event is None:
+			break
+		events.append(event)
+	x = np.asarray([e['x'] for e in events], dtype=np.float32)
+	labels = {k: np.asarray([e.get(k, 0.0) for e in events], dtype=np.float32) for k in LABEL_FIELDS}
+	return x, labels
+
+
+# Teacher pipeline
+class TeacherPipeline(object):
+	"""Background teacher inference feeding a bounded queue of (x, labels, teacher_outputs)."""
+
+	def __init__(self, teacher_fn, source, config=None):
+		config = config or {}
+		self.teacher_fn = teacher_fn
+		self.source = source
+		self.batch_size = config.get('batch_size', DEFAULT_BATCH_SIZE)
+		self.max_wait_ms = config.get('max_wait_ms', DEFAULT_MAX_WAIT_MS)
+		self.policy = config.get('backpressure', 'block')
+		if self.policy not in BACKPRESSURE_POLICIES:
+			raise ValueError(f'Unknown backpressure policy: {self.policy}')
+		self.ready = queue.Queue(config.get('queue_size', DEFAULT_QUEUE_SIZE))
+		self.num_threads = config.get('teacher_threads', DEFAULT_TEACHER_THREADS)
+		self.stop_event = threading.Event()
+		self.source_lock = threading.Lock()
+		self.threads = []
+		self.error = None
+		self.stats = {'batches': 0, 'events': 0, 'dropped_batches': 0, 'teacher_seconds': 0.0}
+		self.stats_lock = threading.Lock()
+
+	def start(self):
+		for i in range(self.num_threads):
+			t = threading.Thread(target=self._run, name=f'teacher-{i}', daemon=True)
+			t.start()
+			self.threads.append(t)
+		return self
+
+	def stop(self):
+		self.stop_event.set()
+		for t in self.threads:
+			t.join()
+		self.threads = []
+
+	def _put(self, item):
+		while not self.stop_event.is_set():
+			try:
+				self.ready.put(item, timeout=0.1)
+				return
+			except queue.Full:
+				if self.policy == 'drop_oldest':
+					try:
+						self.ready.get_nowait()
+						with self.stats_lock:
+							self.stats['dropped_batches'] += 1
+					except queue.Empty:
+						pass
+
+	def _run(self):
+		try:
+			while not self.stop_event.is_set():
+				# one reader at a time keeps micro-batches contiguous in the stream
+				with self.source_lock:
+					batch = next_batch(self.source, self.batch_size, self.max_wait_ms)
+				if batch is None:
+					if self.source.closed.is_set():
+						return
+					continue
+				x, labels = batch
+				start = time.perf_counter()
+				outputs = self.teacher_fn(x)
+				elapsed = time.perf_counter() - start
+				with self.stats_lock:
+					self.stats['batches'] += 1
+					self.stats['events'] += len(x)
+					self.stats['teacher_seconds'] += elapsed
+				self._put((x, labels, outputs))
+		except BaseException as e:   # surfaced to the trainer by get()
+			self.error = e
+			self.stop_event.set()
+
+	def get(self, timeout):
+		"""Next teacher-labeled batch, or None if none is ready within timeout."""
+		if self.error is not None:
+			raise self.error
+		try:
+			return self.ready.get(timeout=timeout)
+		except queue.Empty:
+			return None
+
+	def finished(self):
+		return not any(t.is_alive() for t in self.threads) and self.ready.empty()
+
+
+# Student updates
+def augmented_soft_target(observed, teacher_prob):
+	"""Observed conversions plus the teacher's modeled conversions for the rest."""
+	return observed + (1.0 - observed) * teacher_prob
+
+
+def _scalar(value):
+	# sweep configs hold lists; an online run uses a single setting
+	return value[0] if isinstance(value, (list, tuple)) else value
+
+
+class OnlineDistiller(object):
+	"""Incremental student updates on teacher-labeled micro-batches.
+
+	Uses 'temperature', 'alpha' and the first 'intermediate_losses' hint (weight,
+	projection, and 'online'.hint_layer) from distillation_params. List-valued (sweep) entries use their
+	first value.
+	"""
+
+	def __init__(self, student_model, distillation_params, learning_rate=1e-3, optimizer=None):
+		import tensorflow as tf
+
+		online = distillation_params.get('online', {})
+		self.temperature = float(_scalar(distillation_params.get('temperature', 1.0)))
+		self.alpha = float(_scalar(distillation_params.get('alpha', 0.5)))
+		hints = distillation_params.get('intermediate_losses') or []
+		self.hint_weight = float(_scalar(hints[0].get('weight', 0.0))) if hints else 0.0
+		projection = (hints[0].get('projection') if hints else None) or {}
+		self.hint_layer = online.get('hint_layer', 'bottleneck')
+		self.ewma_decay = online.get('ewma', DEFAULT_EWMA)
+		self.checkpoint_path = online.get('checkpoint_path')
+		self.checkpoint_every_s = online.get('checkpoint_every_s', 60)
+
+		self.student = student_model
+		self.optimizer = optimizer or tf.keras.optimizers.Adam(learning_rate)
+		outputs = {name: student_model.get_layer(name).output for name in ('conv_value', 'prob_logits')}
+		if self.hint_weight > 0:
+			outputs[self.hint_layer] = student_model.get_layer(self.hint_layer).output
+		# one forward pass returns the heads and the hint features
+		self.probe = tf.keras.Model(inputs=student_model.inputs, outputs=outputs)
+		self.projection = None
+		if self.hint_weight > 0 and projection.get('type', 'linear') == 'linear' and 'out_dim' in projection:
+			s_dim = int(outputs[self.hint_layer].shape[-1])
+			init = tf.keras.initializers.GlorotUniform()
+			self.projection = tf.Variable(init((s_dim, int(projection['out_dim']))), name='hint_projection')
+		self.trainable = list(student_model.trainable_weights) + \
+			([self.projection] if self.projection is not None else [])
+		# micro-batches are ragged (max_wait_ms cuts them short); don't retrace per size
+		self.train_step = tf.function(self._train_step, reduce_retracing=True)
+
+		self.steps = 0
+		self.events = 0
+		self.ewma_pll = None
+		self.history = []
+		self._last_checkpoint = time.monotonic()
+
+	def _train_step(self, x, conv_prob, conv_value, t_value, t_logits, t_hint, hint_scale):
+		import tensorflow as tf
+
+		temp = self.temperature
+		# the KL term sees the augmented target as the teacher: sigmoid(t_aug / T) == target
+		target = augmented_soft_target(conv_prob, tf.nn.sigmoid(t_logits / temp))
+		target = tf.clip_by_value(target, TARGET_EPS, 1.0 - TARGET_EPS)
+		t_aug = temp * (tf.math.log(target) - tf.math.log1p(-target))
+		# monitoring PLL of the model as served (training=False: no dropout), before the update
+		value = tf.reshape(self.probe(x, training=False)['conv_value'], [-1])
+		y_value = tf.cast(tf.reshape(conv_value, [-1]), value.dtype)
+		pll = tf.reduce_mean(value - y_value * tf.math.log(value + DEFAULT_EPS))
+		with tf.GradientTape() as tape:
+			s = self.probe(x, training=True)
+			hinted = self.hint_weight > 0
+			# hint_scale is 0 for batches whose teacher outputs carry no hint features
+			total, _ = distillation_loss(s, {'prob_logits': t_aug, 'conv_value': t_value},
+							 {'conv_prob': conv_prob, 'conv_value': conv_value},
+							 temperatures=temp, alphas=self.alpha,
+							 hint_weights=hint_scale * self.hint_weight,
+							 s_hint=s[self.hint_layer] if hinted else None,
+							 t_hint=t_hint if hinted else None,
+							 projection=self.projection, schedule=None)
+			loss = total[0]
+		grads = tape.gradient(loss, self.trainable)
+		self.optimizer.apply_gradients(zip(grads, self.trainable))
+		return loss, pll
+
+	def step(self, x, labels, teacher_outputs):
+		"""One incremental update. Returns (loss, pll) before the update: the training-mode loss and the inference-mode PLL."""
+		# without teacher hint features the hint term is switched off, not trained toward 0
+		has_hint = self.hint_layer in teacher_outputs
+		t_hint = teacher_outputs[self.hint_layer] if has_hint else np.zeros((len(x), 1), np.float32)
+		loss, pll = self.train_step(x, labels['conv_prob'], labels['conv_value'],
+					    np.reshape(teacher_outputs['conv_value'], -1).astype(np.float32),
+					    np.reshape(teacher_outputs['prob_logits'], -1).astype(np.float32),
+					    np.asarray(t_hint, np.float32), np.float32(1.0 if has_hint else 0.0))
+		pll = float(pll)
+		self.ewma_pll = pll if self.ewma_pll is None else \
+			(1 - self.ewma_decay) * self.ewma_pll + self.ewma_decay * pll
+		self.steps += 1
+		self.events += len(x)
+		return float(loss), pll
+
+	def _maybe_checkpoint(self, force=False):
+		if not self.checkpoint_path:
+			return
+		if force or time.monotonic() - self._last_checkpoint >= self.checkpoint_every_s:
+			self.student.save_weights(self.checkpoint_path)
+			self._last_checkpoint = time.monotonic()
+
+	def train(self, pipeline, max_steps=None, max_seconds=None, log_every=100, on_step=None):
+		"""Train until max_steps / max_seconds or until the source is closed and drained."""
+		if not pipeline.threads:
+			pipeline.start()
+		start = time.monotonic()
+		wait = 0.0
+		try:
+			while max_steps is None or self.steps < max_steps:
+				if max_seconds is not None and time.monotonic() - start >= max_seconds:
+					break
+				t0 = time.perf_counter()
+				item = pipeline.get(timeout=0.5)
+				wait += time.perf_counter() - t0
+				if item is None:
+					if pipeline.finished():
+						break
+					continue
+				loss, pll = self.step(*item)
+				if on_step is not None:
+					on_step(self, loss, pll)
+				if self.steps % log_every == 0:
+					self.log(pipeline, time.monotonic() - start, wait)
+				self._maybe_checkpoint()
+		finally:
+			pipeline.stop()
+			self._maybe_checkpoint(force=True)
+		self.log(pipeline, time.monotonic() - start, wait)
+		return self.history
+
+	def log(self, pipeline, elapsed, wait):
+		stats = dict(pipeline.stats)
+		record = {
+			'steps': self.steps, 'events': self.events, 'seconds': elapsed,
+			'events_per_s': self.events / elapsed if elapsed else 0.0,
+			'ewma_pll': self.ewma_pll, 'queue_depth': pipeline.ready.qsize(),
+			'student_wait_frac': wait / elapsed if elapsed else 0.0,
+			'dropped_batches': stats['dropped_batches'],
+			'bad_lines': getattr(pipeline.source, 'bad_lines', 0),
+			'teacher_ms_per_batch': 1e3 * stats['teacher_seconds'] / max(stats['batches'], 1),
+		}
+		self.history.append(record)
+		print(f"step {record['steps']:>7} | {record['events_per_s']:>8.0f} ev/s | "
+		      f"EWMA PLL {record['ewma_pll'] if record['ewma_pll'] is not None else float('nan'):.4f} | "
+		      f"queue {record['queue_depth']} | waiting {record['student_wait_frac']:.0%} | "
+		      f"teacher {record['teacher_ms_per_batch']:.1f} ms/batch | dropped {record['dropped_batches']}")
+		return record
@@ -0,0 +1,342 @@
+"""Parallel hyperparameter sweep executor for the distillation configs
+
+The configs in this directory describe sweeps as list-valued properties
+('temperature': [1.5, 2, 3, 4, 6], 'alpha': [.3, .5, .7, .9], the hint 'weight':
+[0.05, 0.1, 0.2], ...). The notebook expands them with a serial itertools.product
+loop, so the 60-trial v2 grid costs 60x the wall-clock time of one trial.
+
+This module:
+	- expands a config dict into concrete trials (expand_grid)
+	- runs them on a process pool, one CPU group pinned per worker, with the training
+	  data saved once as .npy and memory-mapped read-only by every worker
+	- stops losing trials early with ASHA (asynchronous successive halving) on the
+	  Poisson log loss each trial reports
+	- journals every finished (trial, rung) to disk, so rerunning after a crash only
+	  redoes the work that was in flight
+
+A trial function has the signature
+
+	trial_fn(config, budget, trial_dir, shared) -> poisson_log_loss
+
+where `budget` is the number of epochs to train up to, `trial_dir` is a private
+directory the trial can checkpoint into (so a promoted trial can continue from its
+previous rung instead of starting over), and `shared` maps names to the read-only
+arrays passed to run_sweep. trial_fn must be importable from a module (not defined
+in a notebook), since workers are started with 'spawn' to keep TensorFlow's thread
+pools out of the parent process.
+
+Example:
+	trials = expand_grid(distillation_params)
+	run_sweep(my_trials.train_student, trials, 'sweeps/kd_v2', max_budget=9,
+		  shared_arrays={'x': X_train, 'conv_prob': y_conv, 'conv_value': y_count})
+"""
+
+import copy
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing as mp
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
+
+
+# list-valued properties that describe structure, not a sweep, and runtime blocks
+# (caching, online / data-parallel training, MoE sampling) whose lists are never swept,
+# e.g. data_parallel.hosts or moe_sampling.gate_layers; skipped keys are not walked into
+NON_SWEEP_KEYS = ('hidden_layers', 'hosts', 'gate_layers',
+		  'teacher_cache', 'online', 'moe_sampling', 'data_parallel')
+JOURNAL = 'sweep_journal.jsonl'
+RESULTS = 'sweep_results.json'
+DEFAULT_ETA = 3
+
+
+# Grid expansion
+def _path_name(path):
+	return '.'.join(str(p) for p in path)
+
+
+def _set_path(config, path, value):
+	node = config
+	for p in path[:-1]:
+		node = node[p]
+	node[path[-1]] = value
+
+
+def trial_id(params):
+	return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+def sweep_axes(config, skip_keys=NON_SWEEP_KEYS):
+	"""Find (path, values) for every list-of-scalars property in a nested config.
+
+	Lists of dicts (e.g. 'intermediate_losses') are walked element by element.
+	"""
+	axes = []
+
+	def walk(node, path):
+		if isinstance(node, dict):
+			for k, v in node.items():
+				if k not in skip_keys:
+					walk(v, path + (k,))
+		elif isinstance(node, list) and node:
+			if all(isinstance(v, dict) for v in node):
+				for i, v in enumerate(node):
+					walk(v, path + (i,))
+			elif not any(isinstance(v, (dict, list)) for v in node):
+				axes.append((path, list(node)))
+
+	walk(config, ())
+	return axes
+
+
+def expand_grid(config, skip_keys=NON_SWEEP_KEYS):
+	"""Expand a config with list-valued sweep properties into a list of trials.
+
+	Each trial is {'trial_id', 'params', 'config'}: `params` holds only the swept values
+	(keyed by dotted path, e.g. 'intermediate_losses.0.weight'), `config` is a full copy
+	of the config with every sweep list replaced by its chosen value.
+	"""
+	axes = sweep_axes(config, skip_keys)
+	trials = []
+	for combo in itertools.product(*[values for _, values in axes]):
+		cfg = copy.deepcopy(config)
+		params = {}
+		for (path, _), value in zip(axes, combo):
+			_set_path(cfg, path, value)
+			params[_path_name(path)] = value
+		trials.append({'trial_id': trial_id(params), 'params': params, 'config': cfg})
+	return trials
+
+
+# ASHA scheduling
+def rung_budgets(min_budget, max_budget, eta=DEFAULT_ETA):
+	"""Budgets min_budget * eta^k, capped at (and always ending with) max_budget."""
+	budgets = []
+	b = min_budget
+	while b < max_budget:
+		budgets.append(b)
+		b *= eta
+	budgets.append(max_budget)
+	return budgets
+
+
+class ASHA(object):
+	"""Asynchronous successive halving over a fixed set of trials.
+
+	Whenever a worker frees up, the highest rung with a promotable trial (in the top
+	1/eta of that rung's finished results) gets promoted; otherwise a new trial starts
+	at rung 0. With min_budget == max_budget this degenerates to a plain grid.
+	"""
+
+	def __init__(self, trial_ids, budgets, eta=DEFAULT_ETA):
+		self.budgets = list(budgets)
+		self.eta = eta
+		self.results = [dict() for _ in self.budgets]      # rung -> {trial_id: loss}
+		self.promoted = [set() for _ in self.budgets]
+		self.running = set()
+		self.pending = deque(trial_ids)
+
+	def restore(self, records):
+		"""Replay journal records from a previous run."""
+		for r in records:
+			self.record(r['trial_id'], r['rung'], r['loss'])
+		started = set(self.results[0])
+		self.pending = deque(t for t in self.pending if t not in started)
+		for k in range(len(self.budgets) - 1):
+			self.promoted[k].update(self.results[k + 1])
+
+	def record(self, tid, rung, loss):
+		self.results[rung][tid] = loss
+		self.running.discard((tid, rung))
+
+	def next_job(self):
+		for k in reversed(range(len(self.budgets) - 1)):
+			finished = self.results[k]
+			n_top = len(finished) // self.eta
+			if n_top == 0:
+				continue
+			for tid in sorted(finished, key=finished.get)[:n_top]:
+				if not math.isfinite(finished[tid]):
+					break
+				if tid not in self.promoted[k]:
+					self.promoted[k].add(tid)
+					return tid, k + 1
+		if self.pending:
+			return self.pending.popleft(), 0
+		return None
+
+	def best(self):
+		"""Best (trial_id, rung, loss), preferring results at the highest rung reached."""
+		for k in reversed(range(len(self.budgets))):
+			finished = {t: l for t, l in self.results[k].items() if math.isfinite(l)}
+			if finished:
+				tid = min(finished, key=finished.get)
+				return tid, k, finished[tid]
+		return None
+
+
+# Worker processes
+_SHARED = {}
+
+
+def split_cpus(num_workers):
+	"""Partition the CPUs this process may run on into num_workers contiguous groups."""
+	if hasattr(os, 'sched_getaffinity'):
+		cpus = sorted(os.sched_getaffinity(0))
+	else:
+		cpus = list(range(os.cpu_count() or 1))
+	if num_workers >= len(cpus):
+		return [[cpus[i % len(cpus)]] for i in range(num_workers)]
+	return [list(g) for g in np.array_split(cpus, num_workers)]
+
+
+def share_arrays(arrays, out_dir):
+	"""Save arrays once as .npy so workers can memory-map them read-only. Returns {name: path}."""
+	shared_dir = os.path.join(out_dir, 'shared')
+	os.makedirs(shared_dir, exist_ok=True)
+	paths = {}
+	for name, array in arrays.items():
+		paths[name] = os.path.join(shared_dir, f'{name}.npy')
+		np.save(paths[name], np.ascontiguousarray(array))
+	return paths
+
+
+def _init_worker(counter, cpu_groups, shared_paths, threads_per_worker):
+	with counter.get_lock():
+		worker_id = counter.value
+		counter.value += 1
+	cpus = cpu_groups[worker_id % len(cpu_groups)]
+	if hasattr(os, 'sched_setaffinity'):
+		os.sched_setaffinity(0, cpus)
+
+	# size framework thread pools to the pinned CPUs (must happen before TF is imported)
+	threads = str(threads_per_worker or len(cpus))
+	for var in ('OMP_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS'):
+		os.environ[var] = threads if var != 'TF_NUM_INTEROP_THREADS' else '1'
+
+	for name, path in shared_paths.items():
+		_SHARED[name] = np.load(path, mmap_mode='r')
+
+
+def _run_trial(trial_fn, config, budget, trial_dir):
+	os.makedirs(trial_dir, exist_ok=True)
+	start = time.time()
+	try:
+		loss = float(trial_fn(config, budget, trial_dir, _SHARED))
+		error = None
+	except Exception as e:  # a crashing trial should not take the sweep down with it
+		loss = float('inf')
+		error = repr(e)
+	return {'loss': loss, 'error': error, 'seconds': time.time() - start}
+
+
+# Journal
+def load_journal(out_dir):
+	"""Successful (trial, rung) records from a previous run; failed trials are retried."""
+	path = os.path.join(out_dir, JOURNAL)
+	if not os.path.exists(path):
+		return []
+	records = []
+	with open(path) as f:
+		for line in f:
+			line = line.strip()
+			if not line:
+				continue
+			try:
+				r = json.loads(line)
+			except ValueError:  # torn last line from a crash
+				continue
+			if r.get('error') is None:
+				records.append(r)
+	return records
+
+
+def _append_journal(out_dir, record):
+	with open(os.path.join(out_dir, JOURNAL), 'a') as f:
+		f.write(json.dumps(record, sort_keys=True, default=str) + '\n')
+		f.flush()
+		os.fsync(f.fileno())
+
+
+# Sweep
+def run_sweep(trial_fn, trials, out_dir, num_workers=None, max_budget=1, min_budget=1, eta=DEFAULT_ETA,
+	      early_stopping=True, shared_arrays=None, threads_per_worker=None, start_method='spawn'):
+	"""Run every trial on a pinned process pool with ASHA early stopping. Returns a summary dict.
+
+	Rerunning with the same out_dir resumes from the journal.
+	"""
+	os.makedirs(out_dir, exist_ok=True)
+	num_workers = num_workers or len(split_cpus(1)[0])
+	by_id = {t['trial_id']: t for t in trials}
+	budgets = rung_budgets(min_budget if early_stopping else max_budget, max_budget, eta)
+
+	sched = ASHA(list(by_id), budgets, eta)
+	previous = [r for r in load_journal(out_dir) if r['trial_id'] in by_id and r['rung'] < len(budgets)]
+	sched.restore(previous)
+	if previous:
+		print(f'Resuming sweep: {len(previous)} finished (trial, rung) results found in {out_dir}')
+
+	shared_paths = share_arrays(shared_arrays, out_dir) if shared_arrays else {}
+	ctx = mp.get_context(start_method)
+	counter = ctx.Value('i', 0)
+	initargs = (counter, split_cpus(num_workers), shared_paths, threads_per_worker)
+
+	print(f"{'TRIAL':<14} | {'RUNG':<4} | {'BUDGET':<6} | {'LOSS':<10} | PARAMS")
+	print('-' * 90)
+	with ProcessPoolExecutor(num_workers, mp_context=ctx, initializer=_init_worker, initargs=initargs) as pool:
+		futures = {}
+
+		def fill():
+			while len(futures) < num_workers:
+				job = sched.next_job()
+				if job is None:
+					return
+				tid, rung = job
+				sched.running.add(job)
+				f = pool.submit(_run_trial, trial_fn, by_id[tid]['config'], budgets[rung],
+						os.path.join(out_dir, 'trials', tid))
+				futures[f] = job
+
+		fill()
+		while futures:
+			finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+			for f in finished:
+				tid, rung = futures.pop(f)
+				result = f.result()
+				sched.record(tid, rung, result['loss'])
+				record = dict(result, trial_id=tid, rung=rung, budget=budgets[rung], params=by_id[tid]['params'])
+				_append_journal(out_dir, record)
+				status = f"{result['loss']:<10.4f}" if result['error'] is None else f"ERROR {result['error']}"
+				print(f"{tid:<14} | {rung:<4} | {budgets[rung]:<6} | {status} | {by_id[tid]['params']}")
+			fill()
+
+	summary = summarize(sched, by_id)
+	with open(os.path.join(out_dir, RESULTS), 'w') as f:
+		json.dump(summary, f, indent=2, sort_keys=True, default=str)
+	print('-' * 90)
+	if summary['best'] is not None:
+		print(f"Best trial: {summary['best']['trial_id']} {summary['best']['params']} "
+		      f"(loss {summary['best']['loss']:.4f} at budget {summary['best']['budget']})")
+	return summary
+
+
+def summarize(sched, by_id):
+	trials = []
+	for tid, trial in by_id.items():
+		reached = [(k, sched.results[k][tid]) for k in range(len(sched.budgets)) if tid in sched.results[k]]
+		if not reached:
+			continue
+		rung, loss = reached[-1]
+		trials.append({'trial_id': tid, 'params': trial['params'], 'rung': rung,
+			       'budget': sched.budgets[rung], 'loss': loss})
+	best = sched.best()
+	best_row = None
+	if best is not None:
+		tid, rung, loss = best
+		best_row = {'trial_id': tid, 'params': by_id[tid]['params'], 'rung': rung,
+			    'budget': sched.budgets[rung], 'loss': loss}
+	return {'budgets': sched.budgets, 'eta': sched.eta, 'trials': trials, 'best': best_row}
@@ -0,0 +1,236 @@
+"""Cached teacher outputs for distillation with a frozen teacher
+
+With 'freeze_teacher': True (distillation_v1.py / distillation_v2.py) the teacher's
+outputs for a given example never change, but the notebook's run_experiment still runs
+a full teacher forward pass (plus a second pass through the bottleneck feature
+extractor) on every batch of every epoch of every sweep trial.
+
+Here we run the teacher once per (teacher checkpoint, dataset shard) and persist
+conv_prob / conv_value / prob_logits and the 'bottleneck' hint features to disk as
+chunked .npy files. The student loop then streams batches from memory-mapped chunks,
+so the store can be larger than RAM and is shared by every trial in the sweep.
+
+Layout:
+	<cache_dir>/<teacher_hash>/<shard_id>/manifest.json
+	<cache_dir>/<teacher_hash>/<shard_id>/chunk_00000/conv_prob.npy
+	...
+
+The manifest is rewritten after every finished chunk, so an interrupted build picks up
+where it stopped instead of starting over.
+"""
+
+import hashlib
+import json
+import os
+import numpy as np
+
+
+TEACHER_FIELDS = ('conv_prob', 'conv_value', 'prob_logits')
+HINT_FIELD = 'bottleneck'
+MANIFEST = 'manifest.json'
+DEFAULT_CHUNK_ROWS = 65536
+DEFAULT_TEACHER_BATCH = 4096
+
+
+# Keys
+def hash_arrays(arrays):
+	"""Content hash of a list of arrays (dtype, shape and bytes)."""
+	h = hashlib.sha256()
+	for a in arrays:
+		a = np.ascontiguousarray(a)
+		h.update(str(a.dtype).encode())
+		h.update(str(a.shape).encode())
+		h.update(a.tobytes())
+	return h.hexdigest()[:16]
+
+
+def teacher_checkpoint_hash(teacher):
+	"""Hash identifying a teacher checkpoint.
+
+	Accepts a checkpoint path (file or directory), a Keras model, or the list
+	returned by model.get_weights().
+	"""
+	if isinstance(teacher, (str, os.PathLike)):
+		h = hashlib.sha256()
+		paths = [teacher]
+		if os.path.isdir(teacher):
+			paths = sorted(os.path.join(root, f) for root, _, files in os.walk(teacher) for f in files)
+		for p in paths:
+			h.update(os.path.relpath(p, teacher).encode() if p != teacher else b'')
+			with open(p, 'rb') as f:
+				for block in iter(lambda: f.read(1 << 20), b''):
+					h.update(block)
+		return h.hexdigest()[:16]
+	if hasattr(teacher, 'get_weights'):
+		teacher = teacher.get_weights()
+	return hash_arrays(teacher)
+
+
+def shard_id_for(x):
+	"""Default shard id: content hash of the shard's feature matrix."""
+	return 'shard_' + hash_arrays([x])
+
+
+def cache_path(cache_dir, teacher_hash, shard_id):
+	return os.path.join(cache_dir, teacher_hash, str(shard_id))
+
+
+# Teacher wrapper
+def keras_teacher_fn(teacher_model, hint_layer=HINT_FIELD):
+	"""Wrap a Keras teacher so one forward pass returns every cached field.
+
+	The notebook runs the teacher and a separate bottleneck feature extractor; this
+	builds a single multi-output model instead and returns NumPy arrays keyed by
+	TEACHER_FIELDS + HINT_FIELD.
+	"""
+	import tensorflow as tf
+
+	outputs = {name: teacher_model.get_layer(name).output for name in TEACHER_FIELDS}
+	outputs[HINT_FIELD] = teacher_model.get_layer(hint_layer).output
+	multi = tf.keras.Model(inputs=teacher_model.inputs, outputs=outputs)
+
+	def fn(x):
+		return {k: np.asarray(v) for k, v in multi(x, training=False).items()}
+	return fn
+
+
+# Building the cache
+def _read_manifest(path):
+	manifest_file = os.path.join(path, MANIFEST)
+	if not os.path.exists(manifest_file):
+		return None
+	with open(manifest_file) as f:
+		return json.load(f)
+
+
+def _write_manifest(path, manifest):
+	# write-then-rename so a crash never leaves a truncated manifest behind
+	tmp = os.path.join(path, MANIFEST + '.tmp')
+	with open(tmp, 'w') as f:
+		json.dump(manifest, f, indent=2, sort_keys=True)
+	os.replace(tmp, os.path.join(path, MANIFEST))
+
+
+def build_teacher_cache(teacher_fn, x, cache_dir, teacher_hash, shard_id=None,
+			chunk_rows=DEFAULT_CHUNK_ROWS, batch_size=DEFAULT_TEACHER_BATCH, dtype=np.float32):
+	"""Run the teacher once over `x` and persist its outputs. Returns the cache path.
+
+	teacher_fn maps a batch of features to a dict of arrays (see keras_teacher_fn).
+	If it sets `takes_rows` (e.g. moe_trace.TracingTeacher), it is also passed the
+	batch's absolute row ids as rows=. Chunks already recorded in an existing manifest
+	are skipped. The manifest records a
+	content hash of `x`, so an explicit shard_id cannot silently reuse outputs computed
+	for different features of the same shape.
+	"""
+	data_hash = hash_arrays([x])
+	shard_id = shard_id if shard_id is not None else 'shard_' + data_hash
+	path = cache_path(cache_dir, teacher_hash, shard_id)
+	os.makedirs(path, exist_ok=True)
+
+	num_rows = len(x)
+	num_chunks = (num_rows + chunk_rows - 1) // chunk_rows
+	manifest = _read_manifest(path)
+	if manifest is not None and (manifest['num_rows'] != num_rows or manifest['chunk_rows'] != chunk_rows):
+		raise ValueError(f'Cache at {path} was built for a different shard layout; remove it or use a new shard_id')
+	if manifest is not None and manifest.get('data_hash', data_hash) != data_hash:
+		raise ValueError(f'Cache at {path} was built from different features; remove it or use a new shard_id')
+	if manifest is None:
+		manifest = {
+			'teacher_hash': teacher_hash,
+			'shard_id': str(shard_id),
+			'data_hash': data_hash,
+			'num_rows': num_rows,
+			'chunk_rows': chunk_rows,
+			'num_chunks': num_chunks,
+			'fields': {},
+			'chunks_done': [],
+			'complete': False,
+		}
+	if manifest['complete']:
+		return path
+
+	done = set(manifest['chunks_done'])
+	for c in range(num_chunks):
+		if c in done:
+			continue
+		start, stop = c * chunk_rows, min((c + 1) * chunk_rows, num_rows)
+		chunk_dir = os.path.join(path, f'chunk_{c:05d}')
+		os.makedirs(chunk_dir, exist_ok=True)
+
+		memmaps = None
+		for b in range(start, stop, batch_size):
+			end = min(b + batch_size, stop)
+			if getattr(teacher_fn, 'takes_rows', False):
+				out = teacher_fn(x[b:end], rows=np.arange(b, end))
+			else:
+				out = teacher_fn(x[b:end])
+			if memmaps is None:
+				memmaps = {
+					k: np.lib.format.open_memmap(os.path.join(chunk_dir, f'{k}.npy'), mode='w+',
+								     dtype=dtype, shape=(stop - start,) + np.shape(v)[1:])
+					for k, v in out.items()
+				}
+				manifest['fields'] = {k: list(np.shape(v)[1:]) for k, v in out.items()}
+			for k, v in out.items():
+				memmaps[k][b - start:b - start + len(v)] = v
+		for m in memmaps.values():
+			m.flush()
+		del memmaps
+
+		manifest['chunks_done'].append(c)
+		_write_manifest(path, manifest)
+
+	manifest['complete'] = True
+	_write_manifest(path, manifest)
+	return path
+
+
+# Reading the cache
+class TeacherCache(object):
+	"""Read-only view over a built teacher cache. Chunks are opened with mmap_mode='r'."""
+
+	def __init__(self, path):
+		manifest = _read_manifest(path)
+		if manifest is None or not manifest['complete']:
+			raise FileNotFoundError(f'No complete teacher cache at {path}')
+		self.path = path
+		self.manifest = manifest
+		self.num_rows = manifest['num_rows']
+		self.chunk_rows = manifest['chunk_rows']
+		self.num_chunks = manifest['num_chunks']
+		self.fields = tuple(manifest['fields'])
+
+	def __len__(self):
+		return self.num_rows
+
+	def chunk(self, c):
+		"""Dict of memory-mapped arrays for chunk c."""
+		chunk_dir = os.path.join(self.path, f'chunk_{c:05d}')
+		return {k: np.load(os.path.join(chunk_dir, f'{k}.npy'), mmap_mode='r') for k in self.fields}
+
+	def iter_batches(self, batch_size, shuffle=False, seed=None):
+		"""Yield (rows, teacher_outputs) for each batch.
+
+		`rows` indexes the shard's x / y arrays (a slice when not shuffled, an index
+		array otherwise). Shuffling permutes chunk order and rows within a chunk, so
+		reads stay chunk-local.
+		"""
+		rng = np.random.default_rng(seed)
+		order = rng.permutation(self.num_chunks) if shuffle else range(self.num_chunks)
+		for c in order:
+			arrays = self.chunk(c)
+			base = c * self.chunk_rows
+			n = len(arrays[self.fields[0]])
+			if shuffle:
+				perm = rng.permutation(n)
+				for b in range(0, n, batch_size):
+					local = np.sort(perm[b:b + batch_size])
+					yield base + local, {k: np.asarray(a[local]) for k, a in arrays.items()}
+			else:
+				for b in range(0, n, batch_size):
+					stop = min(b + batch_size, n)
+					yield slice(base + b, base + stop), {k: np.asarray(a[b:stop]) for k, a in arrays.items()}
+
+
+def open_teacher_cache(cache_dir, teacher_hash, shard_id):
+	return TeacherCache(cache_path(cache_dir, teacher_hash, shard_id))
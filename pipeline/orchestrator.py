@@ -0,0 +1,427 @@
+"""
+orchestrator.py
+---------------
+DAG runner for the compression pipeline: KD (distillation_v2.py) -> pruning
+(pruning_v1.py / pruning_v2.py) -> PTQ or QAT (quantization_v1.py) -> eval
+(quantization_eval.py).
+
+The stages are currently chained by hand through hardcoded paths (FP32_PATH =
+"models/fp32_student/", ...), so a change anywhere means guessing which stages to rerun,
+and rerunning KD "to be safe" is the expensive default. Here every stage gets a key
+
+    sha256(stage kind + version, its config subtree, its upstream stages' keys,
+           hashes of the data shards it reads)
+
+and writes its output into a content-addressed artifact cache under that key. A stage
+whose key is already in the cache is skipped, so changing one quantization knob only
+changes the keys of the PTQ / QAT stages that read it (and their evals) and never
+retrains the student. Stages whose inputs are ready run in parallel (PTQ and QAT of the
+same student, one pruning stage per sparsity level).
+
+A stage function has the signature
+
+    fn(inputs, config, out_dir, data) -> metrics dict or None
+
+where `inputs` maps each upstream stage name to its artifact directory, `config` is the
+stage's config subtree, `out_dir` is an empty directory to write the artifact into and
+`data` maps names to the stage's data paths. The artifact is only published into the
+cache (atomic rename) if fn returns normally.
+
+Cache layout:
+    <cache_dir>/objects/<key[:2]>/<key>/artifact/...
+    <cache_dir>/objects/<key[:2]>/<key>/meta.json
+    <cache_dir>/runs/<timestamp>.json                  per-run report
+
+Usage (from the repo root):
+    pipe = compression_pipeline(cfg, fns, data={"train": "data/train", "calib": CALIB_DATA_PATH,
+                                                "eval": EVAL_X_PATH})
+    pipe.print_plan("artifacts")
+    results = pipe.run("artifacts", max_workers=4)
+    results["ptq@prune@0.3"].path            # artifact directory of that stage
+"""
+
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import numpy as np
+
+
+OBJECTS = "objects"
+RUNS = "runs"
+TMP = "tmp"
+META = "meta.json"
+FILE_HASHES = "file_hashes.json"
+HASH_BLOCK = 1 << 20
+EXECUTORS = ("thread", "process")
+
+
+
+# Hashing
+def hash_config(config):
+    """Stable hash of a JSON-like config subtree (key order does not matter)."""
+    blob = json.dumps(config, sort_keys=True, default=repr, separators=(",", ":"))
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def _hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class DataHasher(object):
+    """Content hashes of data files / shard directories, memoized on (size, mtime) across runs."""
+
+    def __init__(self, memo_path=None):
+        self.memo_path = memo_path
+        self.memo = {}
+        self.lock = threading.Lock()
+        if memo_path and os.path.exists(memo_path):
+            with open(memo_path) as f:
+                self.memo = json.load(f)
+
+    def _file(self, path):
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        entry = self.memo.get(os.path.abspath(path))
+        if entry and entry[0] == stamp:
+            return entry[1]
+        digest = _hash_file(path)
+        with self.lock:
+            self.memo[os.path.abspath(path)] = [stamp, digest]
+        return digest
+
+    def hash(self, source):
+        """Hash of a path (file or directory of shards) or an in-memory array."""
+        if isinstance(source, np.ndarray):
+            a = np.ascontiguousarray(source)
+            h = hashlib.sha256(f"{a.dtype}{a.shape}".encode())
+            h.update(memoryview(a).cast("B"))
+            return h.hexdigest()
+        if os.path.isdir(source):
+            h = hashlib.sha256()
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    h.update(os.path.relpath(path, source).encode())
+                    h.update(self._file(path).encode())
+            return h.hexdigest()
+        return self._file(source)
+
+    def save(self):
+        if not self.memo_path:
+            return
+        with self.lock:
+            tmp = self.memo_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.memo, f)
+            os.replace(tmp, self.memo_path)
+
+
+
+# Artifact cache
+class ArtifactCache(object):
+    """Content-addressed store of stage outputs, one directory per stage key."""
+
+    def __init__(self, root):
+        self.root = root
+        for d in (OBJECTS, RUNS, TMP):
+            os.makedirs(os.path.join(root, d), exist_ok=True)
+
+    def _dir(self, key):
+        return os.path.join(self.root, OBJECTS, key[:2], key)
+
+    def path(self, key):
+        return os.path.join(self._dir(key), "artifact")
+
+    def has(self, key):
+        return os.path.exists(os.path.join(self._dir(key), META))
+
+    def meta(self, key):
+        with open(os.path.join(self._dir(key), META)) as f:
+            return json.load(f)
+
+    def staging(self):
+        """Fresh private directory a stage writes into before it is published."""
+        d = os.path.join(self.root, TMP, uuid.uuid4().hex)
+        os.makedirs(os.path.join(d, "artifact"))
+        return d
+
+    def publish(self, key, staging_dir, meta, replace=False):
+        """Move a staged artifact into place. replace=True (forced reruns) swaps out an existing one."""
+        with open(os.path.join(staging_dir, META), "w") as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+        target = self._dir(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        old = None
+        if replace and os.path.exists(target):
+            # directories cannot be renamed over each other: move the old object aside first
+            old = os.path.join(self.root, TMP, uuid.uuid4().hex)
+            try:
+                os.rename(target, old)
+            except OSError:
+                old = None
+        try:
+            os.rename(staging_dir, target)
+        except OSError:
+            # another run published the same key first; its artifact is equivalent
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        if old is not None:
+            shutil.rmtree(old, ignore_errors=True)
+
+    def discard(self, staging_dir):
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+
+# Stages and pipeline
+class Stage(object):
+    """One node of the DAG. `kind` + `version` identify the code that runs (bump version on changes)."""
+
+    def __init__(self, name, fn, config=None, deps=(), data=(), kind=None, version=1):
+        self.name = name
+        self.fn = fn
+        self.config = config if config is not None else {}
+        self.deps = tuple(deps)
+        self.data = tuple(data)
+        self.kind = kind or name.split("@")[0]
+        self.version = version
+
+
+class StageResult(object):
+    __slots__ = ("name", "key", "path", "status", "seconds", "metrics", "error")
+
+    def __init__(self, name, key, path, status, seconds=0.0, metrics=None, error=None):
+        self.name = name
+        self.key = key
+        self.path = path
+        self.status = status        # "cached" | "ran" | "failed" | "skipped"
+        self.seconds = seconds
+        self.metrics = metrics
+        self.error = error
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+def _run_stage(fn, inputs, config, staging_dir, data):
+    # module-level so it can be sent to a process pool
+    start = time.perf_counter()
+    metrics = fn(inputs, config, os.path.join(staging_dir, "artifact"), data)
+    return metrics, time.perf_counter() - start
+
+
+class Pipeline(object):
+    """A DAG of stages run against an ArtifactCache."""
+
+    def __init__(self, data=None):
+        self.stages = {}
+        self.data = dict(data or {})
+
+    def add(self, stage):
+        if stage.name in self.stages:
+            raise ValueError(f"Duplicate stage: {stage.name}")
+        for d in stage.deps:
+            if d not in self.stages:
+                raise ValueError(f"Stage {stage.name} depends on unknown stage {d}")
+        for d in stage.data:
+            if d not in self.data:
+                raise ValueError(f"Stage {stage.name} reads unknown data {d}")
+        self.stages[stage.name] = stage
+        return stage
+
+    def keys(self, hasher=None):
+        """{stage: key}; stages were added in dependency order, so one pass suffices."""
+        hasher = hasher or DataHasher()
+        data_hashes = {name: hasher.hash(src) for name, src in self.data.items()}
+        keys = {}
+        for name, stage in self.stages.items():
+            keys[name] = hash_config({
+                "kind": stage.kind,
+                "version": stage.version,
+                "config": hash_config(stage.config),
+                "deps": [keys[d] for d in stage.deps],
+                "data": {d: data_hashes[d] for d in stage.data},
+            })
+        return keys
+
+    def downstream(self, names):
+        """`names` plus every stage that depends on them."""
+        out = set(names)
+        for name, stage in self.stages.items():
+            if any(d in out for d in stage.deps):
+                out.add(name)
+        return out
+
+    def plan(self, cache_dir):
+        """[(stage, key, cached)] without running anything."""
+        cache = ArtifactCache(cache_dir)
+        hasher = DataHasher(os.path.join(cache_dir, FILE_HASHES))
+        keys = self.keys(hasher)
+        hasher.save()
+        return [(name, keys[name], cache.has(keys[name])) for name in self.stages]
+
+    def print_plan(self, cache_dir):
+        plan = self.plan(cache_dir)
+        width = max(len(n) for n, _, _ in plan)
+        for name, key, cached in plan:
+            print(f"{name:<{width}}  {key[:12]}  {'cached' if cached else 'run'}")
+        print(f"{sum(not c for _, _, c in plan)} of {len(plan)} stages to run")
+
+    def run(self, cache_dir, max_workers=2, executor="thread", force=(), only=None):
+        """Run every stage that is not cached. Returns {stage: StageResult}.
+
+        force: stage names to rerun even if cached (with everything downstream of them). only: restrict to these stages and
+        what they depend on. A failed stage skips its dependents; independent branches
+        keep running. executor="process" needs importable (picklable) stage functions.
+        """
+        if executor not in EXECUTORS:
+            raise ValueError(f"Unknown executor: {executor}")
+        cache = ArtifactCache(cache_dir)
+        hasher = DataHasher(os.path.join(cache_dir, FILE_HASHES))
+        keys = self.keys(hasher)
+        hasher.save()
+        # a forced stage's new output invalidates what was built from the old one
+        force = self.downstream(force)
+
+        wanted = set(self.stages)
+        if only is not None:
+            wanted = set()
+            stack = list(only)
+            while stack:
+                name = stack.pop()
+                if name not in wanted:
+                    wanted.add(name)
+                    stack.extend(self.stages[name].deps)
+
+        results = {}
+        pending = [n for n in self.stages if n in wanted]
+        running = {}
+        if executor == "process":
+            pool = ProcessPoolExecutor(max_workers, mp_context=mp.get_context("spawn"))
+        else:
+            pool = ThreadPoolExecutor(max_workers)
+        with pool:
+            while pending or running:
+                for name in list(pending):
+                    stage = self.stages[name]
+                    if any(d in results and results[d].status in ("failed", "skipped") for d in stage.deps):
+                        results[name] = StageResult(name, keys[name], None, "skipped")
+                        pending.remove(name)
+                        continue
+                    if not all(d in results for d in stage.deps):
+                        continue
+                    pending.remove(name)
+                    key = keys[name]
+                    if cache.has(key) and name not in force:
+                        meta = cache.meta(key)
+                        results[name] = StageResult(name, key, cache.path(key), "cached", 0.0, meta.get("metrics"))
+                        continue
+                    staging = cache.staging()
+                    inputs = {d: results[d].path for d in stage.deps}
+                    data = {d: self.data[d] for d in stage.data}
+                    print(f"[pipeline] running {name} ({key[:12]})")
+                    future = pool.submit(_run_stage, stage.fn, inputs, stage.config, staging, data)
+                    running[future] = (name, staging)
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, staging = running.pop(future)
+                    key = keys[name]
+                    try:
+                        metrics, seconds = future.result()
+                    except Exception as e:
+                        cache.discard(staging)
+                        results[name] = StageResult(name, key, None, "failed", error=repr(e))
+                        print(f"[pipeline] {name} failed: {e!r}")
+                        continue
+                    stage = self.stages[name]
+                    cache.publish(key, staging, {
+                        "stage": name, "kind": stage.kind, "version": stage.version, "key": key,
+                        "config": stage.config, "deps": {d: keys[d] for d in stage.deps},
+                        "data": list(stage.data), "metrics": metrics, "seconds": seconds,
+                        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    }, replace=name in force)
+                    results[name] = StageResult(name, key, cache.path(key), "ran", seconds, metrics)
+                    print(f"[pipeline] finished {name} in {seconds:.1f}s")
+
+        report = os.path.join(cache_dir, RUNS, time.strftime("%Y%m%d-%H%M%S") + ".json")
+        with open(report, "w") as f:
+            json.dump({n: r.to_dict() for n, r in results.items()}, f, indent=2, default=repr)
+        return results
+
+
+
+# The compression pipeline
+def config_subtree(config, name):
+    """A config property by name from a config object (attribute / method) or a dict."""
+    value = config[name] if isinstance(config, dict) else getattr(config, name)
+    return value() if callable(value) else value
+
+
+def _without(d, keys):
+    return {k: v for k, v in d.items() if k not in keys}
+
+
+# documentation-only keys of the quantization config; they do not change any artifact
+QUANT_DOC_KEYS = ("description", "goal", "notes", "evaluation_metrics")
+# runtime-only blocks of distillation_params (cache location, streaming, sampling trace,
+# hosts / ports); changing them must not retrain the student
+DISTILL_RUNTIME_KEYS = ("teacher_cache", "online", "moe_sampling", "data_parallel")
+
+
+def compression_pipeline(config, fns, data, prune_property="z_prune", sparsity_key="sparsity_ratio",
+                         sparsity_levels=None, quantize_unpruned=True):
+    """KD -> {prune@level} -> {ptq, qat}@each -> eval@each, wired from the config properties.
+
+    fns: {"distill", "prune", "ptq", "qat", "eval"} stage functions ("prune" may be
+    omitted to skip pruning). data: {"train", "calib", "eval"} paths.
+    Each stage's config is only the subtree it reads, e.g. PTQ stages see
+    quantization()["ptq"] plus the top-level precision / framework, so changing a PTQ
+    knob leaves the KD, pruning and QAT keys untouched.
+    """
+    pipe = Pipeline(data)
+    pipe.add(Stage("distill", fns["distill"], deps=(), data=("train",), config={
+        "student_model": config_subtree(config, "student_model"),
+        "distillation_params": _without(config_subtree(config, "distillation_params"), DISTILL_RUNTIME_KEYS),
+    }))
+
+    students = ["distill"] if quantize_unpruned or "prune" not in fns else []
+    if "prune" in fns:
+        prune_cfg = config_subtree(config, prune_property)
+        levels = sparsity_levels if sparsity_levels is not None else prune_cfg.get(sparsity_key, [])
+        if not isinstance(levels, (list, tuple)):
+            levels = [levels]
+        for level in levels:
+            name = f"prune@{level}"
+            pipe.add(Stage(name, fns["prune"], deps=("distill",), data=("calib",),
+                           config=dict(prune_cfg, **{sparsity_key: level})))
+            students.append(name)
+
+    quant = _without(config_subtree(config, "quantization"), QUANT_DOC_KEYS)
+    common = _without(quant, ("ptq", "qat"))
+    for student in students:
+        candidates = [student]
+        if "ptq" in fns and "ptq" in quant:
+            pipe.add(Stage(f"ptq@{student}", fns["ptq"], deps=(student,), data=("calib",),
+                           config=dict(common, ptq=quant["ptq"])))
+            candidates.append(f"ptq@{student}")
+        if "qat" in fns and "qat" in quant:
+            pipe.add(Stage(f"qat@{student}", fns["qat"], deps=(student,), data=("train",),
+                           config=dict(common, qat=quant["qat"])))
+            candidates.append(f"qat@{student}")
+        if "eval" in fns:
+            for model in candidates:
+                pipe.add(Stage(f"eval@{model}", fns["eval"], deps=(model,), data=("eval",),
+                               config={"evaluation_metrics": config_subtree(config, "quantization").get("evaluation_metrics")}))
+    return pipe
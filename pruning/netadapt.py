@@ -0,0 +1,247 @@
+"""
+NetAdapt driven by a measured latency lookup table (netadapt_parameters in pruning_v1.py)
+
+The config prunes a fixed pruning_step_sweep fraction of *parameters* per iteration,
+but we serve under a latency SLO and parameter count is a weak proxy for latency at
+these layer sizes. Following NetAdapt (Yang et al., 2018), each iteration here must
+buy a fixed amount of *measured* latency instead:
+
+	1. build_latency_lut micro-benchmarks every Dense layer shape the search can reach
+	   (candidate input width x output width, in multiples of `step`) at each serving
+	   batch size on the target CPU, once, and saves it as JSON
+	2. for every hidden layer, find the smallest number of neurons to remove so the
+	   LUT-estimated model latency drops by the per-iteration target
+	3. remove the lowest-importance neurons (L2 norm of incoming x outgoing weights),
+	   optionally short-term fine-tune, and evaluate
+	4. keep the candidate with the best accuracy; stop on any of stopping_criteria
+	   (max_iterations, target_sparsity, min_accuracy) or once the latency target is met
+
+latency_step and target_latency_ms default to the config's latency_step_sweep (a single
+value, as left by sweep.expand_grid, or the first entry of the list) and
+target_latency_ms; netadapt_sweep runs one search per latency_step_sweep entry. The
+parameter-count pruning_step_sweep is not used. build_latency_lut takes its batch_sizes,
+step and op from the config's latency_lut block when given config=.
+
+eval_fn(spec) must return an accuracy where higher is better (pass e.g. -PLL to use
+Poisson log loss); finetune_fn(spec, iterations) -> spec is optional. Layers are timed
+with the NumPy FP32 path by default, or the INT8 engine (op='int8').
+
+Usage:
+	lut = build_latency_lut(spec, config=prune()['netadapt_parameters'])
+	save_lut(lut, 'latency_lut.json')
+	best, history = netadapt(spec, lut, eval_fn, prune()['netadapt_parameters'], batch_size=64)
+	runs = netadapt_sweep(spec, lut, eval_fn, prune()['netadapt_parameters'], batch_size=64)
+"""
+
+import json
+import os
+import platform
+import numpy as np
+
+from quantization.benchmark import time_calls
+from quantization.int8_engine import FLOAT_ACTIVATIONS, UINT8_MAX, Int8Dense
+
+
+DEFAULT_STEP = 8
+DEFAULT_LUT_BATCH_SIZES = (1, 64)
+DEFAULT_OP = 'fp32'
+DEFAULT_LATENCY_STEP = 0.05    # fraction of the initial latency to remove per iteration
+LUT_WARMUP = 3
+LUT_ITERATIONS = 30
+HEADS = 'heads'
+
+
+# Latency lookup table
+def width_grid(width, step=DEFAULT_STEP):
+	"""Reachable widths for a layer: multiples of step up to (and including) the original width."""
+	return sorted(set(range(step, width, step)) | {width})
+
+
+def _layer_op(n_in, n_out, op, rng):
+	kernel = rng.standard_normal((n_in, n_out)).astype(np.float32) / np.sqrt(n_in)
+	bias = np.zeros(n_out, dtype=np.float32)
+	if op == 'int8':
+		layer = Int8Dense('probe', kernel, bias, in_scale=0.05, in_qmax=UINT8_MAX, out_scale=0.05)
+		return layer, lambda b: rng.integers(0, UINT8_MAX, size=(b, n_in)).astype(np.uint8)
+	relu = FLOAT_ACTIVATIONS['relu']
+	return (lambda x: relu(x @ kernel + bias)), lambda b: rng.standard_normal((b, n_in)).astype(np.float32)
+
+
+def build_latency_lut(spec, batch_sizes=None, step=None, op=None,
+		      warmup=LUT_WARMUP, iterations=LUT_ITERATIONS, config=None):
+	"""Median latency (seconds) of every reachable (in_width, out_width) per layer and batch size.
+
+	Arguments left as None come from config['latency_lut'] (netadapt_parameters), then the defaults.
+	"""
+	lut_config = (config or {}).get('latency_lut', {})
+	batch_sizes = batch_sizes or lut_config.get('batch_sizes', DEFAULT_LUT_BATCH_SIZES)
+	step = step or lut_config.get('step', DEFAULT_STEP)
+	op = op or lut_config.get('op', DEFAULT_OP)
+	rng = np.random.default_rng(0)
+	hidden = spec['hidden']
+	n_heads_out = sum(h['kernel'].shape[1] for h in spec['heads'])
+	in_grid = [[hidden[0]['kernel'].shape[0]]]
+	out_grid = []
+	for layer in hidden:
+		out_grid.append(width_grid(layer['kernel'].shape[1], step))
+		in_grid.append(out_grid[-1])
+
+	lut = {
+		'meta': {'platform': platform.platform(), 'processor': platform.processor(),
+			 'cpu_count': os.cpu_count(), 'op': op, 'step': step, 'iterations': iterations},
+		'batch_sizes': list(batch_sizes),
+		'layers': {},
+	}
+	shapes = [(l['name'], in_grid[i], out_grid[i]) for i, l in enumerate(hidden)]
+	shapes.append((HEADS, in_grid[-1], [n_heads_out]))
+	for name, ins, outs in shapes:
+		entries = {}
+		for b in batch_sizes:
+			for n_in in ins:
+				for n_out in outs:
+					fn, make_x = _layer_op(n_in, n_out, op, rng)
+					latencies, _ = time_calls(fn, make_x(b), warmup, iterations)
+					entries[f'{b}:{n_in}:{n_out}'] = float(np.median(latencies)) / 1e9
+		lut['layers'][name] = entries
+		print(f'LUT: {name} done ({len(entries)} shapes)')
+	return lut
+
+
+def save_lut(lut, path):
+	with open(path, 'w') as f:
+		json.dump(lut, f, indent=2, sort_keys=True)
+
+
+def load_lut(path):
+	with open(path) as f:
+		return json.load(f)
+
+
+def widths_of(spec):
+	return [spec['hidden'][0]['kernel'].shape[0]] + [l['kernel'].shape[1] for l in spec['hidden']]
+
+
+def estimate_latency(lut, spec_or_widths, batch_size, names=None):
+	"""LUT-estimated latency (seconds) of the whole student for a list of widths (input first)."""
+	if isinstance(spec_or_widths, dict):
+		names = [l['name'] for l in spec_or_widths['hidden']]
+		n_heads_out = sum(h['kernel'].shape[1] for h in spec_or_widths['heads'])
+		widths = widths_of(spec_or_widths)
+	else:
+		widths, n_heads_out = spec_or_widths
+	total = 0.0
+	for i, name in enumerate(names):
+		total += lut['layers'][name][f'{batch_size}:{widths[i]}:{widths[i + 1]}']
+	total += lut['layers'][HEADS][f'{batch_size}:{widths[-1]}:{n_heads_out}']
+	return total
+
+
+# Structural pruning
+def neuron_importance(spec, k):
+	"""L2 norm of each hidden-k neuron's incoming weights times its outgoing weights."""
+	incoming = np.linalg.norm(spec['hidden'][k]['kernel'], axis=0)
+	consumers = [spec['hidden'][k + 1]] if k + 1 < len(spec['hidden']) else spec['heads']
+	outgoing = np.sqrt(sum(np.square(c['kernel']).sum(axis=1) for c in consumers))
+	return incoming * outgoing
+
+
+def remove_neurons(spec, k, n_remove):
+	"""Copy of spec with the n_remove least important neurons of hidden layer k deleted."""
+	keep = np.sort(np.argsort(neuron_importance(spec, k))[n_remove:])
+	hidden = [dict(l) for l in spec['hidden']]
+	heads = [dict(l) for l in spec['heads']]
+	hidden[k]['kernel'] = hidden[k]['kernel'][:, keep]
+	hidden[k]['bias'] = hidden[k]['bias'][keep]
+	for c in ([hidden[k + 1]] if k + 1 < len(hidden) else heads):
+		c['kernel'] = c['kernel'][keep]
+	return {'hidden': hidden, 'heads': heads}
+
+
+def param_count(spec):
+	return sum(l['kernel'].size for l in spec['hidden'] + spec['heads'])
+
+
+# NetAdapt
+def _latency_steps(config):
+	steps = config.get('latency_step_sweep', DEFAULT_LATENCY_STEP)
+	return list(steps) if isinstance(steps, (list, tuple)) else [steps]
+
+
+def netadapt(spec, lut, eval_fn, config, batch_size=64, latency_step=None,
+	     target_latency_ms=None, finetune_fn=None, step=None):
+	"""Run NetAdapt until a stopping criterion fires. Returns (best_spec, history)."""
+	step = step or lut['meta']['step']
+	if latency_step is None:
+		latency_step = _latency_steps(config)[0]
+	if target_latency_ms is None:
+		target_latency_ms = config.get('target_latency_ms')
+	stopping = config.get('stopping_criteria', {})
+	max_iterations = stopping.get('max_iterations', 100)
+	target_sparsity = stopping.get('target_sparsity', 1.0)
+	min_accuracy = stopping.get('min_accuracy', -np.inf)
+	finetune_iterations = config.get('short_term_finetune_iterations', 0)
+	names = [l['name'] for l in spec['hidden']]
+	n_heads_out = sum(h['kernel'].shape[1] for h in spec['heads'])
+
+	initial_params = param_count(spec)
+	initial_latency = estimate_latency(lut, spec, batch_size)
+	reduction = latency_step * initial_latency
+	history = [{'iteration': 0, 'layer': None, 'widths': widths_of(spec), 'latency_ms': initial_latency * 1e3,
+		    'accuracy': float(eval_fn(spec)), 'sparsity': 0.0}]
+	print(f"Initial: widths {history[0]['widths']}, {history[0]['latency_ms']:.4f} ms, accuracy {history[0]['accuracy']:.4f}")
+
+	current = spec
+	for it in range(1, max_iterations + 1):
+		latency = estimate_latency(lut, current, batch_size)
+		if target_latency_ms is not None and latency * 1e3 <= target_latency_ms:
+			print(f'Latency target {target_latency_ms} ms reached')
+			break
+
+		best = None
+		widths = widths_of(current)
+		for k in range(len(names)):
+			# smallest removal (on the LUT grid) that buys the per-iteration latency reduction
+			for w in reversed([w for w in width_grid(spec['hidden'][k]['kernel'].shape[1], step) if w < widths[k + 1]]):
+				trial = list(widths)
+				trial[k + 1] = w
+				if latency - estimate_latency(lut, (trial, n_heads_out), batch_size, names) >= reduction:
+					break
+			else:
+				continue
+			candidate = remove_neurons(current, k, widths[k + 1] - w)
+			if finetune_fn is not None and finetune_iterations:
+				candidate = finetune_fn(candidate, finetune_iterations)
+			accuracy = float(eval_fn(candidate))
+			if best is None or accuracy > best[1]:
+				best = (candidate, accuracy, names[k])
+
+		if best is None:
+			print('No layer can deliver the per-iteration latency reduction; stopping')
+			break
+		candidate, accuracy, layer = best
+		if accuracy < min_accuracy:
+			print(f'Best candidate accuracy {accuracy:.4f} is below min_accuracy {min_accuracy}; stopping')
+			break
+
+		current = candidate
+		sparsity = 1.0 - param_count(current) / initial_params
+		history.append({'iteration': it, 'layer': layer, 'widths': widths_of(current),
+				'latency_ms': estimate_latency(lut, current, batch_size) * 1e3,
+				'accuracy': accuracy, 'sparsity': sparsity})
+		h = history[-1]
+		print(f"Iter {it:>3}: pruned {layer:<10} widths {h['widths']} | {h['latency_ms']:.4f} ms | "
+		      f"acc {accuracy:.4f} | sparsity {sparsity:.3f}")
+		if sparsity >= target_sparsity:
+			print(f'Target sparsity {target_sparsity} reached')
+			break
+
+	return current, history
+
+
+def netadapt_sweep(spec, lut, eval_fn, config, **kwargs):
+	"""One netadapt run per latency_step_sweep entry: {latency_step: (best_spec, history)}."""
+	runs = {}
+	for latency_step in _latency_steps(config):
+		print(f'NetAdapt with latency_step {latency_step}')
+		runs[latency_step] = netadapt(spec, lut, eval_fn, config, latency_step=latency_step, **kwargs)
+	return runs
@@ -29,11 +29,16 @@ def prune(self):
 			"pruning_scope": "layer",  ## or might be called "local"
 			"accuracy_degradation_threshold": [.02, .05, .08],  ## TODO change these depending on current accuracy
 			"layer_pruning_sweep_ratios": [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9],  ## sweep per layer according to notes above
+			"eval_samples": 10000,  ## fixed seeded eval subset, layer inputs memoized (see sensitivity.py)
+			"target_sparsity": [.3, .5, .7],  ## solve per-layer ratios for an overall sparsity instead of one threshold
 		},
 		"netadapt_parameters": {
 			"pruning_scope": "global", 
-			"pruning_step_sweep": [0.01, 0.05, 0.1],  ## how much to prune per iteration (overall, not per layer) 
+			"pruning_step_sweep": [0.01, 0.05, 0.1],  ## how much to prune per iteration (overall, not per layer); unused by netadapt.py, which steps by latency_step_sweep
 			"short_term_finetune_iterations": 10000,  ## num finetuning iterations per pruning iteration
+			"latency_step_sweep": [0.01, 0.05, 0.1],  ## fraction of initial latency removed per iteration (netadapt.py LUT)
+			"latency_lut": {"batch_sizes": [1, 64], "step": 8, "op": "fp32"},  ## build_latency_lut defaults; built once per target CPU
+			"target_latency_ms": None,  ## serving SLO; stop once the LUT estimate is under it
 			"stopping_criteria": {  ## not sure how to phrase this, but idea is we stop iterating upon any of these conditions
 				"max_iterations": 100,  ## or some other cutoff value
 				"target_sparsity": .9,  ## if we've hit overall 90% sparsity, since seems like almost always downhill after that
@@ -19,6 +19,7 @@ def z_prune(self):
                 "layer_wise_execution": True,
                 "sparsity_ratio": [.1, .2, .3, .4, .5], # percent of weights pruned
                 "pruning_mode": ["global", "neuron"], # prune across entire weight matrix or per neuron
+                                                      # ("model" ranks across all layers, see z_prune.py)
                 "weight_normalization": { # normalize weights before computing their importance
                         "row_wise_l2": True,
                         "column_wise_l2": True,
@@ -0,0 +1,269 @@
+"""
+Sensitivity-analysis pruning runner (sensitivity_analysis_parameters in pruning_v1.py)
+
+The config sweeps every layer over layer_pruning_sweep_ratios 0.0-0.9 and compares the
+resulting loss to an accuracy_degradation_threshold: layers x 10 full evaluations.
+This runner makes each probe cheap:
+
+	- the eval set is a fixed, seeded subset, and the unpruned activations feeding every
+	  layer are computed once and memoized, so probing layer i only recomputes layers
+	  i..end starting from the cached input of layer i
+	- (layer, ratio) probes run in parallel worker processes that receive the cache once
+	- probe results are persisted (keyed by a fingerprint of the weights, eval subset and
+	  score_fn), so rerunning with more ratios or thresholds only evaluates what is new
+
+Each layer's measured degradation is fitted to a monotone piecewise-linear curve, and
+per-layer ratios are solved either for a fixed degradation threshold or for a global
+sparsity target (bisection on the shared threshold, so every layer stops at the same
+marginal loss).
+
+Degradation is the increase in Poisson log loss on conv_value over the unpruned model,
+as a fraction of the unpruned model's PLL gain over the label-mean predictor (mean(y)
+for every row). PLL itself can be near zero or negative, so dividing by it would make
+the thresholds meaningless; the gain is positive for any model that learned something.
+Pruning inside a layer is by weight magnitude (as in the notebook's prune_and_evaluate)
+unless another score_fn is given.
+
+With config= (sensitivity_analysis_parameters), the eval subset size comes from
+eval_samples, run() sweeps layer_pruning_sweep_ratios and target_ratios() solves every
+target_sparsity entry.
+
+Usage:
+	runner = SensitivityRunner(spec, x_eval, y_eval, config=prune()['sensitivity_analysis_parameters'],
+				   cache_path='sensitivity_cache.json')
+	results = runner.run()
+	by_target = runner.target_ratios(results)          # {target_sparsity: {layer: ratio}}
+	pruned = apply_masks(spec, magnitude_masks(spec, by_target[0.5]))
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from quantization.calibration import poisson_log_loss
+from quantization.int8_engine import FLOAT_ACTIVATIONS
+
+
+DEFAULT_EVAL_SAMPLES = 10000
+RATIO_GRID = np.round(np.arange(0.0, 0.95, 0.01), 2)
+
+
+def magnitude_scores(kernel):
+	return np.abs(kernel)
+
+
+def layer_mask(kernel, ratio, score_fn=magnitude_scores):
+	"""Keep-mask pruning the lowest-scoring `ratio` of a layer's weights."""
+	k = int(ratio * kernel.size)
+	if k == 0:
+		return np.ones(kernel.shape, dtype=bool)
+	scores = score_fn(kernel).ravel()
+	mask = np.ones(kernel.size, dtype=bool)
+	mask[np.argpartition(scores, k - 1)[:k]] = False
+	return mask.reshape(kernel.shape)
+
+
+def magnitude_masks(spec, ratios, score_fn=magnitude_scores):
+	"""{layer: mask} for per-layer ratios (e.g. from ratios_for_target)."""
+	layers = {l['name']: l for l in spec['hidden'] + spec['heads']}
+	return {name: layer_mask(layers[name]['kernel'], r, score_fn) for name, r in ratios.items()}
+
+
+# Probe runner
+class SensitivityRunner(object):
+	"""Per-layer pruning probes over memoized layer inputs."""
+
+	def __init__(self, spec, x_eval, y_eval, max_samples=None, seed=0,
+		     score_fn=magnitude_scores, layer_names=None, cache_path=None, config=None):
+		self.config = config or {}
+		if max_samples is None:
+			max_samples = self.config.get('eval_samples', DEFAULT_EVAL_SAMPLES)
+		if len(x_eval) > max_samples:
+			rows = np.sort(np.random.default_rng(seed).choice(len(x_eval), max_samples, replace=False))
+			x_eval, y_eval = x_eval[rows], y_eval[rows]
+		hidden_names = [l['name'] for l in spec['hidden']]
+		unknown = [n for n in (layer_names or []) if n not in hidden_names]
+		if unknown:
+			raise ValueError(f'layer_names must be hidden layers {hidden_names}; got {unknown}')
+		self.spec = spec
+		self.y = np.asarray(y_eval)
+		self.score_fn = score_fn
+		self.layers = spec['hidden'] + spec['heads']
+		self.layer_names = layer_names or hidden_names
+		self.cache_path = cache_path
+
+		# memoize the unpruned input of every layer; heads all read the last hidden output
+		self.inputs = []
+		h = np.asarray(x_eval, dtype=np.float32)
+		for layer in spec['hidden']:
+			self.inputs.append(h)
+			h = FLOAT_ACTIVATIONS[layer['activation']](h @ layer['kernel'] + layer['bias'])
+		self.head_input = h
+		self.baseline = self.loss_from(len(spec['hidden']), h)
+		self.reference = poisson_log_loss(self.y, np.full(self.y.shape, max(float(self.y.mean()), 1e-7), dtype=np.float32))
+		self.scale = self.reference - self.baseline
+		if self.scale <= 0:
+			print(f'Warning: the model does not beat the label-mean PLL ({self.reference:.5f}); '
+			      'degradation is reported as absolute PLL increase')
+			self.scale = 1.0
+		self.fingerprint = self._fingerprint(x_eval)
+
+	def _fingerprint(self, x_eval):
+		h = hashlib.sha256()
+		for layer in self.layers:
+			h.update(np.ascontiguousarray(layer['kernel']).tobytes())
+			h.update(np.ascontiguousarray(layer['bias']).tobytes())
+		h.update(np.ascontiguousarray(x_eval).tobytes())
+		h.update(np.ascontiguousarray(self.y).tobytes())
+		# probes pruned with a different score_fn are not interchangeable
+		h.update(f'{self.score_fn.__module__}.{self.score_fn.__qualname__}'.encode())
+		return h.hexdigest()[:16]
+
+	def loss_from(self, start, h, pruned=None):
+		"""Forward from hidden layer `start` (or the heads if start == len(hidden)) and score."""
+		for i in range(start, len(self.spec['hidden'])):
+			layer = self.spec['hidden'][i]
+			kernel = pruned if (i == start and pruned is not None) else layer['kernel']
+			h = FLOAT_ACTIVATIONS[layer['activation']](h @ kernel + layer['bias'])
+		value = None
+		for head in self.spec['heads']:
+			if head['name'] == 'conv_value':
+				value = FLOAT_ACTIVATIONS[head['activation']](h @ head['kernel'] + head['bias'])
+		return poisson_log_loss(self.y, value)
+
+	def degradation(self, loss):
+		return (loss - self.baseline) / self.scale
+
+	def probe(self, name, ratio):
+		idx = [l['name'] for l in self.spec['hidden']].index(name)
+		kernel = self.spec['hidden'][idx]['kernel']
+		pruned = kernel * layer_mask(kernel, ratio, self.score_fn)
+		return self.loss_from(idx, self.inputs[idx], pruned)
+
+	def layer_sizes(self):
+		return {l['name']: l['kernel'].size for l in self.spec['hidden'] if l['name'] in self.layer_names}
+
+	# persistence
+	def _load_cache(self):
+		if not self.cache_path or not os.path.exists(self.cache_path):
+			return {}
+		with open(self.cache_path) as f:
+			cached = json.load(f)
+		return cached['probes'] if cached.get('fingerprint') == self.fingerprint else {}
+
+	def _save_cache(self, probes):
+		if not self.cache_path:
+			return
+		tmp = self.cache_path + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump({'fingerprint': self.fingerprint, 'baseline': self.baseline, 'probes': probes}, f, indent=2)
+		os.replace(tmp, self.cache_path)
+
+	def run(self, ratios=None, num_workers=None):
+		"""Evaluate every (layer, ratio) not already cached. Returns {layer: {ratio: loss}}.
+
+		ratios defaults to the config's layer_pruning_sweep_ratios.
+		"""
+		if ratios is None:
+			ratios = self.config['layer_pruning_sweep_ratios']
+		probes = self._load_cache()
+		todo = [(n, float(r)) for n in self.layer_names for r in ratios if f'{n}@{float(r)}' not in probes]
+		print(f'Sensitivity analysis: {len(todo)} probes to run, {len(probes)} cached (baseline PLL {self.baseline:.5f})')
+
+		if todo:
+			if num_workers == 1:
+				losses = [self.probe(n, r) for n, r in todo]
+			else:
+				with ProcessPoolExecutor(num_workers, initializer=_init_worker, initargs=(self,)) as pool:
+					losses = list(pool.map(_probe, todo, chunksize=max(1, len(todo) // (4 * (num_workers or os.cpu_count() or 1)))))
+			for (n, r), loss in zip(todo, losses):
+				probes[f'{n}@{r}'] = loss
+			self._save_cache(probes)
+
+		results = {n: {} for n in self.layer_names}
+		for key, loss in probes.items():
+			n, r = key.rsplit('@', 1)
+			if n in results:
+				results[n][float(r)] = loss
+		return results
+
+	def target_ratios(self, results, targets=None):
+		"""{target_sparsity: {layer: ratio}} for targets (default: the config's target_sparsity)."""
+		if targets is None:
+			targets = self.config.get('target_sparsity', [])
+		if not isinstance(targets, (list, tuple)):
+			targets = [targets]
+		curves = fit_curves(results, self.baseline, self.scale)
+		return {t: ratios_for_target(curves, self.layer_sizes(), t) for t in targets}
+
+
+_RUNNER = None
+
+
+def _init_worker(runner):
+	global _RUNNER
+	_RUNNER = runner
+
+
+def _probe(job):
+	return _RUNNER.probe(*job)
+
+
+# Curves and ratio selection
+def fit_curves(results, baseline, scale):
+	"""Monotone piecewise-linear degradation curves: {layer: (ratios, degradation)}.
+
+	Degradation is (loss - baseline) / scale, with scale = SensitivityRunner.scale.
+	"""
+	curves = {}
+	for name, by_ratio in results.items():
+		ratios = np.array(sorted(by_ratio))
+		degradation = np.array([(by_ratio[r] - baseline) / scale for r in ratios])
+		# pruning more never helps in expectation; clamp noise so the curve is non-decreasing
+		curves[name] = (ratios, np.maximum.accumulate(np.maximum(degradation, 0.0)))
+	return curves
+
+
+def ratios_for_threshold(curves, threshold, grid=RATIO_GRID):
+	"""Largest ratio per layer whose (interpolated) degradation stays within threshold."""
+	out = {}
+	for name, (ratios, degradation) in curves.items():
+		g = grid[grid <= ratios[-1]]
+		ok = np.interp(g, ratios, degradation) <= threshold
+		out[name] = float(g[ok].max()) if ok.any() else 0.0
+	return out
+
+
+def achieved_sparsity(ratios, sizes):
+	total = sum(sizes.values())
+	return sum(ratios[n] * sizes[n] for n in ratios) / total if total else 0.0
+
+
+def ratios_for_target(curves, sizes, target_sparsity, grid=RATIO_GRID, iterations=60):
+	"""Per-layer ratios reaching target_sparsity with the smallest shared degradation threshold."""
+	hi = max(float(d[-1]) for _, d in curves.values())
+	if achieved_sparsity(ratios_for_threshold(curves, hi, grid), sizes) < target_sparsity:
+		print(f'Warning: target sparsity {target_sparsity} is above what the probed ratios allow')
+		return ratios_for_threshold(curves, hi, grid)
+	lo = 0.0
+	for _ in range(iterations):
+		mid = 0.5 * (lo + hi)
+		if achieved_sparsity(ratios_for_threshold(curves, mid, grid), sizes) >= target_sparsity:
+			hi = mid
+		else:
+			lo = mid
+	ratios = ratios_for_threshold(curves, hi, grid)
+	print(f'Target sparsity {target_sparsity:.2f}: threshold {hi:.4f}, '
+	      f'achieved {achieved_sparsity(ratios, sizes):.3f}, ratios {ratios}')
+	return ratios
+
+
+def print_curves(curves):
+	names = list(curves)
+	ratios = curves[names[0]][0]
+	print(f"{'Ratio':<6} | " + ' | '.join(f'{n:>12}' for n in names))
+	print('-' * (9 + 15 * len(names)))
+	for i, r in enumerate(ratios):
+		print(f'{r:<6.2f} | ' + ' | '.join(f'{curves[n][1][i]:>12.4%}' for n in names))
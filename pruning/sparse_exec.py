@@ -0,0 +1,412 @@
+"""
+Sparse execution path for pruned students
+
+prune_and_evaluate in the notebook multiplies kernels by a 0/1 mask but keeps them
+dense, so 70% sparsity costs exactly as much to serve as 0%. This module converts
+each pruned Dense layer into whichever format is actually fastest for it:
+
+	'dense'   plain matmul (small or barely-sparse layers)
+	'csr'     compressed sparse rows over output neurons (unstructured sparsity)
+	'block4'  4x1 / 8x1 blocks (4 or 8 consecutive output neurons sharing one input);
+	'block8'  fewer indices to load than CSR when the pruning left blocky patterns
+	'nm24'    2:4 structured layout (2 kept weights per group of 4 inputs)
+
+and, for neuron-level pruning, first physically shrinks the network: output neurons
+whose incoming weights are all zero are removed (their constant activation is folded
+into the next layer's bias), and inputs nobody reads are dropped.
+
+A per-layer cost model picks the format. By default it micro-benchmarks every
+candidate at the serving batch size (measure=True); measure=False uses a rough
+analytic model of dense FLOPs vs. sparse gathers instead. NumPy has no 2:4 kernel,
+so 'nm24' is rarely picked on CPU; it is kept so the same plan can target hardware
+that has one.
+
+The shrunk spec is an ordinary int8_engine spec, so Int8MLP.build(shrink(spec)[0], ...)
+gives the sparse + INT8 hybrid mentioned in quantization_v1.py.
+
+Usage:
+	spec = extract_keras_layers(pruned_model)
+	sparse = SparseMLP.from_spec(spec, batch_size=64)
+	sparse.describe()
+	outputs = sparse.forward(x)
+"""
+
+import json
+import numpy as np
+
+from quantization.int8_engine import FLOAT_ACTIVATIONS, sigmoid
+
+try:
+	import scipy.sparse as sp
+except ImportError:  # optional: faster CSR kernels when scipy is installed
+	sp = None
+
+
+FORMATS = ('dense', 'csr', 'block4', 'block8', 'nm24')
+MAX_SPARSE_DENSITY = 0.9       # above this, sparse formats are never worth trying
+NM_CHUNK_OUT = 32              # output columns per gather chunk for the 2:4 kernel
+
+# analytic model (measure=False): rough single-core throughput
+DENSE_GFLOPS = 20.0
+GATHER_GELEMS = 1.0
+
+
+# Sparse linear operators, all computing x (B, in) @ kernel (in, out)
+class DenseLinear(object):
+	fmt = 'dense'
+
+	def __init__(self, kernel):
+		self.kernel = np.ascontiguousarray(kernel, dtype=np.float32)
+		self.shape = self.kernel.shape
+
+	def __call__(self, x):
+		return x @ self.kernel
+
+	def arrays(self):
+		return {'kernel': self.kernel}
+
+	@property
+	def nbytes(self):
+		return self.kernel.nbytes
+
+
+class CSRLinear(object):
+	"""CSR over output neurons: row j lists the inputs feeding neuron j."""
+	fmt = 'csr'
+
+	def __init__(self, kernel=None, arrays=None, shape=None):
+		if kernel is not None:
+			wt = np.asarray(kernel, dtype=np.float32).T
+			mask = wt != 0
+			self.shape = kernel.shape
+			self.indptr = np.concatenate([[0], np.cumsum(mask.sum(axis=1))]).astype(np.int64)
+			self.indices = np.nonzero(mask)[1].astype(np.int32)
+			self.data = wt[mask]
+		else:
+			self.shape = tuple(shape)
+			self.indptr, self.indices, self.data = arrays['indptr'], arrays['indices'], arrays['data']
+		lengths = np.diff(self.indptr)
+		self.nonempty = np.nonzero(lengths)[0]
+		self.starts = self.indptr[self.nonempty]
+		self._csr = sp.csr_matrix((self.data, self.indices, self.indptr), shape=self.shape[::-1]) if sp else None
+
+	def __call__(self, x):
+		if self._csr is not None:
+			return np.asarray((self._csr @ x.T).T)
+		y = np.zeros((len(x), self.shape[1]), dtype=np.float32)
+		if self.data.size:
+			prod = x[:, self.indices] * self.data
+			y[:, self.nonempty] = np.add.reduceat(prod, self.starts, axis=1)
+		return y
+
+	def arrays(self):
+		return {'indptr': self.indptr, 'indices': self.indices, 'data': self.data}
+
+	@property
+	def nbytes(self):
+		return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
+
+class BlockSparseLinear(object):
+	"""r x 1 blocks: r consecutive output neurons that share one input index."""
+
+	def __init__(self, kernel=None, r=4, arrays=None, shape=None):
+		self.r = r
+		self.fmt = f'block{r}'
+		if kernel is not None:
+			kernel = np.asarray(kernel, dtype=np.float32)
+			self.shape = kernel.shape
+			n_in, n_out = kernel.shape
+			n_br = -(-n_out // r)
+			padded = np.zeros((n_in, n_br * r), dtype=np.float32)
+			padded[:, :n_out] = kernel
+			blocks = padded.reshape(n_in, n_br, r).transpose(1, 0, 2)     # (block_row, in, r)
+			keep = np.any(blocks != 0, axis=2)
+			self.block_ptr = np.concatenate([[0], np.cumsum(keep.sum(axis=1))]).astype(np.int64)
+			self.cols = np.nonzero(keep)[1].astype(np.int32)
+			self.vals = blocks[keep]                                          # (n_blocks, r)
+		else:
+			self.shape = tuple(shape)
+			self.block_ptr, self.cols, self.vals = arrays['block_ptr'], arrays['cols'], arrays['vals']
+		self.n_br = len(self.block_ptr) - 1
+		self.nonempty = np.nonzero(np.diff(self.block_ptr))[0]
+		self.starts = self.block_ptr[self.nonempty]
+
+	def __call__(self, x):
+		y = np.zeros((len(x), self.n_br, self.r), dtype=np.float32)
+		if self.vals.size:
+			contrib = x[:, self.cols, None] * self.vals[None]
+			y[:, self.nonempty] = np.add.reduceat(contrib, self.starts, axis=1)
+		return y.reshape(len(x), -1)[:, :self.shape[1]]
+
+	def arrays(self):
+		return {'block_ptr': self.block_ptr, 'cols': self.cols, 'vals': self.vals}
+
+	@property
+	def nbytes(self):
+		return self.block_ptr.nbytes + self.cols.nbytes + self.vals.nbytes
+
+
+class NMLinear(object):
+	"""N:M structured sparsity along the input dimension (2:4 by default)."""
+
+	def __init__(self, kernel=None, n=2, m=4, arrays=None, shape=None):
+		self.n, self.m = n, m
+		self.fmt = f'nm{n}{m}'
+		if kernel is not None:
+			kernel = np.asarray(kernel, dtype=np.float32)
+			if not is_nm_sparse(kernel, n, m):
+				# keeping n weights per group of a denser kernel would silently prune it
+				raise ValueError(f'nm{n}{m} requires a {n}:{m}-sparse kernel (at most {n} nonzeros per group of {m} inputs)')
+			self.shape = kernel.shape
+			n_in, n_out = kernel.shape
+			groups = -(-n_in // m)
+			padded = np.zeros((groups * m, n_out), dtype=np.float32)
+			padded[:n_in] = kernel
+			grouped = padded.reshape(groups, m, n_out)
+			# keep the n largest magnitudes per group (the zeros beyond the n:m pattern)
+			order = np.argsort(-np.abs(grouped), axis=1, kind='stable')[:, :n]
+			order = np.sort(order, axis=1)
+			self.idx = order.astype(np.uint8)                                 # (groups, n, out)
+			self.vals = np.take_along_axis(grouped, order, axis=1)
+		else:
+			self.shape = tuple(shape)
+			self.idx, self.vals = arrays['idx'], arrays['vals']
+		groups = self.idx.shape[0]
+		self.abs_idx = (np.arange(groups)[:, None, None] * self.m + self.idx).astype(np.int64)
+		if self.shape[0] % self.m:
+			self._pad = groups * self.m - self.shape[0]
+		else:
+			self._pad = 0
+
+	def __call__(self, x):
+		if self._pad:
+			x = np.concatenate([x, np.zeros((len(x), self._pad), dtype=x.dtype)], axis=1)
+		y = np.empty((len(x), self.shape[1]), dtype=np.float32)
+		for o in range(0, self.shape[1], NM_CHUNK_OUT):
+			sl = slice(o, o + NM_CHUNK_OUT)
+			y[:, sl] = np.einsum('bgno,gno->bo', x[:, self.abs_idx[:, :, sl]], self.vals[:, :, sl])
+		return y
+
+	def arrays(self):
+		return {'idx': self.idx, 'vals': self.vals}
+
+	@property
+	def nbytes(self):
+		return self.vals.nbytes + self.idx.nbytes
+
+
+def make_linear(kernel, fmt):
+	if fmt == 'dense':
+		return DenseLinear(kernel)
+	if fmt == 'csr':
+		return CSRLinear(kernel)
+	if fmt in ('block4', 'block8'):
+		return BlockSparseLinear(kernel, r=int(fmt[5:]))
+	if fmt == 'nm24':
+		return NMLinear(kernel, 2, 4)
+	raise ValueError(f'Unknown sparse format: {fmt}')
+
+
+def _linear_from_arrays(fmt, arrays, shape):
+	if fmt == 'dense':
+		return DenseLinear(arrays['kernel'])
+	if fmt == 'csr':
+		return CSRLinear(arrays=arrays, shape=shape)
+	if fmt in ('block4', 'block8'):
+		return BlockSparseLinear(r=int(fmt[5:]), arrays=arrays, shape=shape)
+	if fmt == 'nm24':
+		return NMLinear(n=2, m=4, arrays=arrays, shape=shape)
+	raise ValueError(f'Unknown sparse format: {fmt}')
+
+
+# Structure analysis
+def is_nm_sparse(kernel, n=2, m=4):
+	"""True if every group of m consecutive inputs has at most n nonzeros per output."""
+	n_in = kernel.shape[0]
+	groups = -(-n_in // m)
+	padded = np.zeros((groups * m, kernel.shape[1]), dtype=bool)
+	padded[:n_in] = kernel != 0
+	return bool(np.all(padded.reshape(groups, m, -1).sum(axis=1) <= n))
+
+
+def block_density(kernel, r):
+	n_in, n_out = kernel.shape
+	n_br = -(-n_out // r)
+	padded = np.zeros((n_in, n_br * r), dtype=bool)
+	padded[:, :n_out] = kernel != 0
+	return float(np.any(padded.reshape(n_in, n_br, r), axis=2).mean())
+
+
+def candidate_formats(kernel):
+	"""Formats worth considering for this kernel's sparsity pattern."""
+	candidates = ['dense']
+	if np.mean(kernel != 0) < MAX_SPARSE_DENSITY:
+		candidates.append('csr')
+	for r in (4, 8):
+		if block_density(kernel, r) < MAX_SPARSE_DENSITY:
+			candidates.append(f'block{r}')
+	if is_nm_sparse(kernel):
+		candidates.append('nm24')
+	return candidates
+
+
+def estimate_cost(kernel, fmt, batch_size):
+	"""Analytic cost (seconds) per call: dense FLOPs vs. gathered multiply-adds."""
+	n_in, n_out = kernel.shape
+	if fmt == 'dense':
+		return 2.0 * batch_size * n_in * n_out / (DENSE_GFLOPS * 1e9)
+	if fmt == 'csr':
+		elems = np.count_nonzero(kernel)
+	elif fmt.startswith('block'):
+		r = int(fmt[5:])
+		elems = block_density(kernel, r) * n_in * (-(-n_out // r)) * r
+	else:
+		elems = n_in * n_out / 2
+	return batch_size * elems / (GATHER_GELEMS * 1e9)
+
+
+def choose_format(kernel, batch_size=64, measure=True, iterations=50):
+	"""Pick the cheapest candidate format for one layer. Returns (fmt, {fmt: cost_seconds})."""
+	costs = {}
+	candidates = candidate_formats(kernel)
+	if measure and len(candidates) > 1:
+		from quantization.benchmark import make_batch, time_calls
+
+		x = make_batch(np.random.default_rng(0).standard_normal((batch_size, kernel.shape[0])).astype(np.float32),
+			       batch_size)
+		for fmt in candidates:
+			latencies, _ = time_calls(make_linear(kernel, fmt), x, warmup=5, iterations=iterations)
+			costs[fmt] = float(np.median(latencies)) / 1e9
+	else:
+		costs = {fmt: estimate_cost(kernel, fmt, batch_size) for fmt in candidates}
+	return min(costs, key=costs.get), costs
+
+
+# Neuron-level shrinking
+def shrink(spec):
+	"""Physically remove dead neurons from an int8_engine float spec.
+
+	A hidden neuron with an all-zero incoming column always outputs act(bias); that
+	constant is folded into every consumer's bias and the neuron is deleted. A neuron no
+	consumer reads (all-zero outgoing rows) is deleted outright. Input features no first-
+	layer weight reads are dropped and reported as `input_keep`.
+	Returns (shrunk_spec, input_keep, removed_per_layer).
+	"""
+	hidden = [dict(l, kernel=l['kernel'].copy(), bias=l['bias'].copy()) for l in spec['hidden']]
+	heads = [dict(l, kernel=l['kernel'].copy(), bias=l['bias'].copy()) for l in spec['heads']]
+	removed = {l['name']: 0 for l in hidden}
+
+	changed = True
+	while changed:
+		changed = False
+		for i, layer in enumerate(hidden):
+			consumers = [hidden[i + 1]] if i + 1 < len(hidden) else heads
+			dead_in = ~np.any(layer['kernel'] != 0, axis=0)
+			unread = np.all([~np.any(c['kernel'] != 0, axis=1) for c in consumers], axis=0)
+			drop = dead_in | unread
+			if not drop.any() or drop.all():
+				continue
+			const = FLOAT_ACTIVATIONS[layer['activation']](layer['bias'][dead_in & ~unread])
+			for c in consumers:
+				c['bias'] = c['bias'] + const @ c['kernel'][dead_in & ~unread]
+				c['kernel'] = c['kernel'][~drop]
+			layer['kernel'] = layer['kernel'][:, ~drop]
+			layer['bias'] = layer['bias'][~drop]
+			removed[layer['name']] += int(drop.sum())
+			changed = True
+
+	input_keep = np.nonzero(np.any(hidden[0]['kernel'] != 0, axis=1))[0] if hidden else None
+	if input_keep is not None and len(input_keep) == hidden[0]['kernel'].shape[0]:
+		input_keep = None
+	elif input_keep is not None:
+		hidden[0]['kernel'] = hidden[0]['kernel'][input_keep]
+	return {'hidden': hidden, 'heads': heads}, input_keep, removed
+
+
+# Executable sparse model
+class SparseMLP(object):
+	"""Student MLP with a per-layer execution format chosen by the cost model."""
+
+	def __init__(self, layers, heads, input_keep=None, costs=None, removed=None):
+		self.layers = layers        # [(name, linear_op, bias, activation)]
+		self.heads = heads          # [(name, linear_op, bias, activation)]
+		self.input_keep = input_keep
+		self.costs = costs or {}
+		self.removed = removed or {}
+
+	@classmethod
+	def from_spec(cls, spec, batch_size=64, measure=True, formats=None, shrink_neurons=True):
+		"""Plan and build a sparse model. `formats` may force {layer_name: fmt}."""
+		removed = {}
+		input_keep = None
+		if shrink_neurons:
+			spec, input_keep, removed = shrink(spec)
+		formats = formats or {}
+		costs = {}
+
+		def build(layer):
+			fmt = formats.get(layer['name'])
+			if fmt is None:
+				fmt, costs[layer['name']] = choose_format(layer['kernel'], batch_size, measure)
+			return (layer['name'], make_linear(layer['kernel'], fmt), layer['bias'].astype(np.float32),
+				layer['activation'])
+
+		return cls([build(l) for l in spec['hidden']], [build(l) for l in spec['heads']],
+			   input_keep, costs, removed)
+
+	def forward(self, x):
+		h = np.asarray(x, dtype=np.float32)
+		if self.input_keep is not None:
+			h = h[:, self.input_keep]
+		for _, op, bias, activation in self.layers:
+			h = FLOAT_ACTIVATIONS[activation](op(h) + bias)
+		outputs = {name: FLOAT_ACTIVATIONS[activation](op(h) + bias) for name, op, bias, activation in self.heads}
+		if 'prob_logits' in outputs:
+			outputs['conv_prob'] = sigmoid(outputs['prob_logits'])
+		return outputs
+
+	@property
+	def nbytes(self):
+		return sum(op.nbytes + bias.nbytes for _, op, bias, _ in self.layers + self.heads)
+
+	def describe(self):
+		print(f"{'Layer':<14} | {'Shape':<10} | {'Removed':>7} | {'Format':<7} | Costs (us)")
+		print('-' * 80)
+		for name, op, _, _ in self.layers + self.heads:
+			shape = f'{op.shape[0]}x{op.shape[1]}'
+			costs = ', '.join(f'{k}={v * 1e6:.1f}' for k, v in self.costs.get(name, {}).items())
+			print(f"{name:<14} | {shape:<10} | {self.removed.get(name, 0):>7} | {op.fmt:<7} | {costs}")
+		print(f'Weights: {self.nbytes / 1024:.1f} KB')
+
+	# Export
+	def save(self, path):
+		"""Save as a single .npz (arrays) with the layer plan in a JSON metadata entry."""
+		arrays, meta = {}, {'layers': [], 'heads': [], 'input_keep': None}
+		if self.input_keep is not None:
+			arrays['input_keep'] = self.input_keep
+			meta['input_keep'] = True
+		for group in ('layers', 'heads'):
+			for i, (name, op, bias, activation) in enumerate(getattr(self, group)):
+				prefix = f'{group}.{i}.'
+				for k, v in op.arrays().items():
+					arrays[prefix + k] = v
+				arrays[prefix + 'bias'] = bias
+				meta[group].append({'name': name, 'fmt': op.fmt, 'shape': list(op.shape), 'activation': activation,
+						    'keys': list(op.arrays())})
+		arrays['__meta__'] = np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)
+		np.savez(path, **arrays)
+
+	@classmethod
+	def load(cls, path):
+		data = np.load(path)
+		meta = json.loads(bytes(data['__meta__']).decode())
+		groups = {}
+		for group in ('layers', 'heads'):
+			groups[group] = []
+			for i, m in enumerate(meta[group]):
+				prefix = f'{group}.{i}.'
+				op = _linear_from_arrays(m['fmt'], {k: data[prefix + k] for k in m['keys']}, m['shape'])
+				groups[group].append((m['name'], op, data[prefix + 'bias'], m['activation']))
+		input_keep = data['input_keep'] if meta['input_keep'] else None
+		return cls(groups['layers'], groups['heads'], input_keep)
@@ -0,0 +1,278 @@
+"""
+Z-score importance pruning engine for the z_prune config (pruning_v2.py)
+
+Based on "Z-Pruner: Post-Training Pruning of Large Language Models for Efficiency
+without Retraining" (https://arxiv.org/html/2508.15828v1).
+
+For every Dense kernel W (in, out):
+	1. row / column L2 normalization:  |W| / ||W_row|| + |W| / ||W_col||
+	2. weight by the RMS of each input feature (activation_measurement), Wanda-style
+	3. per-layer z-score, then signed amplification sign(z) * |z|^p
+	4. scale by the layer-type multiplier (attention / ffn / embedding)
+
+Activation statistics come from forward hooks that keep running means of the squared
+inputs / outputs of each layer instead of storing activations, snapshotted at every
+num_samples value of the sweep so one pass serves [64, 128, 256].
+
+Scores for all layers are computed together on one flat vector (per-layer z-score
+statistics via segment reductions), and each layer is ranked once; masks for every
+sparsity_ratio are then just rank thresholds, so a whole sweep is one sort per mode.
+
+Pruning modes:
+	'global'  rank across the entire weight matrix of each layer (as in the config)
+	'neuron'  rank within each output neuron's incoming weights
+	'model'   rank across all layers at once; the only mode where the amplification
+		  power and layer multipliers change which weights survive
+
+Usage:
+	stats = collect_activation_stats(spec_hooked_forward(spec), batches, checkpoints=[64, 128, 256])
+	for params, masks in sweep_masks(kernels_of(spec), stats, z_prune_config):
+		pruned = apply_masks(spec, masks)
+"""
+
+import itertools
+import numpy as np
+
+
+DEFAULT_EPS = 1e-8
+LAYER_TYPES = ('attention_layers', 'ffn_layers', 'embedding_layers')
+
+
+# Activation statistics
+class ActivationStats(object):
+	"""Running means of squared layer inputs / outputs, per feature, for every hooked layer."""
+
+	def __init__(self):
+		self.count = 0
+		self.in_sq = {}
+		self.out_sq = {}
+
+	def hook(self, name, inputs, outputs):
+		"""Forward hook: fold one batch of a layer's inputs / outputs into the running means."""
+		n = len(inputs)
+		total = self.count + n
+		for store, x in ((self.in_sq, inputs), (self.out_sq, outputs)):
+			batch_mean = np.mean(np.square(x, dtype=np.float64), axis=0)
+			if name not in store:
+				store[name] = batch_mean
+			else:
+				store[name] += (batch_mean - store[name]) * (n / total)
+
+	def input_norms(self):
+		return {k: np.sqrt(v) for k, v in self.in_sq.items()}
+
+	def output_norms(self):
+		return {k: np.sqrt(v) for k, v in self.out_sq.items()}
+
+	def snapshot(self):
+		snap = ActivationStats()
+		snap.count = self.count
+		snap.in_sq = {k: v.copy() for k, v in self.in_sq.items()}
+		snap.out_sq = {k: v.copy() for k, v in self.out_sq.items()}
+		return snap
+
+
+def spec_hooked_forward(spec):
+	"""Forward pass over an int8_engine float spec that calls hook(name, inputs, outputs) per Dense layer."""
+	from quantization.int8_engine import FLOAT_ACTIVATIONS
+
+	def forward(x, hook):
+		h = np.asarray(x, dtype=np.float32)
+		for layer in spec['hidden']:
+			pre = h @ layer['kernel'] + layer['bias']
+			hook(layer['name'], h, pre)
+			h = FLOAT_ACTIVATIONS[layer['activation']](pre)
+		for head in spec['heads']:
+			hook(head['name'], h, h @ head['kernel'] + head['bias'])
+	return forward
+
+
+def keras_hooked_forward(model):
+	"""Same hook protocol for a Keras model: one probe forward pass returns every Dense input / output."""
+	import tensorflow as tf
+
+	dense = [l for l in model.layers if l.__class__.__name__ == 'Dense']
+	probe = tf.keras.Model(inputs=model.inputs, outputs=[(l.input, l.output) for l in dense])
+
+	def forward(x, hook):
+		for layer, (inputs, outputs) in zip(dense, probe(x, training=False)):
+			hook(layer.name, np.asarray(inputs), np.asarray(outputs))
+	return forward
+
+
+def collect_activation_stats(forward, batches, checkpoints):
+	"""Run inference-only forward passes until max(checkpoints) samples, snapshotting at each checkpoint.
+
+	Returns {num_samples: ActivationStats}.
+	"""
+	checkpoints = sorted(checkpoints)
+	stats = ActivationStats()
+	snapshots = {}
+	for batch in batches:
+		remaining = checkpoints[-1] - stats.count
+		# split the batch at checkpoint boundaries so each snapshot sees exactly num_samples rows
+		while len(batch) and remaining > 0:
+			pending = [c for c in checkpoints if c > stats.count]
+			take = min(len(batch), pending[0] - stats.count)
+			forward(batch[:take], stats.hook)
+			stats.count += take
+			batch = batch[take:]
+			if stats.count in checkpoints:
+				snapshots[stats.count] = stats.snapshot()
+			remaining = checkpoints[-1] - stats.count
+		if remaining <= 0:
+			break
+	for c in checkpoints:
+		if c not in snapshots:
+			print(f'Warning: only {stats.count} samples available for num_samples={c}')
+			snapshots[c] = stats.snapshot()
+	return snapshots
+
+
+# Importance scores
+def default_layer_type(name):
+	lowered = name.lower()
+	if 'emb' in lowered:
+		return 'embedding_layers'
+	if 'attn' in lowered or 'attention' in lowered:
+		return 'attention_layers'
+	return 'ffn_layers'
+
+
+def normalized_magnitudes(kernels, input_norms=None, row_wise=True, column_wise=True, eps=DEFAULT_EPS):
+	"""Steps 1-2: row/column L2-normalized |W|, optionally scaled by input RMS. One flat vector."""
+	parts = []
+	for name, w in kernels.items():
+		a = np.abs(w).astype(np.float64)
+		base = np.zeros_like(a)
+		if row_wise:
+			base += a / (np.sqrt(np.square(a).sum(axis=1, keepdims=True)) + eps)
+		if column_wise:
+			base += a / (np.sqrt(np.square(a).sum(axis=0, keepdims=True)) + eps)
+		if not (row_wise or column_wise):
+			base = a
+		if input_norms is not None and name in input_norms:
+			base *= input_norms[name][:, None]
+		parts.append(base.ravel())
+	return np.concatenate(parts)
+
+
+def importance_scores(kernels, input_norms=None, power=3.0, multipliers=None, layer_type=default_layer_type,
+		      row_wise=True, column_wise=True, eps=DEFAULT_EPS):
+	"""Z-Pruner importance for every layer in one vectorized pass. Returns {name: scores (in, out)}."""
+	names = list(kernels)
+	sizes = np.array([kernels[n].size for n in names])
+	offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+	flat = normalized_magnitudes(kernels, input_norms, row_wise, column_wise, eps)
+
+	# per-layer z-scores via segment sums on the flat vector
+	seg = np.repeat(np.arange(len(names)), sizes)
+	mean = np.add.reduceat(flat, offsets) / sizes
+	var = np.add.reduceat(np.square(flat - mean[seg]), offsets) / sizes
+	z = (flat - mean[seg]) / (np.sqrt(var[seg]) + eps)
+
+	scores = np.sign(z) * np.abs(z) ** power
+	if multipliers:
+		scale = np.array([multipliers.get(layer_type(n), 1.0) for n in names])
+		scores *= scale[seg]
+
+	return {n: scores[o:o + s].reshape(kernels[n].shape) for n, o, s in zip(names, offsets, sizes)}
+
+
+# Masks
+def masks_for_ratios(scores, ratios, mode='global'):
+	"""Keep-masks for every sparsity ratio from a single ranking. Returns {ratio: {name: bool mask}}."""
+	out = {r: {} for r in ratios}
+	if mode == 'model':
+		names = list(scores)
+		flat = np.concatenate([scores[n].ravel() for n in names])
+		rank = np.empty(flat.size, dtype=np.int64)
+		rank[np.argsort(flat, kind='stable')] = np.arange(flat.size)
+		offset = 0
+		for n in names:
+			layer_rank = rank[offset:offset + scores[n].size].reshape(scores[n].shape)
+			for r in ratios:
+				out[r][n] = layer_rank >= int(r * flat.size)
+			offset += scores[n].size
+		return out
+
+	for n, s in scores.items():
+		if mode == 'global':
+			rank = np.empty(s.size, dtype=np.int64)
+			rank[np.argsort(s.ravel(), kind='stable')] = np.arange(s.size)
+			rank = rank.reshape(s.shape)
+			for r in ratios:
+				out[r][n] = rank >= int(r * s.size)
+		elif mode == 'neuron':
+			# rank each output neuron's (column's) incoming weights independently
+			rank = np.argsort(np.argsort(s, axis=0, kind='stable'), axis=0)
+			for r in ratios:
+				out[r][n] = rank >= int(r * s.shape[0])
+		else:
+			raise ValueError(f'Unknown pruning mode: {mode}')
+	return out
+
+
+def apply_masks(spec, masks):
+	"""Copy of an int8_engine float spec with pruned kernels zeroed."""
+	def prune(layer):
+		layer = dict(layer)
+		if layer['name'] in masks:
+			layer['kernel'] = layer['kernel'] * masks[layer['name']]
+		return layer
+	return {'hidden': [prune(l) for l in spec['hidden']], 'heads': [prune(l) for l in spec['heads']]}
+
+
+def kernels_of(spec, include_heads=False):
+	layers = spec['hidden'] + (spec['heads'] if include_heads else [])
+	return {l['name']: l['kernel'] for l in layers}
+
+
+def sparsity(masks):
+	kept = sum(int(m.sum()) for m in masks.values())
+	total = sum(m.size for m in masks.values())
+	return 1.0 - kept / total if total else 0.0
+
+
+# Sweep
+def _as_list(v):
+	return v if isinstance(v, list) else [v]
+
+
+def sweep_masks(kernels, stats_by_samples, config, layer_type=default_layer_type):
+	"""Yield (params, masks) for the whole z_prune sweep.
+
+	Scores are computed once per (num_samples, power, ffn multiplier); every pruning mode
+	ranks once and serves all sparsity ratios.
+	"""
+	norm = config.get('weight_normalization', {})
+	z_cfg = config.get('z_score', {})
+	powers = _as_list(z_cfg.get('amplification_power', 3.0)) if z_cfg.get('cubic_amplification', True) else [1.0]
+	mult_cfg = config.get('layer_importance_multipliers', {})
+	mult_axes = [(k, _as_list(mult_cfg[k])) for k in LAYER_TYPES if k in mult_cfg]
+	ratios = _as_list(config['sparsity_ratio'])
+	modes = _as_list(config.get('pruning_mode', 'global'))
+
+	for num_samples, stats in sorted(stats_by_samples.items()):
+		input_norms = stats.input_norms() if stats is not None else None
+		# within a single layer, amplification and multipliers are monotone, so 'global' and
+		# 'neuron' masks only depend on num_samples; rank those once and reuse them
+		per_layer = {}
+		for power in powers:
+			for mult_values in itertools.product(*[v for _, v in mult_axes]):
+				multipliers = {k: v for (k, _), v in zip(mult_axes, mult_values)}
+				scores = importance_scores(kernels, input_norms, power, multipliers, layer_type,
+							   norm.get('row_wise_l2', True), norm.get('column_wise_l2', True),
+							   norm.get('epsilon', DEFAULT_EPS))
+				for mode in modes:
+					if mode == 'model':
+						by_ratio = masks_for_ratios(scores, ratios, mode)
+					else:
+						if mode not in per_layer:
+							per_layer[mode] = masks_for_ratios(scores, ratios, mode)
+						by_ratio = per_layer[mode]
+					for ratio, masks in by_ratio.items():
+						params = {'num_samples': num_samples, 'amplification_power': power,
+							  'pruning_mode': mode, 'sparsity_ratio': ratio}
+						params.update(multipliers)
+						yield params, masks
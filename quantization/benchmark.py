@@ -0,0 +1,164 @@
+"""
+benchmark.py
+------------
+Latency / throughput benchmark harness for the FP32, PTQ and QAT students.
+
+The old measure_latency timed a single call after a single warmup, which is
+mostly noise. Here every configuration gets a configurable warmup followed by
+many timed iterations (perf_counter_ns), and we report mean / p50 / p90 / p99 /
+p99.9 latency plus QPS for a sweep of batch sizes and concurrent caller threads.
+Results are written as JSON so runs on different machines / commits can be diffed.
+
+Usage (from the repo root):
+
+    from quantization.benchmark import benchmark_models, write_results
+    results = benchmark_models({"fp32": fp32_fn, "ptq": ptq_fn}, x_test)
+    write_results(results, "latency_benchmark.json")
+
+`fn` is any callable taking a NumPy batch, e.g. `lambda x: model(x, training=False)`.
+"""
+
+import json
+import os
+import platform
+import threading
+import time
+import numpy as np
+
+
+# Defaults
+DEFAULT_BATCH_SIZES = (1, 8, 64, 512)
+DEFAULT_THREAD_COUNTS = (1, 2, 4)
+DEFAULT_WARMUP = 20
+DEFAULT_ITERATIONS = 500
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+
+# Helper Functions
+def make_batch(x_pool, batch_size):
+    """Build a contiguous batch of `batch_size` rows, cycling through x_pool if it is too small."""
+    idx = np.arange(batch_size) % len(x_pool)
+    return np.ascontiguousarray(x_pool[idx])
+
+
+def latency_summary(latencies_ns, batch_size, wall_ns):
+    """Summary statistics (ms) and throughput for one benchmark configuration."""
+    lat_ms = np.asarray(latencies_ns, dtype=np.float64) / 1e6
+    summary = {
+        "iterations": int(lat_ms.size),
+        "mean_ms": float(lat_ms.mean()),
+        "std_ms": float(lat_ms.std()),
+        "min_ms": float(lat_ms.min()),
+        "max_ms": float(lat_ms.max()),
+    }
+    for p in PERCENTILES:
+        summary[f"p{p:g}_ms"] = float(np.percentile(lat_ms, p))
+    summary["per_sample_p50_ms"] = summary["p50_ms"] / batch_size
+    # QPS counts samples (not calls) per second of wall-clock time across all threads
+    summary["qps"] = float(lat_ms.size * batch_size / (wall_ns / 1e9)) if wall_ns > 0 else 0.0
+    return summary
+
+
+def time_calls(fn, batch, warmup=DEFAULT_WARMUP, iterations=DEFAULT_ITERATIONS, num_threads=1):
+    """Time `iterations` calls of fn(batch) on each of `num_threads` concurrent threads.
+
+    Returns (latencies_ns, wall_ns). Warmup runs once on the calling thread so
+    graph tracing / allocator growth is not counted.
+    """
+    for _ in range(warmup):
+        fn(batch)
+
+    per_thread = [[] for _ in range(num_threads)]
+    errors = []
+    barrier = threading.Barrier(num_threads + 1)
+
+    def worker(out):
+        timer = time.perf_counter_ns
+        barrier.wait()
+        try:
+            for _ in range(iterations):
+                start = timer()
+                fn(batch)
+                out.append(timer() - start)
+        except BaseException as e:
+            # surfaced on the calling thread; a short latency list would skew the percentiles
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(out,)) for out in per_thread]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    wall_start = time.perf_counter_ns()
+    for t in threads:
+        t.join()
+    wall_ns = time.perf_counter_ns() - wall_start
+    if errors:
+        raise errors[0]
+
+    latencies = np.concatenate([np.asarray(out, dtype=np.int64) for out in per_thread])
+    return latencies, wall_ns
+
+
+def benchmark(fn, x_pool, batch_sizes=DEFAULT_BATCH_SIZES, thread_counts=DEFAULT_THREAD_COUNTS,
+              warmup=DEFAULT_WARMUP, iterations=DEFAULT_ITERATIONS):
+    """Sweep batch sizes x thread counts for a single model. Returns a list of result rows."""
+    rows = []
+    for batch_size in batch_sizes:
+        batch = make_batch(x_pool, batch_size)
+        for num_threads in thread_counts:
+            latencies, wall_ns = time_calls(fn, batch, warmup, iterations, num_threads)
+            row = {"batch_size": int(batch_size), "threads": int(num_threads)}
+            row.update(latency_summary(latencies, batch_size, wall_ns))
+            rows.append(row)
+    return rows
+
+
+def benchmark_models(models, x_pool, batch_sizes=DEFAULT_BATCH_SIZES, thread_counts=DEFAULT_THREAD_COUNTS,
+                     warmup=DEFAULT_WARMUP, iterations=DEFAULT_ITERATIONS):
+    """Benchmark a dict of {name: fn}. Returns a JSON-serializable dict with run metadata."""
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "warmup": warmup,
+            "iterations": iterations,
+            "batch_sizes": list(batch_sizes),
+            "thread_counts": list(thread_counts),
+        },
+        "results": {},
+    }
+    for name, fn in models.items():
+        print(f"Benchmarking {name} ...")
+        results["results"][name] = benchmark(fn, x_pool, batch_sizes, thread_counts, warmup, iterations)
+    return results
+
+
+def lookup(results, name, batch_size=1, threads=1, key="p50_ms"):
+    """Pull one statistic out of a benchmark_models result."""
+    for row in results["results"][name]:
+        if row["batch_size"] == batch_size and row["threads"] == threads:
+            return row[key]
+    raise KeyError(f"No result for {name} at batch_size={batch_size}, threads={threads}")
+
+
+def write_results(results, path):
+    """Write benchmark results as pretty-printed JSON (stable key order so runs diff cleanly)."""
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(f"Benchmark results written to {path}")
+
+
+def print_table(results):
+    """Print a compact summary table of a benchmark_models result."""
+    print(f"{'Model':<8} | {'Batch':>5} | {'Thr':>3} | {'p50 ms':>8} | {'p90 ms':>8} | "
+          f"{'p99 ms':>8} | {'p99.9 ms':>8} | {'QPS':>10}")
+    print("-" * 80)
+    for name, rows in results["results"].items():
+        for r in rows:
+            print(f"{name:<8} | {r['batch_size']:>5} | {r['threads']:>3} | {r['p50_ms']:>8.3f} | "
+                  f"{r['p90_ms']:>8.3f} | {r['p99_ms']:>8.3f} | {r['p99.9_ms']:>8.3f} | {r['qps']:>10.0f}")
@@ -0,0 +1,304 @@
+"""
+calibration.py
+--------------
+Streaming PTQ calibration with bounded-memory range observers.
+
+The ptq block in quantization_v1.py asks for 5000 calibration_samples and
+quantization_eval.py loads the whole calibration set with np.load(...).item().
+Here the representative dataset is streamed in chunks (memory-mapped .npy files,
+a directory of .npy shards, or any iterable of arrays) and every layer gets one
+HistogramObserver that tracks, in O(bins) memory:
+
+    - running min / max                 -> "minmax" ranges
+    - a fixed-size, re-binnable histogram -> "percentile" and "mse" ranges
+
+so the calibration set can grow to millions of rows, and all three range-estimation
+methods come out of a single pass over the data and can be compared on quality
+(compare_methods). The MSE search runs over the grid each tensor is quantized to by
+int8_engine.py: symmetric int8 for the input, uint8 from 0 for the post-ReLU hidden
+layers (engine_ranges), or asymmetric int8 for the generic qparam tables.
+
+calibrate and compare_methods read chunk_rows / histogram_bins / range_method /
+percentile from config= (ptq.parameters.calibration in quantization_v1.py); explicit
+arguments take precedence.
+
+Usage (from the repo root):
+    spec = extract_keras_layers(student_model)
+    settings = calibration_settings(quantization()["ptq"]["parameters"]["calibration"])
+    observers = calibrate(spec_activation_fn(spec),
+                          iter_calibration_chunks("data/calib_x.npy", settings["chunk_rows"]), config=settings)
+    tables = {m: qparam_table(observers, m, settings["percentile"]) for m in settings["range_method"]}
+    engine = Int8MLP.build(spec, ranges=engine_ranges(observers, "mse"))
+"""
+
+import json
+import os
+import numpy as np
+
+from quantization.int8_engine import FLOAT_ACTIVATIONS, INT8_MAX, UINT8_MAX, Int8MLP, fp32_forward
+
+
+RANGE_METHODS = ("minmax", "percentile", "mse")
+DEFAULT_BINS = 2048
+DEFAULT_PERCENTILE = 99.99
+DEFAULT_CHUNK_ROWS = 8192
+MSE_CANDIDATES = 128
+INT8_QMIN, INT8_QMAX = -128, 127
+GRIDS = ("asymmetric", "symmetric", "unsigned")
+
+
+
+def calibration_settings(config=None):
+    """ptq.parameters.calibration with the module defaults filled in; range_method as a tuple."""
+    config = config or {}
+    methods = config.get("range_method", RANGE_METHODS)
+    return {
+        "chunk_rows": config.get("chunk_rows", DEFAULT_CHUNK_ROWS),
+        "range_method": tuple(methods) if isinstance(methods, (list, tuple)) else (methods,),
+        "histogram_bins": config.get("histogram_bins", DEFAULT_BINS),
+        "percentile": config.get("percentile", DEFAULT_PERCENTILE),
+    }
+
+
+
+# Data streaming
+def _iter_array_chunks(array, chunk_rows):
+    for start in range(0, len(array), chunk_rows):
+        yield np.asarray(array[start:start + chunk_rows], dtype=np.float32)
+
+
+def iter_calibration_chunks(source, chunk_rows=DEFAULT_CHUNK_ROWS, max_samples=None, key="x"):
+    """Yield float32 chunks of calibration features without loading the full set.
+
+    `source` may be an array, a .npy file (memory-mapped), a directory of .npy shards,
+    or an iterable of arrays. Legacy pickled {"x": ..., "y": ...} .npy files cannot be
+    memory-mapped and are loaded whole (with a warning).
+    """
+    if isinstance(source, np.ndarray):
+        arrays = [source]
+    elif isinstance(source, (str, os.PathLike)):
+        if os.path.isdir(source):
+            paths = sorted(os.path.join(source, f) for f in os.listdir(source) if f.endswith(".npy"))
+        else:
+            paths = [source]
+        arrays = (_load_npy(p, key) for p in paths)
+    else:
+        arrays = source
+
+    seen = 0
+    for array in arrays:
+        for chunk in _iter_array_chunks(array, chunk_rows):
+            if max_samples is not None:
+                if seen >= max_samples:
+                    return
+                chunk = chunk[:max_samples - seen]
+            seen += len(chunk)
+            yield chunk
+
+
+def _load_npy(path, key):
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        print(f"Warning: {path} is a pickled object array and will be loaded into memory; "
+              f"save the features as a plain .npy to stream it")
+        return np.load(path, allow_pickle=True).item()[key]
+
+
+
+# Observers
+def qparams(lo, hi, qmin=INT8_QMIN, qmax=INT8_QMAX, symmetric=False):
+    """Scale / zero point covering [lo, hi] (always widened to include 0)."""
+    lo, hi = min(float(lo), 0.0), max(float(hi), 0.0)
+    if symmetric:
+        absmax = max(-lo, hi)
+        scale = absmax / qmax if absmax > 0 else 1.0
+        return scale, 0
+    scale = (hi - lo) / (qmax - qmin) if hi > lo else 1.0
+    zero_point = int(np.clip(np.round(qmin - lo / scale), qmin, qmax))
+    return scale, zero_point
+
+
+class HistogramObserver(object):
+    """Running min/max plus a fixed-bin histogram that is re-binned when the range grows."""
+
+    def __init__(self, bins=DEFAULT_BINS):
+        self.bins = bins
+        self.hist = None
+        self.lo = self.hi = None       # histogram range (may be wider than min/max)
+        self.min = self.max = None
+        self.count = 0
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float32).ravel()
+        x = x[np.isfinite(x)]
+        if x.size == 0:
+            return
+        lo, hi = float(x.min()), float(x.max())
+        self.min = lo if self.min is None else min(self.min, lo)
+        self.max = hi if self.max is None else max(self.max, hi)
+        self.count += x.size
+
+        if self.hist is None:
+            self.lo, self.hi = lo, hi if hi > lo else lo + 1e-8
+            self.hist = np.zeros(self.bins, dtype=np.float64)
+        elif lo < self.lo or hi > self.hi:
+            self._expand(lo, hi)
+        self.hist += np.histogram(x, self.bins, (self.lo, self.hi))[0]
+
+    def _expand(self, lo, hi):
+        # grow geometrically so a slowly drifting range doesn't re-bin on every chunk
+        width = self.hi - self.lo
+        new_lo = min(self.lo, lo - 0.25 * width) if lo < self.lo else self.lo
+        new_hi = max(self.hi, hi + 0.25 * width) if hi > self.hi else self.hi
+        edges = np.linspace(self.lo, self.hi, self.bins + 1)
+        centers = 0.5 * (edges[:-1] + edges[1:])
+        self.hist = np.histogram(centers, self.bins, (new_lo, new_hi), weights=self.hist)[0]
+        self.lo, self.hi = new_lo, new_hi
+
+    def _centers(self):
+        edges = np.linspace(self.lo, self.hi, self.bins + 1)
+        return edges, 0.5 * (edges[:-1] + edges[1:])
+
+    def percentile_range(self, percentile=DEFAULT_PERCENTILE):
+        edges, _ = self._centers()
+        cdf = np.concatenate([[0.0], np.cumsum(self.hist)]) / self.hist.sum()
+        lo = np.interp((100.0 - percentile) / 100.0, cdf, edges)
+        hi = np.interp(percentile / 100.0, cdf, edges)
+        return max(float(lo), self.min), min(float(hi), self.max)
+
+    def mse_range(self, grid="asymmetric", candidates=MSE_CANDIDATES):
+        """Clipping range minimizing expected (clipping + rounding) error over the histogram.
+
+        grid is the integer grid the tensor is quantized to: "asymmetric" int8 (qmin..qmax
+        with a zero point), "symmetric" int8 (+-127, the engine's input) or "unsigned"
+        uint8 from 0 (the engine's post-ReLU activations).
+        """
+        _, centers = self._centers()
+        p = self.hist / self.hist.sum()
+        shrink = np.linspace(1.0 / candidates, 1.0, candidates)[:, None]
+        if grid == "symmetric":
+            hi = max(-self.min, self.max, 0.0) * shrink
+            lo = -hi
+            scale = hi / INT8_MAX
+        elif grid == "unsigned":
+            hi = max(self.max, 0.0) * shrink
+            lo = np.zeros_like(hi)
+            scale = hi / UINT8_MAX
+        elif grid == "asymmetric":
+            lo = np.minimum(self.min, 0.0) * shrink
+            hi = np.maximum(self.max, 0.0) * shrink
+            scale = (hi - lo) / (INT8_QMAX - INT8_QMIN)
+        else:
+            raise ValueError(f"Unknown quantization grid: {grid}")
+        scale = np.maximum(scale, 1e-12)
+        clipped = np.clip(centers[None, :], lo, hi)
+        err = (centers[None, :] - clipped) ** 2 + scale ** 2 / 12.0   # clip error + uniform rounding noise
+        best = int(np.argmin((err * p[None, :]).sum(axis=1)))
+        return float(lo[best, 0]), float(hi[best, 0])
+
+    def range(self, method="minmax", percentile=DEFAULT_PERCENTILE, grid="asymmetric"):
+        if self.hist is None:
+            raise ValueError("Observer has not seen any data")
+        if method == "minmax":
+            return self.min, self.max
+        if method == "percentile":
+            return self.percentile_range(percentile)
+        if method == "mse":
+            return self.mse_range(grid)
+        raise ValueError(f"Unknown range method: {method}")
+
+
+
+# Calibration
+def spec_activation_fn(spec):
+    """Activations of an extracted float spec (int8_engine.extract_keras_layers) per layer."""
+    def fn(x):
+        acts = {"input": x}
+        h = x
+        for layer in spec["hidden"]:
+            h = FLOAT_ACTIVATIONS[layer["activation"]](h @ layer["kernel"] + layer["bias"])
+            acts[layer["name"]] = h
+        return acts
+    return fn
+
+
+def keras_activation_fn(model, layer_names):
+    """Activations of named Keras layers from a single multi-output forward pass."""
+    import tensorflow as tf
+
+    probe = tf.keras.Model(inputs=model.inputs, outputs={n: model.get_layer(n).output for n in layer_names})
+
+    def fn(x):
+        acts = {k: np.asarray(v) for k, v in probe(x, training=False).items()}
+        acts["input"] = x
+        return acts
+    return fn
+
+
+def calibrate(activation_fn, chunks, bins=None, config=None):
+    """One streaming pass: update a HistogramObserver per layer for every chunk."""
+    bins = bins or calibration_settings(config)["histogram_bins"]
+    observers = {}
+    rows = 0
+    for chunk in chunks:
+        for name, act in activation_fn(chunk).items():
+            observers.setdefault(name, HistogramObserver(bins)).update(act)
+        rows += len(chunk)
+    print(f"Calibrated {len(observers)} tensors on {rows} samples")
+    return observers
+
+
+def qparam_table(observers, method="minmax", percentile=DEFAULT_PERCENTILE, symmetric=False):
+    """{layer: {"min", "max", "scale", "zero_point"}} for one range method."""
+    table = {}
+    for name, obs in observers.items():
+        lo, hi = obs.range(method, percentile, "symmetric" if symmetric else "asymmetric")
+        scale, zero_point = qparams(lo, hi, symmetric=symmetric)
+        table[name] = {"min": lo, "max": hi, "scale": scale, "zero_point": zero_point}
+    return table
+
+
+def engine_ranges(observers, method="minmax", percentile=DEFAULT_PERCENTILE):
+    """Ranges in the form Int8MLP.build expects: input absmax, hidden-layer max."""
+    ranges = {}
+    for name, obs in observers.items():
+        # searched on the grid the engine uses: symmetric int8 input, uint8 post-ReLU layers
+        lo, hi = obs.range(method, percentile, "symmetric" if name == "input" else "unsigned")
+        ranges[name] = max(-lo, hi) if name == "input" else max(hi, 0.0)
+    return ranges
+
+
+def write_tables(tables, path):
+    with open(path, "w") as f:
+        json.dump(tables, f, indent=2, sort_keys=True)
+    print(f"Quantization tables written to {path}")
+
+
+
+# Quality comparison
+def poisson_log_loss(y, pred, eps=1e-7):
+    """Same definition as tf.keras.metrics.Poisson: mean(pred - y * log(pred + eps))."""
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    pred = np.asarray(pred, dtype=np.float64).reshape(-1)
+    return float(np.mean(pred - y * np.log(pred + eps)))
+
+
+def compare_methods(spec, observers, x_eval, y_eval, methods=None, percentile=None, config=None):
+    """Build one INT8 engine per range method and report PLL vs. the FP32 reference."""
+    settings = calibration_settings(config)
+    methods = methods or settings["range_method"]
+    percentile = percentile or settings["percentile"]
+    ref = fp32_forward(spec, x_eval)["conv_value"]
+    rows = [{"method": "fp32", "pll": poisson_log_loss(y_eval, ref), "max_abs_diff": 0.0}]
+    for method in methods:
+        engine = Int8MLP.build(spec, ranges=engine_ranges(observers, method, percentile))
+        pred = engine.predict(x_eval)["conv_value"]
+        rows.append({"method": method, "pll": poisson_log_loss(y_eval, pred),
+                     "max_abs_diff": float(np.abs(pred - ref).max())})
+
+    print(f"{'Method':<12} | {'PLL':>10} | {'Max |diff|':>10}")
+    print("-" * 38)
+    for r in rows:
+        print(f"{r['method']:<12} | {r['pll']:>10.5f} | {r['max_abs_diff']:>10.5f}")
+    return rows
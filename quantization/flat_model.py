@@ -0,0 +1,312 @@
+"""
+flat_model.py
+-------------
+Zero-copy flat file format for the student's NumPy runtimes (int8_engine float specs
+and built Int8MLP engines).
+
+quantization_eval.py's load_model parses a SavedModel directory and the notebook writes
+.tflite blobs; both copy every weight into the process before the first prediction, so
+cold start and per-process RSS grow with the model. A flat file is instead:
+
+    - an 8-byte magic, a fixed little-endian preamble (version, header length, data
+      offset) and a JSON header with the layer graph and a tensor table
+      {name: dtype, shape, offset, nbytes}
+    - the raw weight / scale / bias blobs, each starting on a 64-byte boundary (cache
+      line and AVX-512 aligned), written once and never rewritten in place
+
+Loading maps the file read-only (mmap.ACCESS_READ) and wraps each tensor in a NumPy
+view with np.frombuffer: nothing is parsed or copied beyond the header, pages are read
+on first touch, and every serving process that opens the same file shares one copy of
+the weights through the page cache. The arrays are read-only, which the runtimes never
+need to violate.
+
+INT8 files store the engine exactly as built (quantized kernels, scales, int32 biases,
+fixed-point multipliers), so loading does not re-quantize or re-calibrate. By default
+they also store each layer's matmul operand (the float32 / int32 copy of the kernel
+that Int8Dense keeps), so that copy is shared too instead of being rebuilt per
+process; exec_weights=False keeps the file at INT8 size and rebuilds it on load. The
+footprint report lists the INT8 payload and the matmul operands separately, so the
+file size is not mistaken for the size of the quantized model.
+
+Usage (from the repo root):
+    save_flat("models/student_int8.kdflat", Int8MLP.build(spec, x_calib))
+    model = FlatModel.open("models/student_int8.kdflat")
+    outputs = model.engine.predict(x)      # Int8MLP, or model.spec for FP32 files
+    print_footprint(model)
+"""
+
+import json
+import mmap
+import os
+import struct
+import numpy as np
+
+from quantization.int8_engine import LAYER_STATE_ARRAYS, Int8Dense, Int8MLP, fp32_forward
+
+
+MAGIC = b"KDSFLAT1"
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct("<8sIIQ")   # magic, version, header bytes, data offset
+ALIGNMENT = 64
+KINDS = ("fp32", "int8")
+MB = 1024 * 1024
+
+
+
+# Helper Functions
+def _align(n, alignment=ALIGNMENT):
+    return (n + alignment - 1) // alignment * alignment
+
+
+class _TensorTable(object):
+    """Collects named arrays and assigns each an aligned offset in the data section."""
+
+    def __init__(self):
+        self.arrays = {}
+        self.entries = {}
+        self.size = 0
+
+    def add(self, name, array):
+        if name in self.entries:
+            raise ValueError(f"Duplicate tensor name: {name}")
+        array = np.ascontiguousarray(array)
+        offset = _align(self.size)
+        self.arrays[name] = array
+        self.entries[name] = {"dtype": array.dtype.str, "shape": list(array.shape),
+                              "offset": offset, "nbytes": int(array.nbytes)}
+        self.size = offset + array.nbytes
+        return name
+
+
+def _spec_graph(spec, table):
+    graph = {}
+    for group in ("hidden", "heads"):
+        graph[group] = []
+        for layer in spec[group]:
+            graph[group].append({
+                "name": layer["name"],
+                "activation": layer["activation"],
+                "kernel": table.add(f"{layer['name']}/kernel", np.asarray(layer["kernel"], dtype=np.float32)),
+                "bias": table.add(f"{layer['name']}/bias", np.asarray(layer["bias"], dtype=np.float32)),
+            })
+    return graph
+
+
+def _engine_graph(engine, table, exec_weights):
+    def layer_node(layer):
+        scalars, arrays = layer.state()
+        node = dict(scalars)
+        node["out_scale"] = None if layer.out_scale is None else float(layer.out_scale)
+        node["acc_bound"] = int(layer.acc_bound)
+        node["tensors"] = {k: table.add(f"{layer.name}/{k}", v) for k, v in arrays.items()}
+        if exec_weights:
+            node["tensors"]["exec"] = table.add(f"{layer.name}/exec", layer._w)
+        return node
+
+    return {
+        "input_scale": float(engine.input_scale),
+        "layers": [layer_node(l) for l in engine.layers],
+        "head": layer_node(engine.head),
+        "head_names": [[name, int(start), int(stop)] for name, start, stop in engine.head_names],
+        "head_activations": list(engine.head_activations),
+    }
+
+
+
+# Save
+def save_flat(path, model, exec_weights=True, metadata=None):
+    """Write a float spec (kind "fp32") or a built Int8MLP (kind "int8") as a flat file.
+
+    The file is staged next to `path` and renamed into place, so processes that still map
+    the previous version keep a consistent copy and new ones see the complete file.
+    """
+    table = _TensorTable()
+    if isinstance(model, Int8MLP):
+        kind, graph = "int8", _engine_graph(model, table, exec_weights)
+    else:
+        kind, graph = "fp32", _spec_graph(model, table)
+
+    header = {"kind": kind, "graph": graph, "tensors": table.entries,
+              "alignment": ALIGNMENT, "metadata": metadata or {}}
+    header_bytes = json.dumps(header, sort_keys=True).encode("utf-8")
+    data_offset = _align(PREAMBLE.size + len(header_bytes))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes), data_offset))
+        f.write(header_bytes)
+        for name, entry in table.entries.items():
+            f.seek(data_offset + entry["offset"])
+            f.write(table.arrays[name].tobytes())
+        f.truncate(data_offset + table.size)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_header(path):
+    """Header dict and data offset, read without mapping the weights."""
+    with open(path, "rb") as f:
+        magic, version, header_len, data_offset = PREAMBLE.unpack(f.read(PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path}: not a flat model file")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"{path}: unsupported format version {version}")
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    return header, data_offset
+
+
+
+# Load
+class FlatModel(object):
+    """A read-only memory-mapped flat model file with zero-copy NumPy views over its tensors."""
+
+    def __init__(self, path, header, data_offset, mm):
+        self.path = path
+        self.header = header
+        self.kind = header["kind"]
+        self.data_offset = data_offset
+        self._mm = mm
+        self.tensors = {name: self._view(entry) for name, entry in header["tensors"].items()}
+        self.spec = self._build_spec() if self.kind == "fp32" else None
+        self.engine = self._build_engine() if self.kind == "int8" else None
+
+    @classmethod
+    def open(cls, path):
+        header, data_offset = read_header(path)
+        if header["kind"] not in KINDS:
+            raise ValueError(f"{path}: unknown model kind {header['kind']}")
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)   # the mapping outlives the fd
+        return cls(path, header, data_offset, mm)
+
+    def _view(self, entry):
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        array = np.frombuffer(self._mm, dtype=dtype, count=count, offset=self.data_offset + entry["offset"])
+        return array.reshape(entry["shape"])
+
+    def _build_spec(self):
+        graph = self.header["graph"]
+        return {group: [{"name": node["name"], "activation": node["activation"],
+                         "kernel": self.tensors[node["kernel"]], "bias": self.tensors[node["bias"]]}
+                        for node in graph[group]]
+                for group in ("hidden", "heads")}
+
+    def _build_layer(self, node):
+        tensors = node["tensors"]
+        arrays = {k: self.tensors[tensors[k]] for k in LAYER_STATE_ARRAYS if k in tensors}
+        scalars = {k: node[k] for k in ("name", "relu", "out_scale", "acc_bound", "backend")}
+        w = self.tensors[tensors["exec"]] if "exec" in tensors else None
+        return Int8Dense.from_state(scalars, arrays, w=w)
+
+    def _build_engine(self):
+        graph = self.header["graph"]
+        return Int8MLP(graph["input_scale"],
+                       [self._build_layer(node) for node in graph["layers"]],
+                       self._build_layer(graph["head"]),
+                       [tuple(h) for h in graph["head_names"]],
+                       graph["head_activations"])
+
+    def predict_fn(self):
+        """x -> outputs dict, for stream_evaluate / benchmark_models."""
+        if self.kind == "int8":
+            return self.engine.forward
+        return lambda x: fp32_forward(self.spec, x)
+
+    @property
+    def nbytes(self):
+        """Bytes of tensor data (what the process would otherwise hold on its heap)."""
+        return sum(entry["nbytes"] for entry in self.header["tensors"].values())
+
+    @property
+    def exec_bytes(self):
+        """Bytes of stored matmul operands (exec_weights=True); the rest is the INT8 payload."""
+        return sum(entry["nbytes"] for name, entry in self.header["tensors"].items() if name.endswith("/exec"))
+
+    @property
+    def file_bytes(self):
+        return len(self._mm)
+
+    def close(self):
+        """Unmap the file; mmap raises BufferError while views (or engines built on them) are still referenced."""
+        self.tensors, self.spec, self.engine = {}, None, None
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+# Reporting
+def model_size_mb(path):
+    """Size of a flat model file, or of a SavedModel / TFLite directory, in MB."""
+    if os.path.isfile(path):
+        return os.path.getsize(path) / MB
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total / MB
+
+
+def mapping_stats(path, pid="self"):
+    """Rss / Pss / Shared_Clean / Private_* (bytes) of `path`'s mappings, from /proc/<pid>/smaps.
+
+    Rss counts the file pages this process has touched; Pss splits shared pages between
+    the processes mapping them, so the sum of Pss over all serving processes is the real
+    memory cost of the weights. Returns None where smaps is unavailable (non-Linux).
+    """
+    smaps = f"/proc/{pid}/smaps"
+    if not os.path.exists(smaps):
+        return None
+    target = os.path.realpath(path)
+    stats, inside = {}, False
+    with open(smaps) as f:
+        for line in f:
+            fields = line.split()
+            if "-" in fields[0] and not fields[0].endswith(":"):   # mapping header line
+                inside = len(fields) >= 6 and fields[5] == target
+            elif inside and fields[0].endswith(":") and len(fields) >= 3 and fields[2] == "kB":
+                key = fields[0][:-1]
+                stats[key] = stats.get(key, 0) + int(fields[1]) * 1024
+    return {k: stats.get(k, 0) for k in ("Rss", "Pss", "Shared_Clean", "Private_Clean", "Private_Dirty")}
+
+
+def footprint(model):
+    """Memory report for an open FlatModel: file size, tensor bytes by dtype and per layer, residency."""
+    by_dtype, by_layer = {}, {}
+    for name, entry in model.header["tensors"].items():
+        dtype = np.dtype(entry["dtype"]).name
+        layer = name.split("/")[0]
+        by_dtype[dtype] = by_dtype.get(dtype, 0) + entry["nbytes"]
+        by_layer[layer] = by_layer.get(layer, 0) + entry["nbytes"]
+    return {
+        "path": model.path,
+        "kind": model.kind,
+        "file_mb": model.file_bytes / MB,
+        "tensor_mb": model.nbytes / MB,
+        "payload_mb": (model.nbytes - model.exec_bytes) / MB,
+        "exec_mb": model.exec_bytes / MB,
+        "by_dtype_kb": {k: v / 1024 for k, v in by_dtype.items()},
+        "by_layer_kb": {k: v / 1024 for k, v in by_layer.items()},
+        "mapping": mapping_stats(model.path),
+    }
+
+
+def print_footprint(model):
+    report = footprint(model)
+    print(f"{report['path']} ({report['kind']}): {report['file_mb']:.3f} MB file, "
+          f"{report['tensor_mb']:.3f} MB tensors ({report['payload_mb']:.3f} MB model payload, "
+          f"{report['exec_mb']:.3f} MB shared matmul operands)")
+    for layer, kb in report["by_layer_kb"].items():
+        print(f"  {layer:<12} {kb:>10.1f} KB")
+    print("  " + ", ".join(f"{dtype} {kb:.1f} KB" for dtype, kb in report["by_dtype_kb"].items()))
+    mapping = report["mapping"]
+    if mapping is not None:
+        print(f"  mapped: rss {mapping['Rss'] / 1024:.1f} KB, pss {mapping['Pss'] / 1024:.1f} KB, "
+              f"shared {mapping['Shared_Clean'] / 1024:.1f} KB, private {mapping['Private_Dirty'] / 1024:.1f} KB")
+    return report
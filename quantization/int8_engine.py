@@ -0,0 +1,297 @@
+"""
+int8_engine.py
+--------------
+Pure-NumPy INT8 inference engine for the distilled student MLP
+(student_model: hidden_layers [256, 128, 64], ReLU, BatchNorm).
+
+quantization_v1.py hands everything to the TFLite converter, so we could only check
+model size, not whether integer arithmetic is actually faster. This engine runs the
+quantized student directly:
+
+    - BatchNorm folded into the preceding Dense kernel / bias
+    - per-output-channel symmetric INT8 weights (zero point 0)
+    - INT8 input, UINT8 post-ReLU activations (zero point 0, so no cross terms)
+    - INT32 accumulation, INT32 bias
+    - fused requantize + ReLU with a fixed-point (int32 multiplier, shift) rescale
+    - both output heads (prob_logits, conv_value) computed by a single GEMM
+
+Matmul backends:
+    "int32"       exact integer matmul (NumPy has no BLAS path for integers, so this
+                  is the slow reference)
+    "fp32_exact"  the same integer operands fed to SGEMM. The result is bit-identical to
+                  int32 accumulation as long as every partial sum stays below 2^24, which
+                  is checked per layer when the engine is built
+    "auto"        fp32_exact where it is exact, int32 otherwise
+
+NumPy has no int8 GEMM kernel, so "auto" measures the quantized dataflow (int8 storage,
+integer accumulation, requantization) on top of SGEMM; it verifies accuracy and memory
+traffic, not the peak speedup of a VNNI / NEON int8 kernel.
+
+Usage:
+    spec = extract_keras_layers(student_model)
+    engine = Int8MLP.build(spec, x_calib)
+    outputs = engine.predict(x)      # {"prob_logits", "conv_prob", "conv_value"}
+"""
+
+import numpy as np
+
+
+HEAD_OUTPUTS = ("prob_logits", "conv_value")
+FP32_EXACT_LIMIT = 2 ** 24   # largest integer range float32 represents exactly
+INT8_MAX = 127
+UINT8_MAX = 255
+DEFAULT_BATCH_SIZE = 512
+# per-layer arrays of a built Int8Dense (m0 / shift only exist when the layer requantizes)
+LAYER_STATE_ARRAYS = ("q_kernel", "w_scale", "acc_scale", "q_bias", "m0", "shift")
+
+
+
+# Activations
+def sigmoid(x):
+    return 0.5 * (np.tanh(0.5 * x) + 1.0)
+
+
+def softplus(x):
+    return np.logaddexp(0.0, x)
+
+
+FLOAT_ACTIVATIONS = {
+    None: lambda x: x,
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0.0),
+    "sigmoid": sigmoid,
+    "softplus": softplus,
+}
+
+
+
+# Model extraction / folding
+def fold_batch_norm(kernel, bias, gamma, beta, mean, var, eps=1e-3):
+    """Fold y = BN(x @ kernel + bias) into a single Dense layer. Returns (kernel, bias)."""
+    gamma = np.ones_like(mean) if gamma is None else gamma
+    beta = np.zeros_like(mean) if beta is None else beta
+    scale = gamma / np.sqrt(var + eps)
+    return kernel * scale[None, :], (bias - mean) * scale + beta
+
+
+def extract_keras_layers(model, head_names=HEAD_OUTPUTS):
+    """Pull Dense / BatchNorm / ReLU layers out of a Keras student into a float spec.
+
+    Returns {"hidden": [...], "heads": [...]} where each entry is
+    {"name", "kernel" (in, out), "bias" (out,), "activation"} with BatchNorm already folded.
+    Dense layers named in head_names become heads, every other Dense layer is hidden; pass
+    e.g. head_names=HEAD_OUTPUTS + ("pconvs_quantiles",) for a student with extra heads.
+    Dropout is ignored (inference only).
+    """
+    hidden, heads = [], []
+    for layer in model.layers:
+        kind = layer.__class__.__name__
+        if kind == "Dense":
+            weights = layer.get_weights()
+            kernel = weights[0].astype(np.float32)
+            bias = weights[1].astype(np.float32) if len(weights) > 1 else np.zeros(kernel.shape[1], np.float32)
+            activation = layer.get_config().get("activation")
+            spec = {"name": layer.name, "kernel": kernel, "bias": bias,
+                    "activation": None if activation == "linear" else activation}
+            (heads if layer.name in head_names else hidden).append(spec)
+        elif kind == "BatchNormalization":
+            prev = hidden[-1]
+            if prev["activation"] not in (None, "linear"):
+                raise ValueError(f"Cannot fold {layer.name}: it follows an activation, not a Dense layer")
+            as_array = lambda v: None if v is None else np.asarray(v, dtype=np.float32)
+            prev["kernel"], prev["bias"] = fold_batch_norm(
+                prev["kernel"], prev["bias"], as_array(layer.gamma), as_array(layer.beta),
+                as_array(layer.moving_mean), as_array(layer.moving_variance), layer.epsilon)
+        elif kind in ("Activation", "ReLU"):
+            # conv_prob is sigmoid(prob_logits); it is recomputed as a derived output
+            if hidden and layer.name != "conv_prob":
+                hidden[-1]["activation"] = layer.get_config().get("activation", "relu")
+    return {"hidden": hidden, "heads": heads}
+
+
+def fp32_forward(spec, x):
+    """Float reference forward pass over an extracted spec (same outputs as Int8MLP.predict)."""
+    h = np.asarray(x, dtype=np.float32)
+    for layer in spec["hidden"]:
+        h = FLOAT_ACTIVATIONS[layer["activation"]](h @ layer["kernel"] + layer["bias"])
+    return _head_outputs({l["name"]: FLOAT_ACTIVATIONS[l["activation"]](h @ l["kernel"] + l["bias"])
+                          for l in spec["heads"]})
+
+
+def _head_outputs(outputs):
+    if "prob_logits" in outputs:
+        outputs["conv_prob"] = sigmoid(outputs["prob_logits"])
+    return outputs
+
+
+
+# Quantization primitives
+def quantize_weights_per_channel(kernel):
+    """Symmetric per-output-channel INT8. Returns (int8 kernel, float32 scales (out,))."""
+    absmax = np.abs(kernel).max(axis=0)
+    scale = np.where(absmax > 0, absmax / INT8_MAX, 1.0).astype(np.float32)
+    q = np.clip(np.round(kernel / scale[None, :]), -INT8_MAX, INT8_MAX).astype(np.int8)
+    return q, scale
+
+
+def quantize_multiplier(multiplier):
+    """Express real multipliers as int32 M0 * 2^-shift (M0 in [2^30, 2^31)). Returns (M0, shift)."""
+    multiplier = np.asarray(multiplier, dtype=np.float64)
+    mantissa, exponent = np.frexp(multiplier)
+    m0 = np.round(mantissa * (1 << 31)).astype(np.int64)
+    overflow = m0 == (1 << 31)
+    m0[overflow] //= 2
+    exponent = exponent + overflow
+    shift = 31 - exponent
+    if np.any(shift < 1):
+        raise ValueError("Requantization multiplier too large for fixed-point rescale")
+    return m0, shift.astype(np.int64)
+
+
+def requantize(acc, m0, shift, relu=True, qmax=UINT8_MAX):
+    """Fused requantize (+ ReLU): round(acc * M0 / 2^shift) clipped to [0 | -qmax, qmax]."""
+    scaled = (acc.astype(np.int64) * m0 + (np.int64(1) << (shift - 1))) >> shift
+    return np.clip(scaled, 0 if relu else -qmax, qmax).astype(np.uint8 if relu else np.int8)
+
+
+def quantize_input(x, scale):
+    return np.clip(np.round(x / scale), -INT8_MAX, INT8_MAX).astype(np.int8)
+
+
+def activation_ranges(spec, x_calib):
+    """Max-abs calibration: input absmax and each hidden layer's post-activation max."""
+    x = np.asarray(x_calib, dtype=np.float32)
+    ranges = {"input": float(np.abs(x).max())}
+    h = x
+    for layer in spec["hidden"]:
+        h = FLOAT_ACTIVATIONS[layer["activation"]](h @ layer["kernel"] + layer["bias"])
+        ranges[layer["name"]] = float(np.abs(h).max())
+    return ranges
+
+
+
+# Engine
+class Int8Dense(object):
+    """One quantized Dense layer: int8 weights, int32 bias, fixed-point requantization."""
+
+    def __init__(self, name, kernel, bias, in_scale, in_qmax, out_scale=None, relu=True, backend="auto"):
+        self.name = name
+        self.relu = relu
+        self.q_kernel, self.w_scale = quantize_weights_per_channel(kernel)
+        self.acc_scale = (in_scale * self.w_scale).astype(np.float32)   # float value of one accumulator unit
+        self.q_bias = np.round(bias / self.acc_scale).astype(np.int32)
+        self.out_scale = out_scale
+        if out_scale is not None:
+            self.m0, self.shift = quantize_multiplier(self.acc_scale / out_scale)
+
+        # worst-case |partial sum| decides whether SGEMM is exact
+        self.acc_bound = int(kernel.shape[0]) * in_qmax * INT8_MAX + int(np.abs(self.q_bias).max(initial=0))
+        if backend == "auto":
+            backend = "fp32_exact" if self.acc_bound < FP32_EXACT_LIMIT else "int32"
+        if backend == "fp32_exact" and self.acc_bound >= FP32_EXACT_LIMIT:
+            raise ValueError(f"{name}: accumulator bound {self.acc_bound} is not exact in float32")
+        self.backend = backend
+        self._w = self.q_kernel.astype(np.float32 if backend == "fp32_exact" else np.int32)
+
+    def accumulate(self, q_in):
+        """int32 accumulators (batch, out) = q_in @ q_kernel + q_bias."""
+        if self.backend == "fp32_exact":
+            acc = np.matmul(q_in.astype(np.float32), self._w).astype(np.int32)
+        else:
+            acc = np.matmul(q_in.astype(np.int32), self._w)
+        acc += self.q_bias
+        return acc
+
+    def __call__(self, q_in):
+        acc = self.accumulate(q_in)
+        if self.out_scale is None:
+            return acc.astype(np.float32) * self.acc_scale     # dequantize (heads)
+        return requantize(acc, self.m0, self.shift, relu=self.relu)
+
+    @property
+    def nbytes(self):
+        return self.q_kernel.nbytes + self.q_bias.nbytes + self.w_scale.nbytes
+
+    def state(self):
+        """(scalars, arrays) that fully describe the built layer, e.g. for flat_model.py."""
+        scalars = {"name": self.name, "relu": self.relu, "out_scale": self.out_scale,
+                   "acc_bound": self.acc_bound, "backend": self.backend}
+        arrays = {k: getattr(self, k) for k in LAYER_STATE_ARRAYS if hasattr(self, k)}
+        return scalars, arrays
+
+    @classmethod
+    def from_state(cls, scalars, arrays, w=None):
+        """Rebuild a layer from state() without re-quantizing; `w` is the matmul operand if stored."""
+        layer = cls.__new__(cls)
+        layer.__dict__.update(scalars)
+        layer.__dict__.update(arrays)
+        if w is None:
+            w = layer.q_kernel.astype(np.float32 if layer.backend == "fp32_exact" else np.int32)
+        layer._w = w
+        return layer
+
+
+class Int8MLP(object):
+    """INT8 student: quantized hidden stack plus one fused GEMM for all output heads."""
+
+    def __init__(self, input_scale, layers, head, head_names, head_activations):
+        self.input_scale = input_scale
+        self.layers = layers
+        self.head = head
+        self.head_names = head_names
+        self.head_activations = head_activations
+
+    @classmethod
+    def build(cls, spec, x_calib=None, ranges=None, backend="auto"):
+        """Quantize a float spec. Activation ranges come from `ranges` or max-abs over x_calib."""
+        if ranges is None:
+            ranges = activation_ranges(spec, x_calib)
+        input_scale = ranges["input"] / INT8_MAX if ranges["input"] > 0 else 1.0
+
+        layers = []
+        in_scale, in_qmax = input_scale, INT8_MAX
+        for layer in spec["hidden"]:
+            if layer["activation"] != "relu":
+                raise ValueError(f"{layer['name']}: only ReLU hidden layers are supported")
+            out_scale = ranges[layer["name"]] / UINT8_MAX if ranges[layer["name"]] > 0 else 1.0
+            layers.append(Int8Dense(layer["name"], layer["kernel"], layer["bias"], in_scale, in_qmax,
+                                    out_scale=out_scale, relu=True, backend=backend))
+            in_scale, in_qmax = out_scale, UINT8_MAX
+
+        # concatenate the heads' kernels so every head comes out of one GEMM
+        heads = spec["heads"]
+        kernel = np.concatenate([h["kernel"] for h in heads], axis=1)
+        bias = np.concatenate([h["bias"] for h in heads])
+        head = Int8Dense("heads", kernel, bias, in_scale, in_qmax, out_scale=None, relu=False, backend=backend)
+        widths = [h["kernel"].shape[1] for h in heads]
+        head_names = [(h["name"], start, start + w) for h, start, w in zip(heads, np.cumsum([0] + widths[:-1]), widths)]
+        return cls(input_scale, layers, head, head_names, [h["activation"] for h in heads])
+
+    def forward(self, x):
+        q = quantize_input(np.asarray(x, dtype=np.float32), self.input_scale)
+        for layer in self.layers:
+            q = layer(q)
+        logits = self.head(q)
+        outputs = {}
+        for (name, start, stop), activation in zip(self.head_names, self.head_activations):
+            outputs[name] = FLOAT_ACTIVATIONS[activation](logits[:, start:stop])
+        return _head_outputs(outputs)
+
+    def predict(self, x, batch_size=DEFAULT_BATCH_SIZE):
+        """Batched inference; chunks keep each layer's working set cache-resident."""
+        if len(x) <= batch_size:
+            return self.forward(x)
+        parts = [self.forward(x[i:i + batch_size]) for i in range(0, len(x), batch_size)]
+        return {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+
+    @property
+    def nbytes(self):
+        return sum(l.nbytes for l in self.layers) + self.head.nbytes
+
+    def describe(self):
+        print(f"{'Layer':<12} | {'Shape':<12} | {'Backend':<10} | {'Acc bound':>10}")
+        print("-" * 54)
+        for l in self.layers + [self.head]:
+            shape = f"{l.q_kernel.shape[0]}x{l.q_kernel.shape[1]}"
+            print(f"{l.name:<12} | {shape:<12} | {l.backend:<10} | {l.acc_bound:>10}")
+        print(f"Weights: {self.nbytes / 1024:.1f} KB")
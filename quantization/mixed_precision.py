@@ -0,0 +1,307 @@
+"""
+mixed_precision.py
+------------------
+Per-layer mixed-precision search (INT4 / INT8 / FP16) for the student MLP.
+
+quantization_v1.py targets a single "precision": "int8" for the whole model. Not every
+layer needs 8 bits: the wide first layers dominate weight bytes (and therefore memory
+bandwidth at serving batch sizes), while the bottleneck and heads are tiny. This search
+assigns each hidden layer one of
+
+    "fp16"   W16A16 float
+    "int8"   W8A8, per-channel symmetric weights (what int8_engine.py runs)
+    "int4"   W4A8, per-channel symmetric 4-bit weights, 8-bit activations
+
+(embedding layers stay "fp32" unless qat.parameters.quantize_embeddings is set) from:
+
+    - quantization sensitivity: Poisson log loss increase (scaled as in sensitivity.py)
+      when only that layer is fake-quantized, measured on memoized layer inputs
+      (SensitivityRunner from pruning/sensitivity.py), one probe per (layer, precision)
+    - size: weight + bias bytes at each precision
+    - latency: the FP32 layer (NumPy) and the INT8 layer (a real Int8Dense from
+      int8_engine.py, the kernel PTQ serves) are timed at the serving batch size.
+      NumPy has no FP16 / INT4 GEMM, so those two are estimated by scaling the FP32
+      time by weight bytes (the bandwidth-bound regime we are targeting) and marked
+      as not measured; pass latency_table= with numbers measured on the serving fleet
+      to replace the estimates.
+
+The chosen map minimizes normalized size + latency_weight * normalized latency subject
+to the summed per-layer degradation staying within pll_budget (exhaustive over small
+models, greedy otherwise). The assignment is then verified by quantizing all layers
+together and raising the most sensitive layer until the joint degradation fits.
+
+Usage (from the repo root):
+    search = MixedPrecisionSearch(spec, x_eval, y_eval)
+    bit_map = search.run(pll_budget=0.005)
+    export_bitwidth_map(bit_map, "bitwidth_map.json", search.result, search.costs)
+"""
+
+import itertools
+import json
+import numpy as np
+
+from pruning.sensitivity import SensitivityRunner
+from quantization.benchmark import time_calls
+from quantization.int8_engine import FLOAT_ACTIVATIONS, INT8_MAX, UINT8_MAX, Int8Dense
+
+
+PRECISIONS = {
+    "fp32": {"weight_bits": 32, "activation_bits": 32, "float": True},
+    "fp16": {"weight_bits": 16, "activation_bits": 16, "float": True},
+    "int8": {"weight_bits": 8, "activation_bits": 8, "float": False},
+    "int4": {"weight_bits": 4, "activation_bits": 8, "float": False},
+}
+CANDIDATES = ("fp16", "int8", "int4")
+ORDER = ("int4", "int8", "fp16", "fp32")     # low -> high precision
+DEFAULT_PLL_BUDGET = 0.005                  # PLL increase, 0.5% of the skill over the label mean (qat expected accuracy_drop)
+DEFAULT_LATENCY_WEIGHT = 0.5
+EXHAUSTIVE_LIMIT = 200000
+LATENCY_WARMUP = 5
+LATENCY_ITERATIONS = 50
+MEASURED = ("fp32", "int8")                 # timed directly; the rest are byte-scaled from fp32
+
+
+
+# Fake quantization
+def fake_quant_weights(kernel, precision):
+    """Round-trip a (in, out) kernel through `precision` (per-output-channel for integers)."""
+    p = PRECISIONS[precision]
+    if precision == "fp32":
+        return kernel
+    if p["float"]:
+        return kernel.astype(np.float16).astype(np.float32)
+    qmax = 2 ** (p["weight_bits"] - 1) - 1
+    absmax = np.abs(kernel).max(axis=0, keepdims=True)
+    scale = np.where(absmax > 0, absmax / qmax, 1.0)
+    return (np.clip(np.round(kernel / scale), -qmax, qmax) * scale).astype(np.float32)
+
+
+def fake_quant_activations(h, precision, lo, hi):
+    """Round-trip activations through `precision` over the calibrated range [lo, hi]."""
+    p = PRECISIONS[precision]
+    if precision == "fp32":
+        return h
+    if p["float"]:
+        return h.astype(np.float16).astype(np.float32)
+    bits = p["activation_bits"]
+    if lo >= 0:   # post-ReLU: unsigned, zero point 0 (as in int8_engine)
+        qmin, qmax, absmax = 0, 2 ** bits - 1, hi
+    else:
+        qmax = 2 ** (bits - 1) - 1
+        qmin, absmax = -qmax, max(-lo, hi)
+    scale = absmax / qmax if absmax > 0 else 1.0
+    return (np.clip(np.round(h / scale), qmin, qmax) * scale).astype(np.float32)
+
+
+def layer_bytes(layer, precision):
+    bits = PRECISIONS[precision]["weight_bits"]
+    # integer layers also store an int32 bias and one float32 scale per output channel
+    extra = 0 if PRECISIONS[precision]["float"] else 4 * layer["kernel"].shape[1]
+    bias_bits = bits if PRECISIONS[precision]["float"] else 32
+    return layer["kernel"].size * bits / 8 + layer["bias"].size * bias_bits / 8 + extra
+
+
+def is_embedding(name):
+    return "emb" in name.lower()
+
+
+
+# Costs
+def measure_layer_latency(layer, batch_size, first=False, warmup=LATENCY_WARMUP, iterations=LATENCY_ITERATIONS):
+    """Median seconds per call: fp32 (NumPy) and int8 (Int8Dense) timed, fp16 / int4 scaled by bytes.
+
+    `first` marks the input layer, which reads signed int8 features instead of the
+    uint8 post-ReLU activations of the layer before it.
+    """
+    rng = np.random.default_rng(0)
+    kernel, bias = layer["kernel"], layer["bias"]
+    activation = FLOAT_ACTIVATIONS[layer["activation"]]
+    x = rng.standard_normal((batch_size, kernel.shape[0])).astype(np.float32)
+    fp32_lat, _ = time_calls(lambda v: activation(v @ kernel + bias), x, warmup, iterations)
+
+    in_qmax = INT8_MAX if first else UINT8_MAX
+    int8 = Int8Dense(layer["name"], kernel, bias, in_scale=0.05, in_qmax=in_qmax, out_scale=0.05,
+                     relu=layer["activation"] == "relu")
+    q_in = rng.integers(-INT8_MAX if first else 0, in_qmax + 1, size=x.shape).astype(np.int8 if first else np.uint8)
+    int8_lat, _ = time_calls(int8, q_in, warmup, iterations)
+
+    fp32 = float(np.median(fp32_lat)) / 1e9
+    fp32_bytes = layer_bytes(layer, "fp32")
+    latency = {p: fp32 * layer_bytes(layer, p) / fp32_bytes for p in PRECISIONS}
+    latency["fp32"] = fp32
+    latency["int8"] = float(np.median(int8_lat)) / 1e9
+    return latency
+
+
+def layer_costs(spec, batch_size=64, latency_table=None, layer_names=None):
+    """{layer: {precision: {"bytes", "latency_s", "measured"}}}.
+
+    latency_table ({layer: {precision: seconds}}) overrides the local numbers;
+    "measured" is True for the timed fp32 / int8 kernels and for every table entry,
+    False for the byte-scaled fp16 / int4 estimates.
+    """
+    costs = {}
+    for i, layer in enumerate(spec["hidden"]):
+        name = layer["name"]
+        if layer_names is not None and name not in layer_names:
+            continue
+        latency = measure_layer_latency(layer, batch_size, first=i == 0)
+        overrides = (latency_table or {}).get(name, {})
+        costs[name] = {
+            p: {"bytes": layer_bytes(layer, p),
+                "latency_s": overrides.get(p, latency[p]),
+                "measured": p in overrides or p in MEASURED}
+            for p in PRECISIONS
+        }
+    return costs
+
+
+
+# Search
+class MixedPrecisionSearch(object):
+    """Sensitivity probes + cost table + constrained search over per-layer precisions."""
+
+    def __init__(self, spec, x_eval, y_eval, max_samples=10000, seed=0, batch_size=64,
+                 candidates=CANDIDATES, quantize_embeddings=False, latency_table=None):
+        self.runner = SensitivityRunner(spec, x_eval, y_eval, max_samples=max_samples, seed=seed)
+        self.spec = spec
+        self.names = [l["name"] for l in spec["hidden"]]
+        self.candidates = {n: (("fp32",) if is_embedding(n) and not quantize_embeddings else tuple(candidates))
+                           for n in self.names}
+        # calibrated input range of every layer, from the memoized FP32 activations
+        self.ranges = [(float(h.min()), float(h.max())) for h in self.runner.inputs]
+        self.costs = layer_costs(spec, batch_size, latency_table)
+        self.fp32_bytes = sum(self.costs[n]["fp32"]["bytes"] for n in self.names)
+        self.fp32_latency = sum(self.costs[n]["fp32"]["latency_s"] for n in self.names)
+        self.sensitivity = None
+        self.result = None
+
+    def degradation(self, loss):
+        return self.runner.degradation(loss)
+
+    def probe(self, idx, precision):
+        layer = self.spec["hidden"][idx]
+        lo, hi = self.ranges[idx]
+        h = fake_quant_activations(self.runner.inputs[idx], precision, lo, hi)
+        return self.runner.loss_from(idx, h, fake_quant_weights(layer["kernel"], precision))
+
+    def measure_sensitivity(self):
+        """{layer: {precision: scaled PLL increase}} with only that layer quantized."""
+        self.sensitivity = {
+            n: {p: (0.0 if p == "fp32" else max(self.degradation(self.probe(i, p)), 0.0))
+                for p in self.candidates[n]}
+            for i, n in enumerate(self.names)
+        }
+        return self.sensitivity
+
+    def joint_degradation(self, bit_map):
+        """Relative PLL increase with every layer quantized to bit_map at once."""
+        h = self.runner.inputs[0]
+        for i, layer in enumerate(self.spec["hidden"]):
+            p = bit_map[layer["name"]]
+            lo, hi = self.ranges[i]
+            h = fake_quant_activations(h, p, lo, hi)
+            h = FLOAT_ACTIVATIONS[layer["activation"]](h @ fake_quant_weights(layer["kernel"], p) + layer["bias"])
+        return self.degradation(self.runner.loss_from(len(self.spec["hidden"]), h))
+
+    def _cost(self, name, precision, latency_weight):
+        c = self.costs[name][precision]
+        return c["bytes"] / self.fp32_bytes + latency_weight * c["latency_s"] / self.fp32_latency
+
+    def search(self, pll_budget=DEFAULT_PLL_BUDGET, latency_weight=DEFAULT_LATENCY_WEIGHT):
+        """Cheapest assignment whose summed per-layer degradation fits pll_budget."""
+        sens = self.sensitivity or self.measure_sensitivity()
+        options = [[(p, self._cost(n, p, latency_weight), sens[n][p]) for p in self.candidates[n]]
+                   for n in self.names]
+
+        if np.prod([len(o) for o in options]) <= EXHAUSTIVE_LIMIT:
+            best = None
+            for combo in itertools.product(*options):
+                if sum(c[2] for c in combo) <= pll_budget:
+                    cost = sum(c[1] for c in combo)
+                    if best is None or cost < best[0]:
+                        best = (cost, combo)
+            if best is not None:
+                return {n: c[0] for n, c in zip(self.names, best[1])}
+            print(f"Warning: no assignment fits pll_budget={pll_budget}; using the least sensitive one")
+            return {n: min(o, key=lambda c: c[2])[0] for n, o in zip(self.names, options)}
+
+        # greedy: start at the safest option, then take the best cost saving per unit of degradation
+        choice = {n: min(o, key=lambda c: (c[2], c[1])) for n, o in zip(self.names, options)}
+        used = sum(c[2] for c in choice.values())
+        while True:
+            moves = [(n, c) for n, o in zip(self.names, options) for c in o
+                     if c[1] < choice[n][1] and used - choice[n][2] + c[2] <= pll_budget]
+            if not moves:
+                break
+            n, c = max(moves, key=lambda m: (choice[m[0]][1] - m[1][1]) / (max(m[1][2] - choice[m[0]][2], 0.0) + 1e-12))
+            used += c[2] - choice[n][2]
+            choice[n] = c
+        return {n: c[0] for n, c in choice.items()}
+
+    def run(self, pll_budget=DEFAULT_PLL_BUDGET, latency_weight=DEFAULT_LATENCY_WEIGHT):
+        """Search, then raise precision until the jointly quantized model fits the budget."""
+        bit_map = self.search(pll_budget, latency_weight)
+        joint = self.joint_degradation(bit_map)
+        while joint > pll_budget:
+            # raise the layer that currently contributes the most degradation
+            raisable = [n for n in self.names
+                        if any(ORDER.index(p) > ORDER.index(bit_map[n]) for p in self.candidates[n])]
+            if not raisable:
+                print(f"Warning: joint degradation {joint:.4%} exceeds the budget at the highest precisions")
+                break
+            n = max(raisable, key=lambda m: self.sensitivity[m][bit_map[m]])
+            bit_map[n] = min((p for p in self.candidates[n] if ORDER.index(p) > ORDER.index(bit_map[n])),
+                             key=ORDER.index)
+            joint = self.joint_degradation(bit_map)
+        self.result = self.summary(bit_map, joint, pll_budget, latency_weight)
+        return bit_map
+
+    def summary(self, bit_map, joint, pll_budget, latency_weight):
+        size = sum(self.costs[n][bit_map[n]]["bytes"] for n in self.names)
+        latency = sum(self.costs[n][bit_map[n]]["latency_s"] for n in self.names)
+        return {
+            "pll_budget": pll_budget, "latency_weight": latency_weight,
+            "baseline_pll": self.runner.baseline, "joint_degradation": joint,
+            "size_bytes": size, "fp32_size_bytes": self.fp32_bytes,
+            "latency_ms": latency * 1e3, "fp32_latency_ms": self.fp32_latency * 1e3,
+        }
+
+    def print_table(self, bit_map=None):
+        sens = self.sensitivity or self.measure_sensitivity()
+        print(f"{'Layer':<12} | " + " | ".join(f"{p:>16}" for p in CANDIDATES) + f" | {'Chosen':>6}")
+        print("-" * (17 + 19 * len(CANDIDATES) + 9))
+        for n in self.names:
+            cells = []
+            for p in CANDIDATES:
+                if p in sens[n]:
+                    cells.append(f"{sens[n][p]:>7.3%} {self.costs[n][p]['bytes'] / 1024:>6.1f}KB")
+                else:
+                    cells.append(f"{'-':>16}")
+            print(f"{n:<12} | " + " | ".join(cells) + f" | {(bit_map or {}).get(n, ''):>6}")
+
+
+
+# Export
+def export_bitwidth_map(bit_map, path, summary=None, costs=None):
+    """Write {"layers": {name: {"precision", "weight_bits", "activation_bits"}}, "summary": ...}.
+
+    With costs (MixedPrecisionSearch.costs) each layer also records the chosen precision's
+    "bytes", "latency_s" and whether that latency was "measured" or scaled from fp32.
+    """
+    layers = {}
+    for n, p in bit_map.items():
+        layers[n] = dict(precision=p, weight_bits=PRECISIONS[p]["weight_bits"],
+                         activation_bits=PRECISIONS[p]["activation_bits"])
+        if costs is not None and n in costs:
+            layers[n].update(costs[n][p])
+    out = {"layers": layers, "summary": summary or {}}
+    with open(path, "w") as f:
+        json.dump(out, f, indent=2, sort_keys=True)
+    print(f"Bit-width map written to {path}")
+
+
+def load_bitwidth_map(path):
+    """{layer: precision} from an exported bit-width map."""
+    with open(path) as f:
+        return {n: v["precision"] for n, v in json.load(f)["layers"].items()}
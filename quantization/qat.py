@@ -0,0 +1,172 @@
+"""
+qat.py
+------
+Quantization-aware training (the "qat" block in quantization_v1.py) with per-layer
+precisions from a mixed-precision bit-width map (mixed_precision.py).
+
+Every Dense layer of the student is replaced by a FakeQuantDense that, in the forward
+pass, rounds
+
+    - its kernel to the layer's weight precision (per-output-channel symmetric for
+      INT8 / INT4, a float16 round trip for FP16)
+    - its input to the layer's activation precision over an EMA-tracked range
+      (unsigned when the input is post-ReLU, as in int8_engine.py)
+
+and passes gradients straight through the rounding (straight-through estimator),
+zeroing them where the value was clipped. Layers the map does not list (and embeddings,
+unless quantize_embeddings is set) stay FP32. BatchNorm is left unfolded during
+fine-tuning; int8_engine.extract_keras_layers folds it at export.
+
+Usage (from the repo root):
+    bit_map = load_bitwidth_map("bitwidth_map.json")
+    qat_model = quantize_student(student_model, bit_map)
+    train_qat(qat_model, x_train, y_train, quantization()["qat"]["parameters"])
+    qat_model.save("models/qat_int8/")
+"""
+
+import numpy as np
+import tensorflow as tf
+
+from quantization.mixed_precision import PRECISIONS, is_embedding
+
+
+DEFAULT_PRECISION = "int8"
+DEFAULT_EMA_DECAY = 0.999
+DEFAULT_LEARNING_RATE = 1e-3
+DEFAULT_LOSSES = {"conv_prob": "binary_crossentropy", "conv_value": "poisson", "prob_logits": None}
+
+
+
+# Fake quantization with straight-through gradients
+def _ste(x, rounded, clipped):
+    # forward: rounded; backward: d/dx clipped (1 inside the range, 0 where clipped)
+    return clipped + tf.stop_gradient(rounded - clipped)
+
+
+def fake_quant_per_channel(kernel, bits):
+    """Symmetric per-output-channel fake quantization of a (in, out) kernel."""
+    qmax = float(2 ** (bits - 1) - 1)
+    absmax = tf.reduce_max(tf.abs(kernel), axis=0, keepdims=True)
+    scale = tf.stop_gradient(tf.where(absmax > 0, absmax / qmax, tf.ones_like(absmax)))
+    clipped = tf.clip_by_value(kernel, -qmax * scale, qmax * scale)
+    return _ste(kernel, tf.round(clipped / scale) * scale, clipped)
+
+
+def fake_quant_range(x, bits, lo, hi):
+    """Fake-quantize activations over [lo, hi]: unsigned if lo >= 0, else symmetric."""
+    unsigned = lo >= 0.0
+    qmax = tf.where(unsigned, float(2 ** bits - 1), float(2 ** (bits - 1) - 1))
+    absmax = tf.where(unsigned, hi, tf.maximum(-lo, hi))
+    scale = tf.stop_gradient(tf.where(absmax > 0, absmax / qmax, 1.0))
+    qmin = tf.where(unsigned, 0.0, -qmax)
+    clipped = tf.clip_by_value(x, qmin * scale, qmax * scale)
+    return _ste(x, tf.round(clipped / scale) * scale, clipped)
+
+
+def fake_fp16(x):
+    return x + tf.stop_gradient(tf.cast(tf.cast(x, tf.float16), tf.float32) - x)
+
+
+
+# Layer
+class FakeQuantDense(tf.keras.layers.Dense):
+    """Dense layer that simulates `precision` for its kernel and input during training and inference."""
+
+    def __init__(self, units, precision=DEFAULT_PRECISION, ema_decay=DEFAULT_EMA_DECAY, **kwargs):
+        super().__init__(units, **kwargs)
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision: {precision}")
+        self.precision = precision
+        self.ema_decay = ema_decay
+
+    def build(self, input_shape):
+        super().build(input_shape)
+        self.act_min = self.add_weight(name="act_min", shape=(), initializer="zeros", trainable=False)
+        self.act_max = self.add_weight(name="act_max", shape=(), initializer="zeros", trainable=False)
+        self.act_seen = self.add_weight(name="act_seen", shape=(), initializer="zeros", trainable=False)
+
+    def _track_range(self, x):
+        lo, hi = tf.reduce_min(x), tf.reduce_max(x)
+        first = self.act_seen < 0.5
+        d = self.ema_decay
+        self.act_min.assign(tf.where(first, lo, d * self.act_min + (1 - d) * lo))
+        self.act_max.assign(tf.where(first, hi, d * self.act_max + (1 - d) * hi))
+        self.act_seen.assign(1.0)
+
+    def call(self, inputs, training=None):
+        p = PRECISIONS[self.precision]
+        x = tf.cast(inputs, tf.float32)
+        kernel = self.kernel
+        if self.precision != "fp32":
+            if p["float"]:
+                x, kernel = fake_fp16(x), fake_fp16(kernel)
+            else:
+                if training:
+                    self._track_range(x)
+                # no range observed yet (inference before any training step): leave the input in float
+                x = tf.where(self.act_seen > 0.5, fake_quant_range(x, p["activation_bits"], self.act_min, self.act_max), x)
+                kernel = fake_quant_per_channel(kernel, p["weight_bits"])
+        out = tf.matmul(x, kernel)
+        if self.use_bias:
+            out = tf.nn.bias_add(out, fake_fp16(self.bias) if self.precision == "fp16" else self.bias)
+        return self.activation(out) if self.activation is not None else out
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"precision": self.precision, "ema_decay": self.ema_decay})
+        return config
+
+
+
+# Model conversion / training
+def quantize_student(model, bit_map=None, default_precision=None, quantize_embeddings=False):
+    """Clone a Keras student with every Dense layer replaced by a FakeQuantDense.
+
+    bit_map ({layer: precision}, e.g. from load_bitwidth_map) sets the precision per layer.
+    Layers it does not list were never scored by the mixed-precision search, so they
+    default to fp32; without a bit_map every layer uses DEFAULT_PRECISION (uniform QAT).
+    default_precision overrides either default. Weights are copied from `model`.
+    """
+    if default_precision is None:
+        default_precision = "fp32" if bit_map else DEFAULT_PRECISION
+    bit_map = bit_map or {}
+
+    def precision_for(name):
+        if is_embedding(name) and not quantize_embeddings:
+            return "fp32"
+        return bit_map.get(name, default_precision)
+
+    def clone(layer):
+        if layer.__class__.__name__ != "Dense":
+            return layer.__class__.from_config(layer.get_config())
+        return FakeQuantDense(precision=precision_for(layer.name), **layer.get_config())
+
+    qat_model = tf.keras.models.clone_model(model, clone_function=clone)
+    for layer in qat_model.layers:
+        source = model.get_layer(layer.name)
+        if isinstance(layer, FakeQuantDense):
+            layer.kernel.assign(source.kernel)
+            if layer.use_bias:
+                layer.bias.assign(source.bias)
+        elif source.weights:
+            layer.set_weights(source.get_weights())
+    return qat_model
+
+
+def train_qat(qat_model, x, y, parameters, base_learning_rate=DEFAULT_LEARNING_RATE, losses=None,
+              validation_data=None, verbose=1):
+    """Fine-tune with the qat.parameters block (epochs, learning_rate_scale, batch_size)."""
+    optimizer = tf.keras.optimizers.Adam(base_learning_rate * parameters.get("learning_rate_scale", 0.1))
+    qat_model.compile(optimizer=optimizer, loss=losses or DEFAULT_LOSSES)
+    return qat_model.fit(x, y, epochs=parameters.get("epochs", 3), batch_size=parameters.get("batch_size", 512),
+                         validation_data=validation_data, verbose=verbose)
+
+
+def precision_summary(qat_model):
+    """{layer: precision} for every FakeQuantDense, with its calibrated input range."""
+    out = {}
+    for layer in qat_model.layers:
+        if isinstance(layer, FakeQuantDense):
+            out[layer.name] = {"precision": layer.precision,
+                               "act_range": [float(np.asarray(layer.act_min)), float(np.asarray(layer.act_max))]}
+    return out
@@ -1,147 +1,250 @@
-# This script will generate:
-'''
-accuracy_comparison.png
-latency_comparison.png
-model_size_comparison.png
-quality_vs_latency.png
-'''
-
-
-
-
-import os
-import time
-import json
-import numpy as np
-import tensorflow as tf
-import matplotlib.pyplot as plt
-from tensorflow.keras.metrics import Poisson
-
-
-# CONFIG — CHANGE THESE PATHS
-FP32_PATH = "models/fp32_student/"
-PTQ_PATH  = "models/ptq_int8/"
-QAT_PATH  = "models/qat_int8/"
-
-CALIB_DATA_PATH = "data/calibration.npy"
-BATCH_SIZE = 512
-
-
-
-# Helper Functions
-def load_model(path):
-    print(f"Loading model from {path} ...")
-    return tf.keras.models.load_model(path)
-
-
-def model_size_mb(path):
-    """Return size of SavedModel directory in MB."""
-    total = 0
-    for root, _, files in os.walk(path):
-        for f in files:
-            total += os.path.getsize(os.path.join(root, f))
-    return total / (1024 * 1024)
-
-
-def measure_latency(model, sample):
-    """Returns inference latency in milliseconds per sample."""
-    # warmup
-    _ = model(sample)
-
-    start = time.time()
-    _ = model(sample)
-    end = time.time()
-
-    return (end - start) * 1000  # ms
-
-
-def compute_accuracy(model, x, y):
-    preds = model.predict(x, batch_size=BATCH_SIZE)
-    metric = Poisson()
-    metric.update_state(y, preds)
-    return float(metric.result().numpy())
-
-
-
-# Main Evaluation
-def main():
-
-    # Load data
-    data = np.load(CALIB_DATA_PATH, allow_pickle=True).item()
-    x_test, y_test = data["x"], data["y"]
-    sample_input = tf.convert_to_tensor(x_test[:1])
-
-    # Load models
-    m_fp32 = load_model(FP32_PATH)
-    m_ptq  = load_model(PTQ_PATH)
-    m_qat  = load_model(QAT_PATH)
-
-    # 1. Accuracy
-    print("\nEvaluating Accuracy...")
-    acc_fp32 = compute_accuracy(m_fp32, x_test, y_test)
-    acc_ptq  = compute_accuracy(m_ptq,  x_test, y_test)
-    acc_qat  = compute_accuracy(m_qat,  x_test, y_test)
-    print("-> Accuracy Done")
-
-    # 2. Latency
-    print("\nMeasuring Latency...")
-    lat_fp32 = measure_latency(m_fp32, sample_input)
-    lat_ptq  = measure_latency(m_ptq,  sample_input)
-    lat_qat  = measure_latency(m_qat,  sample_input)
-    print("-> Latency Done")
-
-    # 3. Model size
-    print("\nMeasuring Model Size...")
-    size_fp32 = model_size_mb(FP32_PATH)
-    size_ptq  = model_size_mb(PTQ_PATH)
-    size_qat  = model_size_mb(QAT_PATH)
-    print("-> Model Size Done")
-
-
-    # PLOTS
-    # 1. Accuracy Chart
-    plt.figure(figsize=(7,5))
-    plt.bar(["FP32", "PTQ", "QAT"], [acc_fp32, acc_ptq, acc_qat], color=["blue","green","orange"])
-    plt.ylabel("Poisson Log Loss (lower = better)")
-    plt.title("Accuracy Comparison")
-    plt.savefig("accuracy_comparison.png")
-    plt.close()
-
-    # 2. Latency Chart
-    plt.figure(figsize=(7,5))
-    plt.bar(["FP32", "PTQ", "QAT"], [lat_fp32, lat_ptq, lat_qat], color=["blue","green","orange"])
-    plt.ylabel("Latency (ms per inference)")
-    plt.title("Latency Comparison")
-    plt.savefig("latency_comparison.png")
-    plt.close()
-
-    # 3. Model Size Chart
-    plt.figure(figsize=(7,5))
-    plt.bar(["FP32", "PTQ", "QAT"], [size_fp32, size_ptq, size_qat], color=["blue","green","orange"])
-    plt.ylabel("Model Size (MB)")
-    plt.title("Model Size Comparison")
-    plt.savefig("model_size_comparison.png")
-    plt.close()
-
-    # 4. Quality vs Latency (Pareto Curve)
-    plt.figure(figsize=(7,5))
-    plt.scatter([lat_fp32, lat_ptq, lat_qat], [acc_fp32, acc_ptq, acc_qat],
-                s=[120,120,120], c=["blue","green","orange"], label="models")
-    for x,y,name in [(lat_fp32,acc_fp32,"FP32"),(lat_ptq,acc_ptq,"PTQ"),(lat_qat,acc_qat,"QAT")]:
-        plt.text(x, y, name)
-    plt.xlabel("Latency (ms)")
-    plt.ylabel("Poisson Log Loss")
-    plt.title("Quality vs Latency Trade-off (Pareto Curve)")
-    plt.savefig("quality_vs_latency.png")
-    plt.close()
-
-    print("\nAll graphs saved:")
-    print("  - accuracy_comparison.png")
-    print("  - latency_comparison.png")
-    print("  - model_size_comparison.png")
-    print("  - quality_vs_latency.png")
-    print("\nDone ✔")
-
-
-if __name__ == "__main__":
-    main()
+# This script will generate:
+'''
+accuracy_comparison.png
+latency_comparison.png
+model_size_comparison.png
+quality_vs_latency.png
+latency_benchmark.json
+quantization_tables.json
+eval_metrics.json
+profile_trace.json
+'''
+# Run from the repo root: python -m quantization.quantization_eval
+
+
+
+
+import time
+import json
+import numpy as np
+import tensorflow as tf
+import matplotlib.pyplot as plt
+
+from quantization.benchmark import benchmark_models, lookup, print_table, write_results
+from quantization.calibration import (calibrate, calibration_settings, engine_ranges, iter_calibration_chunks,
+                                      qparam_table, spec_activation_fn, write_tables)
+from quantization.flat_model import MB, FlatModel, model_size_mb, print_footprint, save_flat
+from quantization.int8_engine import Int8MLP, extract_keras_layers, fp32_forward
+from quantization.qat import FakeQuantDense
+from quantization.streaming_eval import iter_eval_chunks, keras_predict_fn, print_metrics, stream_evaluate
+from profiling.profiler import Profiler, instrument_engine, profiled_spec_forward, profiling
+
+
+# CONFIG — CHANGE THESE PATHS
+FP32_PATH = "models/fp32_student/"
+PTQ_PATH  = "models/ptq_int8/"
+QAT_PATH  = "models/qat_int8/"
+FLAT_INT8_PATH = "models/np_int8.kdflat"   # mmap-able NumPy INT8 engine (flat_model.py)
+
+CALIB_DATA_PATH = "data/calibration.npy"
+# eval set: memory-mapped .npy files or directories of .npy shards
+# (EVAL_Y_PATH = None reads a legacy pickled {"x", "y"} file, which is loaded whole)
+EVAL_X_PATH = CALIB_DATA_PATH
+EVAL_Y_PATH = None
+EVAL_CHUNK_ROWS = 65536
+EVAL_OUTPUT = "eval_metrics.json"
+BATCH_SIZE = 512
+CALIB_SAMPLES = 5000   # matches ptq.parameters.calibration_samples in quantization_v1.py
+CALIB_METHOD = "mse"   # minmax | percentile | mse
+# mirrors ptq.parameters.calibration in quantization_v1.py
+CALIB_CONFIG = calibration_settings({
+    "chunk_rows": 8192,
+    "range_method": ["minmax", "percentile", "mse"],
+    "histogram_bins": 2048,
+    "percentile": 99.99,
+})
+QPARAM_OUTPUT = "quantization_tables.json"
+
+# latency benchmark sweep
+BENCH_BATCH_SIZES = (1, 8, 64, 512)
+BENCH_THREAD_COUNTS = (1, 2, 4)
+BENCH_WARMUP = 20
+BENCH_ITERATIONS = 500
+BENCH_OUTPUT = "latency_benchmark.json"
+BENCH_POOL_ROWS = 4096   # rows sampled for benchmark batches
+
+# per-layer profile of the NumPy runtimes (batch 1)
+PROFILE_ITERATIONS = 2000
+PROFILE_OUTPUT = "profile_trace.json"
+
+
+
+# Helper Functions
+def load_model(path):
+    print(f"Loading model from {path} ...")
+    # QAT students (qat.py) contain FakeQuantDense layers
+    return tf.keras.models.load_model(path, custom_objects={"FakeQuantDense": FakeQuantDense})
+
+
+def measure_latency(model, sample, warmup=BENCH_WARMUP, iterations=BENCH_ITERATIONS):
+    """Returns median (p50) inference latency in milliseconds per call on `sample`.
+
+    Kept for quick one-off checks; main() uses the full benchmark sweep instead.
+    """
+    results = benchmark_models({"model": lambda x: model(x, training=False)}, np.asarray(sample),
+                               batch_sizes=(len(sample),), thread_counts=(1,),
+                               warmup=warmup, iterations=iterations)
+    return lookup(results, "model", batch_size=len(sample))
+
+
+def compute_accuracy(models, x_path=EVAL_X_PATH, y_path=EVAL_Y_PATH):
+    """Poisson log loss of every model from one streaming pass over the eval set.
+
+    `models` maps name -> fn(x). Returns ({name: pll}, {name: full metrics}).
+    """
+    metrics = stream_evaluate(models, iter_eval_chunks(x_path, y_path, EVAL_CHUNK_ROWS), batch_size=BATCH_SIZE)
+    print_metrics(metrics)
+    results = {name: m.result() for name, m in metrics.items()}
+    return {name: r["pll"] for name, r in results.items()}, results
+
+
+def profile_layers(spec, engine, x, iterations=PROFILE_ITERATIONS):
+    """Per-layer time / bytes / FLOP/s of the NumPy FP32 and INT8 paths on single rows."""
+    instrument_engine(engine, prefix="int8/")
+    with profiling(Profiler()) as prof:
+        for i in range(iterations):
+            row = x[i % len(x)][None]
+            profiled_spec_forward(spec, row, prefix="fp32/")
+            engine.forward(row)
+    prof.print_summary()
+    return prof.export_chrome_trace(PROFILE_OUTPUT)
+
+
+
+# Main Evaluation
+def main():
+
+    # Load data (only a small pool for benchmark batches; accuracy is streamed)
+    x_test, _ = next(iter_eval_chunks(EVAL_X_PATH, EVAL_Y_PATH, chunk_rows=BENCH_POOL_ROWS))
+
+    # Load models
+    m_fp32 = load_model(FP32_PATH)
+    m_ptq  = load_model(PTQ_PATH)
+    m_qat  = load_model(QAT_PATH)
+
+    # in-repo NumPy runtimes built from the FP32 student (see int8_engine.py)
+    spec = extract_keras_layers(m_fp32)
+    observers = calibrate(spec_activation_fn(spec),
+                          iter_calibration_chunks(CALIB_DATA_PATH, CALIB_CONFIG["chunk_rows"], max_samples=CALIB_SAMPLES),
+                          config=CALIB_CONFIG)
+    write_tables({m: qparam_table(observers, m, CALIB_CONFIG["percentile"]) for m in CALIB_CONFIG["range_method"]},
+                 QPARAM_OUTPUT)
+    np_int8 = Int8MLP.build(spec, ranges=engine_ranges(observers, CALIB_METHOD, CALIB_CONFIG["percentile"]))
+    np_int8.describe()
+
+    # export as a flat file and serve the zero-copy mmap view from here on
+    save_flat(FLAT_INT8_PATH, np_int8, metadata={"calibration": CALIB_METHOD})
+    start = time.perf_counter()
+    flat_int8 = FlatModel.open(FLAT_INT8_PATH)
+    print(f"Mapped {FLAT_INT8_PATH} in {(time.perf_counter() - start) * 1000:.2f} ms")
+    np_int8 = flat_int8.engine
+
+    # 1. Accuracy
+    print("\nEvaluating Accuracy...")
+    pll, eval_metrics = compute_accuracy({
+        "FP32": keras_predict_fn(m_fp32),
+        "PTQ":  keras_predict_fn(m_ptq),
+        "QAT":  keras_predict_fn(m_qat),
+        "NP-INT8": np_int8.forward,
+    })
+    with open(EVAL_OUTPUT, "w") as f:
+        json.dump(eval_metrics, f, indent=2)
+    acc_fp32, acc_ptq, acc_qat = pll["FP32"], pll["PTQ"], pll["QAT"]
+    print("-> Accuracy Done")
+
+    # 2. Latency
+    print("\nMeasuring Latency...")
+    bench = benchmark_models(
+        {
+            "FP32": lambda x: m_fp32(x, training=False),
+            "PTQ":  lambda x: m_ptq(x, training=False),
+            "QAT":  lambda x: m_qat(x, training=False),
+            "NP-FP32": lambda x: fp32_forward(spec, x),
+            "NP-INT8": np_int8.forward,
+        },
+        x_test,
+        batch_sizes=BENCH_BATCH_SIZES,
+        thread_counts=BENCH_THREAD_COUNTS,
+        warmup=BENCH_WARMUP,
+        iterations=BENCH_ITERATIONS,
+    )
+    write_results(bench, BENCH_OUTPUT)
+    print_table(bench)
+    # single-request serving latency (batch 1, one caller) drives the charts below
+    lat_fp32 = lookup(bench, "FP32")
+    lat_ptq  = lookup(bench, "PTQ")
+    lat_qat  = lookup(bench, "QAT")
+    p99 = [lookup(bench, name, key="p99_ms") for name in ("FP32", "PTQ", "QAT")]
+    print("-> Latency Done")
+
+    # 3. Model size
+    print("\nMeasuring Model Size...")
+    size_fp32 = model_size_mb(FP32_PATH)
+    size_ptq  = model_size_mb(PTQ_PATH)
+    size_qat  = model_size_mb(QAT_PATH)
+    print(f"NP-INT8 flat file: {model_size_mb(FLAT_INT8_PATH):.3f} MB "
+          f"(INT8 payload {(flat_int8.nbytes - flat_int8.exec_bytes) / MB:.3f} MB)")
+    print_footprint(flat_int8)
+    print("-> Model Size Done")
+
+    # 4. Per-layer profile (INT8 runs all heads as one fused "heads" GEMM)
+    print("\nProfiling NumPy runtimes per layer...")
+    profile_layers(spec, np_int8, x_test)
+    print("-> Profile Done")
+
+
+    # PLOTS
+    # 1. Accuracy Chart
+    plt.figure(figsize=(7,5))
+    plt.bar(["FP32", "PTQ", "QAT"], [acc_fp32, acc_ptq, acc_qat], color=["blue","green","orange"])
+    plt.ylabel("Poisson Log Loss (lower = better)")
+    plt.title("Accuracy Comparison")
+    plt.savefig("accuracy_comparison.png")
+    plt.close()
+
+    # 2. Latency Chart
+    plt.figure(figsize=(7,5))
+    xs = np.arange(3)
+    plt.bar(xs - 0.2, [lat_fp32, lat_ptq, lat_qat], width=0.4, color=["blue","green","orange"], label="p50")
+    plt.bar(xs + 0.2, p99, width=0.4, color=["blue","green","orange"], alpha=0.5, label="p99")
+    plt.xticks(xs, ["FP32", "PTQ", "QAT"])
+    plt.ylabel("Latency (ms per inference, batch 1)")
+    plt.title("Latency Comparison")
+    plt.legend()
+    plt.savefig("latency_comparison.png")
+    plt.close()
+
+    # 3. Model Size Chart
+    plt.figure(figsize=(7,5))
+    plt.bar(["FP32", "PTQ", "QAT"], [size_fp32, size_ptq, size_qat], color=["blue","green","orange"])
+    plt.ylabel("Model Size (MB)")
+    plt.title("Model Size Comparison")
+    plt.savefig("model_size_comparison.png")
+    plt.close()
+
+    # 4. Quality vs Latency (Pareto Curve)
+    plt.figure(figsize=(7,5))
+    plt.scatter([lat_fp32, lat_ptq, lat_qat], [acc_fp32, acc_ptq, acc_qat],
+                s=[120,120,120], c=["blue","green","orange"], label="models")
+    for x,y,name in [(lat_fp32,acc_fp32,"FP32"),(lat_ptq,acc_ptq,"PTQ"),(lat_qat,acc_qat,"QAT")]:
+        plt.text(x, y, name)
+    plt.xlabel("Latency (ms)")
+    plt.ylabel("Poisson Log Loss")
+    plt.title("Quality vs Latency Trade-off (Pareto Curve)")
+    plt.savefig("quality_vs_latency.png")
+    plt.close()
+
+    print("\nAll outputs saved:")
+    print("  - accuracy_comparison.png")
+    print("  - latency_comparison.png")
+    print("  - model_size_comparison.png")
+    print("  - quality_vs_latency.png")
+    print(f"  - {BENCH_OUTPUT}")
+    print(f"  - {QPARAM_OUTPUT}")
+    print(f"  - {EVAL_OUTPUT}")
+    print(f"  - {PROFILE_OUTPUT}")
+    print("\nDone ✔")
+
+
+if __name__ == "__main__":
+    main()
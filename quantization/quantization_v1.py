@@ -1,135 +1,149 @@
-"""
-Quantization_v1.py
--------------------
-Author: Mahdi Saleh Tabesh
-Project: Efficient Knowledge Distillation for Conversion Prediction Models (HPML, Columbia University)
-Teammates: Alex Racapé, Rohan Singh, Kimberly Collins
-Hardware: Google TPUs (Pufferfish)
-Framework: TensorFlow 2 + TensorFlow Model Optimization Toolkit (TF-MOT)
-
-Purpose:
-This config defines the quantization stage of our model optimization pipeline.
-After training the student model (via knowledge distillation) and optionally pruning it,
-we apply quantization to further compress the model and improve inference latency.
-
-Quantization converts high-precision (FP32) weights and activations into lower-precision (INT8)
-representations, making the model:
-    - smaller (≈ 4× smaller size)
-    - faster (integer arithmetic is faster)
-    - cheaper to serve (less memory + better cache utilization)
-with only a small drop in accuracy (ideally < 1%).
-
-We experiment with two main approaches:
-    1. Post-Training Quantization (PTQ)
-    2. Quantization-Aware Training (QAT)
-"""
-
-@cached_property
-def quantization(self):
-    """Quantization configuration for the student model.
-       Outcome: Generates a quantized INT8 version of the distilled student model for latency benchmarking."""
-    return {
-
-        # Overview and Common Parameters
-        "description": "Quantization configuration for reducing model precision from FP32 to INT8.",
-        "goal": (
-            "Reduce model size and latency while maintaining similar accuracy "
-            "to the FP32 distilled student model."
-        ),
-        "precision": "int8",   # target precision
-        "framework": "tfmot",  # TensorFlow Model Optimization Toolkit
-
-
-        # Post-Training Quantization (PTQ)
-        # ---------------------------------
-
-        # PTQ is applied AFTER model training, without retraining.
-        # It uses a small representative dataset (e.g., ~5,000 samples)
-        # to estimate activation ranges and quantization scales.
-        # This is the simplest and fastest approach.
-        "ptq": {
-            "method": "post_training_quantization",
-            "description": (
-                "Convert trained FP32 weights/activations to INT8 "
-                "using representative calibration data. No retraining needed."
-            ),
-            "parameters": {
-                "calibration_samples": 5000,              # number of samples for calibration
-                "representative_dataset_path": "path/to/calibration/data",
-                "optimization_mode": "DEFAULT",           # DEFAULT or OPTIMIZE_FOR_SIZE
-                "include_activations": True,              # quantize both weights + activations
-            },
-            "expected_results": {
-                "size_reduction": "≈4x smaller",
-                "latency_reduction": "2–4x faster",
-                "accuracy_drop": "<1.5%",
-            },
-        },
-
-
-        # Quantization-Aware Training (QAT)
-        # ---------------------------------
-
-        # QAT simulates quantization during training using "fake quantization nodes"
-        # so the model learns to handle low precision. It gives better accuracy
-        # compared to PTQ but takes longer to train.
-        "qat": {
-            "method": "quantization_aware_training",
-            "description": (
-                "Fine-tune the student model while simulating INT8 arithmetic. "
-                "Adds fake quantization ops during forward/backward passes to "
-                "make the model robust to quantization effects."
-            ),
-            "parameters": {
-                "epochs": 3,                   # number of fine-tuning epochs
-                "learning_rate_scale": 0.1,    # typically lower than normal training
-                "quantize_embeddings": False,  # embeddings often left in FP32 for stability
-                "batch_size": 512,
-            },
-            "expected_results": {
-                "accuracy_drop": "<0.5%",      # almost negligible accuracy loss
-                "latency_reduction": "2–4x faster",
-                "best_for_production": True,
-            },
-        },
-
-
-        # Evaluation Metrics
-        # ------------------
-        # These metrics will help us quantify the efficiency of quantization.
-        "evaluation_metrics": {
-            "accuracy": "Poisson Log Loss (compared to FP32 baseline)",
-            "latency": "Prediction time per sample / QPS throughput",
-            "model_size": "Size on disk after quantization",
-            "memory_footprint": "Total memory used during inference",
-        },
-
-        # Notes & Future Work
-        # --------------------
-        
-        "notes": (
-            "We will compare both PTQ and QAT to select the best trade-off between "
-            "accuracy and latency. Quantization can be combined with pruning "
-            "to create a sparse + INT8 hybrid model for further gains. "
-            "If QAT proves stable, it will be the preferred method for deployment."
-        ),
-    }
-
-"""
-Example Usage (simplified):
-
-# Post-Training Quantization (PTQ)
-import tensorflow as tf
-import tensorflow_model_optimization as tfmot
-
-converter = tf.lite.TFLiteConverter.from_saved_model('student_model/')
-converter.optimizations = [tf.lite.Optimize.DEFAULT]
-quantized_model = converter.convert()
-
-# Quantization-Aware Training (QAT)
-quantize_model = tfmot.quantization.keras.quantize_model(student_model)
-quantize_model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
-quantize_model.fit(train_data, epochs=3, validation_data=val_data)
-
-Both methods will output a smaller, faster student model ready for production inference on TPUs.
-"""
+"""
+Quantization_v1.py
+-------------------
+Author: Mahdi Saleh Tabesh
+Project: Efficient Knowledge Distillation for Conversion Prediction Models (HPML, Columbia University)
+Teammates: Alex Racapé, Rohan Singh, Kimberly Collins
+Hardware: Google TPUs (Pufferfish)
+Framework: TensorFlow 2 + TensorFlow Model Optimization Toolkit (TF-MOT)
+
+Purpose:
+This config defines the quantization stage of our model optimization pipeline.
+After training the student model (via knowledge distillation) and optionally pruning it,
+we apply quantization to further compress the model and improve inference latency.
+
+Quantization converts high-precision (FP32) weights and activations into lower-precision (INT8)
+representations, making the model:
+    - smaller (≈ 4× smaller size)
+    - faster (integer arithmetic is faster)
+    - cheaper to serve (less memory + better cache utilization)
+with only a small drop in accuracy (ideally < 1%).
+
+We experiment with two main approaches:
+    1. Post-Training Quantization (PTQ)
+    2. Quantization-Aware Training (QAT)
+"""
+
+@cached_property
+def quantization(self):
+    """Quantization configuration for the student model.
+       Outcome: Generates a quantized INT8 version of the distilled student model for latency benchmarking."""
+    return {
+
+        # Overview and Common Parameters
+        "description": "Quantization configuration for reducing model precision from FP32 to INT8.",
+        "goal": (
+            "Reduce model size and latency while maintaining similar accuracy "
+            "to the FP32 distilled student model."
+        ),
+        "precision": "int8",   # target precision
+        "framework": "tfmot",  # TensorFlow Model Optimization Toolkit
+
+
+        # Post-Training Quantization (PTQ)
+        # ---------------------------------
+
+        # PTQ is applied AFTER model training, without retraining.
+        # It uses a small representative dataset (e.g., ~5,000 samples)
+        # to estimate activation ranges and quantization scales.
+        # This is the simplest and fastest approach.
+        "ptq": {
+            "method": "post_training_quantization",
+            "description": (
+                "Convert trained FP32 weights/activations to INT8 "
+                "using representative calibration data. No retraining needed."
+            ),
+            "parameters": {
+                "calibration_samples": 5000,              # number of samples for calibration
+                "representative_dataset_path": "path/to/calibration/data",
+                "optimization_mode": "DEFAULT",           # DEFAULT or OPTIMIZE_FOR_SIZE
+                "include_activations": True,              # quantize both weights + activations
+                "calibration": {                          # see quantization/calibration.py
+                    "chunk_rows": 8192,                   # streamed, never held in memory at once
+                    "range_method": ["minmax", "percentile", "mse"],  # compare on PLL
+                    "histogram_bins": 2048,
+                    "percentile": 99.99,
+                },
+            },
+            "expected_results": {
+                "size_reduction": "≈4x smaller",
+                "latency_reduction": "2–4x faster",
+                "accuracy_drop": "<1.5%",
+            },
+        },
+
+
+        # Quantization-Aware Training (QAT)
+        # ---------------------------------
+
+        # QAT simulates quantization during training using "fake quantization nodes"
+        # so the model learns to handle low precision. It gives better accuracy
+        # compared to PTQ but takes longer to train.
+        "qat": {
+            "method": "quantization_aware_training",
+            "description": (
+                "Fine-tune the student model while simulating INT8 arithmetic. "
+                "Adds fake quantization ops during forward/backward passes to "
+                "make the model robust to quantization effects."
+            ),
+            "parameters": {
+                "epochs": 3,                   # number of fine-tuning epochs
+                "learning_rate_scale": 0.1,    # typically lower than normal training
+                "quantize_embeddings": False,  # embeddings often left in FP32 for stability
+                "batch_size": 512,
+                "mixed_precision": {           # see quantization/mixed_precision.py + qat.py
+                    "candidates": ["fp16", "int8", "int4"],  # per hidden layer; int4 = W4A8
+                    "pll_budget": 0.005,       # max PLL increase vs. FP32, as a fraction of FP32's PLL gain over the label-mean predictor (SensitivityRunner.degradation)
+                    "latency_weight": 0.5,     # objective: size + latency_weight * latency
+                    "latency_batch_size": 64,  # serving batch size for per-layer timing
+                    "eval_samples": 10000,
+                    "bitwidth_map_path": "bitwidth_map.json",
+                },
+            },
+            "expected_results": {
+                "accuracy_drop": "<0.5%",      # almost negligible accuracy loss
+                "latency_reduction": "2–4x faster",
+                "best_for_production": True,
+            },
+        },
+
+
+        # Evaluation Metrics
+        # ------------------
+        # These metrics will help us quantify the efficiency of quantization.
+        "evaluation_metrics": {
+            "accuracy": "Poisson Log Loss (compared to FP32 baseline)",
+            "latency": "Prediction time per sample / QPS throughput",
+            "model_size": "Size on disk after quantization",
+            "memory_footprint": "Total memory used during inference",
+        },
+
+        # Notes & Future Work
+        # --------------------
+        
+        "notes": (
+            "We will compare both PTQ and QAT to select the best trade-off between "
+            "accuracy and latency. Quantization can be combined with pruning "
+            "to create a sparse + INT8 hybrid model for further gains. "
+            "If QAT proves stable, it will be the preferred method for deployment."
+        ),
+    }
+
+"""
+Example Usage (simplified):
+
+# Post-Training Quantization (PTQ)
+import tensorflow as tf
+import tensorflow_model_optimization as tfmot
+
+converter = tf.lite.TFLiteConverter.from_saved_model('student_model/')
+converter.optimizations = [tf.lite.Optimize.DEFAULT]
+quantized_model = converter.convert()
+
+# Quantization-Aware Training (QAT)
+quantize_model = tfmot.quantization.keras.quantize_model(student_model)
+quantize_model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
+quantize_model.fit(train_data, epochs=3, validation_data=val_data)
+
+Both methods will output a smaller, faster student model ready for production inference on TPUs.
+"""
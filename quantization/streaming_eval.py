@@ -0,0 +1,262 @@
+"""
+streaming_eval.py
+-----------------
+Chunked, single-pass evaluation of several models with a fused Poisson log loss.
+
+quantization_eval.py's compute_accuracy loads the whole eval set, materializes every
+prediction with model.predict(x) and then feeds them to a Keras Poisson metric, once
+per model. Here the eval set is:
+
+    - read from memory-mapped .npy files or a directory of .npy shards, in chunks
+    - prefetched by a background reader thread into a two-slot buffer, so the next
+      chunk is paged in while the current one is being scored
+    - scored by every model (FP32, PTQ, QAT, ...) before moving on, so the data is
+      read once instead of once per model
+
+Each model keeps float64 running sums only (no per-row predictions):
+
+    - Poisson log loss  sum(pred - y * log(pred + eps)), same definition as
+      tf.keras.metrics.Poisson / calibration.poisson_log_loss
+    - squared / absolute error, sum(pred), sum(y)
+    - calibration: count, sum(pred), sum(y) per predicted-value bin (log-spaced), from
+      which the observed / expected ratio and a calibration error are reported
+
+Usage (from the repo root):
+    chunks = iter_eval_chunks("data/eval_x.npy", "data/eval_y.npy")   # or a shard directory
+    metrics = stream_evaluate({"FP32": keras_predict_fn(m_fp32), "PTQ": keras_predict_fn(m_ptq)}, chunks)
+    print_metrics(metrics)
+"""
+
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+from dataloader.sharded_loader import FEATURES, ShardedDataset, is_shard_dir
+from quantization.calibration import _load_npy
+
+
+DEFAULT_CHUNK_ROWS = 65536
+DEFAULT_PREFETCH = 2          # chunks buffered ahead of the consumer (double buffering)
+DEFAULT_EPS = 1e-7            # tf.keras.metrics.Poisson epsilon
+DEFAULT_HEAD = "conv_value"
+CALIBRATION_EDGES = np.concatenate([[0.0], np.logspace(-4, 3, 29), [np.inf]])
+
+
+
+# Data streaming
+def _shard_paths(source):
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, f) for f in os.listdir(source) if f.endswith(".npy"))
+    return [source]
+
+
+def _load_legacy_pair(path):
+    """(x, y) from a legacy pickled {"x", "y"} .npy, unpickled once for both fields."""
+    print(f"Warning: {path} is a pickled object array and will be loaded into memory; "
+          f"save the features and labels as plain .npy files to stream them")
+    data = np.load(path, allow_pickle=True).item()
+    return data["x"], data["y"]
+
+
+def _open_pairs(x_source, y_source):
+    """(x, y) array pairs: memory-mapped .npy files / shard directories, or a legacy {"x", "y"} file."""
+    if isinstance(x_source, str) and is_shard_dir(x_source):
+        # columnar shards (dataloader/sharded_loader.py); y_source names the label column
+        dataset = ShardedDataset(x_source)
+        for shard in range(len(dataset.shard_rows)):
+            yield dataset.column(shard, FEATURES), dataset.column(shard, y_source or "conv_value")
+        return
+    if y_source is None:
+        for path in _shard_paths(x_source):
+            yield _load_legacy_pair(path)
+        return
+    if isinstance(x_source, np.ndarray):
+        yield x_source, np.asarray(y_source)
+        return
+    x_paths, y_paths = _shard_paths(x_source), _shard_paths(y_source)
+    if len(x_paths) != len(y_paths):
+        raise ValueError(f"{len(x_paths)} feature shards but {len(y_paths)} label shards")
+    for xp, yp in zip(x_paths, y_paths):
+        yield _load_npy(xp, "x"), _load_npy(yp, "y")
+
+
+def iter_eval_chunks(x_source, y_source=None, chunk_rows=DEFAULT_CHUNK_ROWS, max_samples=None):
+    """Yield (x, y) chunks copied out of the memory maps as contiguous float32 / float64 arrays.
+
+    x_source may also be a shard directory (dataloader/sharded_loader.py), with y_source
+    naming the label column (conv_value by default). Otherwise, with y_source=None,
+    x_source is a legacy pickled {"x": ..., "y": ...} .npy (loaded whole).
+    """
+    seen = 0
+    for x, y in _open_pairs(x_source, y_source):
+        if len(x) != len(y):
+            raise ValueError(f"Feature / label row counts differ: {len(x)} vs {len(y)}")
+        for start in range(0, len(x), chunk_rows):
+            stop = start + chunk_rows
+            if max_samples is not None:
+                if seen >= max_samples:
+                    return
+                stop = min(stop, start + max_samples - seen)
+            # the copy is what actually pages the rows in; it runs on the prefetch thread
+            chunk = (np.ascontiguousarray(x[start:stop], dtype=np.float32),
+                     np.ascontiguousarray(y[start:stop], dtype=np.float64).reshape(-1))
+            seen += len(chunk[0])
+            yield chunk
+
+
+_DONE = object()
+
+
+def prefetch(chunks, depth=DEFAULT_PREFETCH):
+    """Run a chunk iterator on a reader thread, keeping up to `depth` chunks ready."""
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # give up if the consumer has stopped, so the reader never blocks on a full buffer
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+            put(_DONE)
+        except BaseException as e:   # re-raised on the consumer side
+            put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+
+# Metrics
+class StreamingMetrics(object):
+    """float64 running sums for Poisson log loss, error and calibration of one model."""
+
+    def __init__(self, eps=DEFAULT_EPS, edges=CALIBRATION_EDGES):
+        self.eps = eps
+        self.edges = edges
+        self.count = 0
+        self.sum_pll = 0.0
+        self.sum_sq_err = 0.0
+        self.sum_abs_err = 0.0
+        self.sum_pred = 0.0
+        self.sum_y = 0.0
+        self.bin_count = np.zeros(len(edges) - 1, dtype=np.int64)
+        self.bin_pred = np.zeros(len(edges) - 1, dtype=np.float64)
+        self.bin_y = np.zeros(len(edges) - 1, dtype=np.float64)
+        self.seconds = 0.0
+
+    def update(self, y, pred):
+        pred = np.asarray(pred, dtype=np.float64).reshape(-1)
+        err = pred - y
+        # fused PLL: one float64 pass per chunk, no stored predictions
+        self.sum_pll += float(np.sum(pred - y * np.log(pred + self.eps)))
+        self.sum_sq_err += float(np.dot(err, err))
+        self.sum_abs_err += float(np.abs(err).sum())
+        self.sum_pred += float(pred.sum())
+        self.sum_y += float(y.sum())
+        self.count += len(y)
+
+        bins = np.clip(np.searchsorted(self.edges, pred, side="right") - 1, 0, len(self.bin_count) - 1)
+        self.bin_count += np.bincount(bins, minlength=len(self.bin_count))
+        self.bin_pred += np.bincount(bins, weights=pred, minlength=len(self.bin_count))
+        self.bin_y += np.bincount(bins, weights=y, minlength=len(self.bin_count))
+
+    def calibration_table(self):
+        rows = []
+        for i in np.flatnonzero(self.bin_count):
+            n = int(self.bin_count[i])
+            rows.append({"lo": float(self.edges[i]), "hi": float(self.edges[i + 1]), "count": n,
+                         "mean_pred": self.bin_pred[i] / n, "mean_y": self.bin_y[i] / n})
+        return rows
+
+    def result(self):
+        n = max(self.count, 1)
+        # count-weighted mean |observed - expected| over the calibration bins
+        calibration_error = float(np.abs(self.bin_y - self.bin_pred).sum()) / n
+        return {
+            "samples": self.count,
+            "pll": self.sum_pll / n,
+            "mse": self.sum_sq_err / n,
+            "mae": self.sum_abs_err / n,
+            "mean_pred": self.sum_pred / n,
+            "mean_y": self.sum_y / n,
+            "observed_over_expected": self.sum_y / self.sum_pred if self.sum_pred else float("nan"),
+            "calibration_error": calibration_error,
+            "seconds": self.seconds,
+        }
+
+
+
+# Evaluation
+def select_head(outputs, head=DEFAULT_HEAD):
+    """Pick the prediction to score out of a dict / single-array model output."""
+    if isinstance(outputs, dict):
+        return outputs[head]
+    return outputs
+
+
+def keras_predict_fn(model, head=DEFAULT_HEAD):
+    """Inference-only call of a Keras model returning the `head` output as a NumPy array."""
+    names = list(getattr(model, "output_names", []) or [])
+
+    def fn(x):
+        out = model(x, training=False)
+        if isinstance(out, (list, tuple)):
+            out = out[names.index(head)] if head in names else out[-1]
+        return np.asarray(select_head(out, head))
+    return fn
+
+
+def stream_evaluate(models, chunks, batch_size=None, prefetch_depth=DEFAULT_PREFETCH, eps=DEFAULT_EPS,
+                    head=DEFAULT_HEAD):
+    """Score every model on every chunk in a single pass over the data.
+
+    `models` maps name -> fn(x) returning predictions (array or dict of heads).
+    `batch_size` splits each chunk for models with a bounded working set.
+    Returns {name: StreamingMetrics}.
+    """
+    metrics = {name: StreamingMetrics(eps) for name in models}
+    source = prefetch(chunks, prefetch_depth) if prefetch_depth else chunks
+    start, rows = time.perf_counter(), 0
+    for x, y in source:
+        for name, fn in models.items():
+            t0 = time.perf_counter()
+            step = batch_size or len(x)
+            for i in range(0, len(x), step):
+                metrics[name].update(y[i:i + step], select_head(fn(x[i:i + step]), head))
+            metrics[name].seconds += time.perf_counter() - t0
+        rows += len(x)
+    elapsed = time.perf_counter() - start
+    print(f"Streamed {rows} samples through {len(models)} models in {elapsed:.1f}s")
+    return metrics
+
+
+def print_metrics(metrics):
+    print(f"{'Model':<10} | {'PLL':>10} | {'MSE':>10} | {'Obs/Exp':>8} | {'Cal err':>8} | {'Time (s)':>8}")
+    print("-" * 70)
+    for name, m in metrics.items():
+        r = m.result()
+        print(f"{name:<10} | {r['pll']:>10.5f} | {r['mse']:>10.5f} | {r['observed_over_expected']:>8.4f} | "
+              f"{r['calibration_error']:>8.5f} | {r['seconds']:>8.2f}")
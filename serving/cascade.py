@@ -0,0 +1,373 @@
+"""
+cascade.py
+----------
+Confidence-gated cascade serving: the INT8 student answers by default and only the
+requests it is unsure about, or that matter most, are escalated to a stronger model
+(the FP32 student or the teacher).
+
+A row is escalated when either
+
+    - its predicted conv_value quantile interval (the PconvsQuantilesHead output, a spec
+      head of width Q holding increasing quantiles) is wider than max_width; the width is
+      q[hi] - q[lo], divided by the predicted conv_value when relative=True. The students
+      in this repo have no such head by default: extract_keras_layers only treats
+      HEAD_OUTPUTS as heads, so pass head_names=HEAD_OUTPUTS + ("pconvs_quantiles",) when
+      building the spec of a student trained with one. With quantile_head=None the policy
+      escalates on slices only
+    - it falls in a configured high-value slice, e.g. high tCPA: a rule
+      {"name": "high_tcpa", "column": <feature index>, "min": <value>} (and / or "max"),
+      or {"name": ..., "fn": callable(x) -> bool mask}
+
+Escalated rows run on a separate MicroBatcher (multihead_runtime.py), so escalations
+from concurrent requests are coalesced into batches on their own worker pool while the
+student path stays inline. Escalated rows get the fallback's outputs for every head the
+fallback produces; the other heads (e.g. quantiles the teacher has no head for) keep the
+student's values. If the fallback does not answer within escalation_timeout_s (the
+abandoned escalation is cancelled if it has not started) or raises, the student's
+answer is served and the timeout / error is counted.
+
+The threshold is tuned offline with replay(): student and fallback are run once over a
+labelled eval set, then every candidate max_width is scored from those predictions,
+reporting the escalation rate (interval + slices), the cascade's Poisson log loss and
+the expected latency per single-row request,
+
+    student_ms + rate * (fallback_ms + batcher_wait_ms)
+
+where batcher_wait_ms is the escalation MicroBatcher's max_wait_ms (the wait of an
+escalated row that does not fill a batch). Pass escalation_ms, e.g. escalation_p50_ms
+from CascadeServer.stats() in production, to use a measured escalation latency instead.
+
+Usage (from the repo root):
+    spec = extract_keras_layers(student, head_names=HEAD_OUTPUTS + ("pconvs_quantiles",))
+    int8_model = MultiHeadModel(spec, backend="int8", x_calib=x_calib)
+    policy = CascadePolicy(quantile_head="pconvs_quantiles", max_width=0.8,
+                           slices=[{"name": "high_tcpa", "column": 12, "min": 5.0}])
+    with CascadeServer(int8_model, fp32_model, policy) as server:
+        outputs = server.predict(x, heads=("conv_value",))
+
+    python -m serving.cascade --student models/np_int8.kdflat --fallback models/np_fp32.kdflat \\
+        --x data/eval_x.npy --y data/eval_y.npy --quantile-head pconvs_quantiles
+
+If the student file has no quantile head, the replay warns and sweeps slice-only escalation.
+"""
+
+import argparse
+import collections
+import json
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import numpy as np
+
+from quantization.benchmark import benchmark_models, lookup
+from quantization.calibration import poisson_log_loss
+from quantization.flat_model import FlatModel
+from quantization.streaming_eval import iter_eval_chunks
+from serving.multihead_runtime import DEFAULT_MAX_BATCH_ROWS, DEFAULT_MAX_WAIT_MS, MicroBatcher
+
+
+VALUE_HEAD = "conv_value"
+DEFAULT_QUANTILE_HEAD = "pconvs_quantiles"
+DEFAULT_ESCALATION_TIMEOUT_S = 0.05
+# target interval-escalation rates the default replay sweep picks thresholds for
+DEFAULT_REPLAY_RATES = (0.0, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+REPLAY_OUTPUT = "cascade_replay.json"
+WIDTH_EPS = 1e-6
+INTERVAL = "interval"
+LATENCY_WINDOW = 10000   # most recent escalations kept for latency percentiles
+
+
+
+# Policy
+class CascadePolicy(object):
+    """Decides which rows to escalate from the student's outputs and the request features."""
+
+    def __init__(self, quantile_head=DEFAULT_QUANTILE_HEAD, lo=0, hi=-1, max_width=np.inf,
+                 relative=True, slices=()):
+        self.quantile_head = quantile_head
+        self.lo = lo
+        self.hi = hi
+        self.max_width = max_width
+        self.relative = relative
+        self.slices = list(slices)
+        for rule in self.slices:
+            if "fn" not in rule and "column" not in rule:
+                raise ValueError(f"Slice rule {rule.get('name')} needs a 'column' or an 'fn'")
+
+    def heads(self):
+        """Student heads the policy reads."""
+        if self.quantile_head is None:
+            return ()
+        return (self.quantile_head, VALUE_HEAD) if self.relative else (self.quantile_head,)
+
+    def check_heads(self, heads):
+        """Raise if the student's head names lack the quantile head the policy reads."""
+        if self.quantile_head is not None and self.quantile_head not in heads:
+            raise ValueError(
+                f"The student has no '{self.quantile_head}' head (heads: {sorted(heads)}); build its spec with "
+                f"extract_keras_layers(model, head_names=HEAD_OUTPUTS + ('{self.quantile_head}',)), "
+                f"or use quantile_head=None to escalate on slices only")
+
+    def width(self, outputs):
+        """Per-row quantile interval width (relative to conv_value if relative=True)."""
+        self.check_heads(outputs)
+        q = np.asarray(outputs[self.quantile_head], dtype=np.float32)
+        width = q[:, self.hi] - q[:, self.lo]
+        if self.relative:
+            width = width / (np.abs(np.asarray(outputs[VALUE_HEAD], dtype=np.float32).reshape(-1)) + WIDTH_EPS)
+        return width
+
+    def slice_masks(self, x):
+        """{slice name: bool mask} of the rows in each high-value slice."""
+        masks = {}
+        for rule in self.slices:
+            if "fn" in rule:
+                mask = np.asarray(rule["fn"](x), dtype=bool).reshape(-1)
+            else:
+                column = x[:, rule["column"]]
+                mask = np.ones(len(x), dtype=bool)
+                if "min" in rule:
+                    mask &= column >= rule["min"]
+                if "max" in rule:
+                    mask &= column <= rule["max"]
+            masks[rule["name"]] = mask
+        return masks
+
+    def decide(self, x, outputs, width=None):
+        """(escalate mask, {reason: mask}) with reasons "interval" and each slice name."""
+        reasons = {}
+        if self.quantile_head is not None:
+            if width is None:
+                width = self.width(outputs)
+            reasons[INTERVAL] = width > self.max_width
+        reasons.update(self.slice_masks(x))
+        escalate = np.zeros(len(x), dtype=bool)
+        for mask in reasons.values():
+            escalate |= mask
+        return escalate, reasons
+
+
+
+# Serving
+class FunctionModel(object):
+    """forward(x, heads) adapter around a predict function returning {head: array} (e.g. the teacher)."""
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def forward(self, x, heads=None):
+        outputs = self.fn(x)
+        if heads is None:
+            return outputs
+        return {h: outputs[h] for h in heads if h in outputs}
+
+
+def _as_model(model):
+    """MultiHeadModel as is; Int8MLP engines and plain predict functions through FunctionModel."""
+    if hasattr(model, "resolve"):
+        return model
+    return FunctionModel(model.forward if hasattr(model, "forward") else model)
+
+
+class CascadeServer(object):
+    """INT8 student inline, escalations batched on a separate worker pool for the fallback model."""
+
+    def __init__(self, student, fallback, policy, max_batch_rows=DEFAULT_MAX_BATCH_ROWS,
+                 max_wait_ms=DEFAULT_MAX_WAIT_MS, num_workers=1, escalation_timeout_s=DEFAULT_ESCALATION_TIMEOUT_S):
+        self.student = _as_model(student)
+        self.policy = policy
+        if hasattr(self.student, "head_names"):
+            policy.check_heads(self.student.head_names)
+        # a predict-function fallback (e.g. the teacher) computes every head it has anyway and
+        # may lack some requested ones, so its rows are returned whole and merged by name
+        self.fallback_selects_heads = hasattr(fallback, "resolve")
+        self.escalation = MicroBatcher(_as_model(fallback), max_batch_rows, max_wait_ms, num_workers)
+        self.escalation_timeout_s = escalation_timeout_s
+        self._stats_lock = threading.Lock()
+        self.requests = self.rows = self.escalated = self.timeouts = self.fallback_errors = 0
+        self.reason_rows = {}
+        self.escalation_ms = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def predict(self, x, heads=None, return_route=False):
+        """{head: (n, width)}; with return_route=True also the per-row escalation mask."""
+        x = np.asarray(x, dtype=np.float32).reshape(-1, np.shape(x)[-1])
+        heads = tuple(heads) if heads is not None else None
+        student_heads = None if heads is None else tuple(dict.fromkeys(heads + self.policy.heads()))
+        outputs = self.student.forward(x, student_heads)
+        escalate, reasons = self.policy.decide(x, outputs)
+
+        served = escalate.copy()
+        elapsed_ms, timed_out, failed = None, False, False
+        if escalate.any():
+            start = time.perf_counter()
+            future = None
+            try:
+                future = self.escalation.submit(x[escalate], heads if self.fallback_selects_heads else None)
+                better = future.result(timeout=self.escalation_timeout_s)
+                merged = {h: v.copy() for h, v in outputs.items()}
+                for h, v in better.items():
+                    if h in merged:
+                        merged[h][escalate] = v
+                outputs = merged
+            except FutureTimeoutError:
+                # drop the abandoned work if the pool has not picked it up yet
+                future.cancel()
+                timed_out, served[:] = True, False
+            except Exception:
+                # fallback unavailable: the student's answer is already computed, serve it
+                failed, served[:] = True, False
+            elapsed_ms = (time.perf_counter() - start) * 1e3
+
+        with self._stats_lock:
+            self.requests += 1
+            self.rows += len(x)
+            self.escalated += int(served.sum())
+            self.timeouts += int(timed_out)
+            self.fallback_errors += int(failed)
+            for name, mask in reasons.items():
+                self.reason_rows[name] = self.reason_rows.get(name, 0) + int(mask.sum())
+            if elapsed_ms is not None:
+                self.escalation_ms.append(elapsed_ms)
+
+        if heads is not None:
+            outputs = {h: outputs[h] for h in heads}
+        return (outputs, served) if return_route else outputs
+
+    def stats(self):
+        with self._stats_lock:
+            stats = {"requests": self.requests, "rows": self.rows, "escalated_rows": self.escalated,
+                     "escalation_rate": self.escalated / self.rows if self.rows else 0.0,
+                     "timeouts": self.timeouts, "fallback_errors": self.fallback_errors,
+                     "reason_rows": dict(self.reason_rows)}
+            waits = np.asarray(self.escalation_ms)
+        if len(waits):
+            stats["escalation_p50_ms"] = float(np.percentile(waits, 50))
+            stats["escalation_p99_ms"] = float(np.percentile(waits, 99))
+        stats["escalation_batches"] = self.escalation.stats()
+        return stats
+
+    def close(self):
+        self.escalation.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+# Offline replay
+def measure_request_ms(models, x_pool, iterations=200):
+    """p50 latency (ms) of a single-row request for each {name: fn}."""
+    results = benchmark_models(models, x_pool, batch_sizes=(1,), thread_counts=(1,), iterations=iterations)
+    return {name: lookup(results, name) for name in models}
+
+
+def replay(student_fn, fallback_fn, chunks, policy, thresholds=None, rates=DEFAULT_REPLAY_RATES,
+           student_ms=None, fallback_ms=None, batcher_wait_ms=DEFAULT_MAX_WAIT_MS, escalation_ms=None):
+    """Score a sweep of max_width thresholds on labelled (x, y) chunks.
+
+    Both models run once per row; each threshold then only re-selects rows. Thresholds
+    default to the quantiles of the student's interval width that escalate `rates` of
+    the traffic on interval grounds alone (slices are escalated at every threshold).
+    A slice-only policy (quantile_head=None) is scored at the single threshold inf.
+    """
+    widths, slice_rows, pred_student, pred_fallback, labels = [], [], [], [], []
+    for x, y in chunks:
+        outputs = student_fn(x)
+        if policy.quantile_head is None:
+            widths.append(np.zeros(len(x), dtype=np.float32))
+        else:
+            widths.append(policy.width(outputs))
+        in_slice = np.zeros(len(x), dtype=bool)
+        for mask in policy.slice_masks(x).values():
+            in_slice |= mask
+        slice_rows.append(in_slice)
+        pred_student.append(np.asarray(outputs[VALUE_HEAD], dtype=np.float64).reshape(-1))
+        pred_fallback.append(np.asarray(fallback_fn(x)[VALUE_HEAD], dtype=np.float64).reshape(-1))
+        labels.append(y)
+    width, in_slice = np.concatenate(widths), np.concatenate(slice_rows)
+    student, fallback, y = np.concatenate(pred_student), np.concatenate(pred_fallback), np.concatenate(labels)
+
+    if policy.quantile_head is None:
+        thresholds = [np.inf]
+    elif thresholds is None:
+        # width > t escalates, so the (1 - rate) quantile escalates about `rate` of the rows
+        thresholds = [np.inf if r <= 0 else -np.inf if r >= 1 else float(np.quantile(width, 1.0 - r))
+                      for r in rates]
+    if escalation_ms is None and fallback_ms is not None:
+        escalation_ms = fallback_ms + batcher_wait_ms
+    rows = []
+    for t in sorted(set(thresholds), reverse=True):
+        escalate = (width > t) | in_slice
+        rate = float(escalate.mean())
+        row = {"max_width": float(t), "escalation_rate": rate,
+               "interval_rate": float((width > t).mean()), "slice_rate": float(in_slice.mean()),
+               "pll": poisson_log_loss(y, np.where(escalate, fallback, student))}
+        if student_ms is not None and escalation_ms is not None:
+            row["expected_latency_ms"] = student_ms + rate * escalation_ms
+        rows.append(row)
+    return {"rows": int(len(y)), "pll_student": poisson_log_loss(y, student),
+            "pll_fallback": poisson_log_loss(y, fallback), "student_ms": student_ms,
+            "fallback_ms": fallback_ms, "escalation_ms": escalation_ms, "sweep": rows}
+
+
+def pick_threshold(report, max_rate=None, max_latency_ms=None):
+    """Best-PLL sweep row within an escalation-rate and / or expected-latency budget."""
+    rows = [r for r in report["sweep"]
+            if (max_rate is None or r["escalation_rate"] <= max_rate)
+            and (max_latency_ms is None or r.get("expected_latency_ms", 0.0) <= max_latency_ms)]
+    return min(rows, key=lambda r: r["pll"]) if rows else None
+
+
+def print_replay(report):
+    print(f"Rows: {report['rows']}, PLL student {report['pll_student']:.5f}, "
+          f"fallback {report['pll_fallback']:.5f}")
+    print(f"{'Max width':>10} | {'Escalated':>9} | {'Interval':>8} | {'Slices':>7} | {'PLL':>9} | {'Latency ms':>10}")
+    print("-" * 70)
+    for r in report["sweep"]:
+        latency = f"{r['expected_latency_ms']:>10.4f}" if "expected_latency_ms" in r else f"{'-':>10}"
+        print(f"{r['max_width']:>10.4g} | {r['escalation_rate']:>9.2%} | {r['interval_rate']:>8.2%} | "
+              f"{r['slice_rate']:>7.2%} | {r['pll']:>9.5f} | {latency}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay an eval set through the student/fallback cascade.")
+    parser.add_argument("--student", required=True, help="flat model file of the INT8 student")
+    parser.add_argument("--fallback", required=True, help="flat model file of the FP32 student / teacher")
+    parser.add_argument("--x", required=True, help="eval features (.npy or shard directory)")
+    parser.add_argument("--y", default=None, help="eval labels (.npy, or label column of a shard directory)")
+    parser.add_argument("--quantile-head", default=DEFAULT_QUANTILE_HEAD,
+                        help="student head with the conv_value quantiles; slice-only escalation if absent")
+    parser.add_argument("--absolute", action="store_true", help="absolute instead of relative interval width")
+    parser.add_argument("--slices", default=None, help='JSON list of rules, e.g. [{"name": "high_tcpa", "column": 12, "min": 5}]')
+    parser.add_argument("--max-wait-ms", type=float, default=DEFAULT_MAX_WAIT_MS,
+                        help="escalation batcher max_wait_ms, added to the fallback latency")
+    parser.add_argument("--escalation-ms", type=float, default=None,
+                        help="measured escalation latency (e.g. escalation_p50_ms); overrides the estimate")
+    parser.add_argument("--max-samples", type=int, default=None)
+    parser.add_argument("--output", default=REPLAY_OUTPUT)
+    args = parser.parse_args()
+
+    student, fallback = FlatModel.open(args.student), FlatModel.open(args.fallback)
+    x_pool, _ = next(iter_eval_chunks(args.x, args.y, chunk_rows=1024))
+    quantile_head = args.quantile_head
+    if quantile_head not in student.predict_fn()(x_pool[:1]):
+        print(f"Warning: {args.student} has no '{quantile_head}' head; replaying slice-only escalation")
+        quantile_head = None
+    policy = CascadePolicy(quantile_head, relative=not args.absolute,
+                           slices=json.loads(args.slices) if args.slices else ())
+    latency = measure_request_ms({"student": student.predict_fn(), "fallback": fallback.predict_fn()}, x_pool)
+    report = replay(student.predict_fn(), fallback.predict_fn(),
+                    iter_eval_chunks(args.x, args.y, max_samples=args.max_samples), policy,
+                    student_ms=latency["student"], fallback_ms=latency["fallback"],
+                    batcher_wait_ms=args.max_wait_ms, escalation_ms=args.escalation_ms)
+    print_replay(report)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Replay report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
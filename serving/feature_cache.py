@@ -0,0 +1,284 @@
+"""
+feature_cache.py
+----------------
+Request-level caching in front of student inference on the auction path.
+
+Every auction builds one feature vector per candidate ad from a query part, a user part
+(both the same for every candidate of the auction and often repeated across auctions)
+and a product part, then runs the whole student on each row. Two caches cut that work:
+
+    - context cache: the student is an MLP over the concatenated features, so the first
+      Dense layer splits exactly by columns,
+          x @ W1 + b1 = x_ctx @ W1[ctx] + x_prod @ W1[prod] + b1
+      The query/user term (plus bias) is computed once per distinct context and
+      memoized; each candidate then pays only for its product columns in layer 1 and
+      for the (small) rest of the network. For the int8 backend the memoized term is
+      the int32 accumulator of the quantized context columns, so results stay
+      bit-identical to the unsplit engine. Deeper layers mix both parts and are not
+      cacheable.
+    - prediction cache: per-row outputs keyed by a hash of the full feature row (and
+      the requested heads), for candidates that repeat across auctions.
+
+Both are bounded LRU caches with a TTL, so entries age out when features drift or a
+new model is rolled out (CachedInference.invalidate() clears them on a model swap).
+Hit / miss / eviction / expiry counters and per-call latency percentiles come from
+CachedInference.stats().
+
+The split of the input columns into context (query + user) and product is given as
+the indices of the context columns in the student's input vector.
+
+Usage (from the repo root):
+    model = MultiHeadModel(spec, backend="int8", x_calib=x_calib)
+    server = CachedInference(model, context_columns=range(0, 24), ttl_s=60.0)
+    outputs = server.predict_auction(x_context, x_candidates, heads=("conv_value",))
+    print_cache_stats(server.stats())
+"""
+
+import collections
+import hashlib
+import threading
+import time
+import numpy as np
+
+from quantization.int8_engine import FLOAT_ACTIVATIONS, _head_outputs, quantize_input, requantize
+
+
+DEFAULT_CONTEXT_ENTRIES = 10000
+DEFAULT_PREDICTION_ENTRIES = 100000
+DEFAULT_TTL_S = 300.0
+LATENCY_WINDOW = 10000   # most recent calls kept for latency percentiles
+KEY_BYTES = 16
+
+
+
+# Cache
+def feature_key(*parts):
+    """128-bit blake2b digest of the raw bytes of one or more feature arrays / strings."""
+    h = hashlib.blake2b(digest_size=KEY_BYTES)
+    for part in parts:
+        h.update(part.encode() if isinstance(part, str) else np.ascontiguousarray(part).tobytes())
+    return h.digest()
+
+
+class TTLCache(object):
+    """Thread-safe LRU cache with a per-entry time to live and hit / miss / eviction counters."""
+
+    def __init__(self, max_entries, ttl_s=DEFAULT_TTL_S, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.clock = clock
+        self._data = collections.OrderedDict()   # key -> (expires_at, value), oldest first
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= self.clock():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (self.clock() + self.ttl_s, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._data), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions, "expirations": self.expirations}
+
+
+
+# Split first layer
+class SplitTower(object):
+    """The student's tower with layer 1 split into a memoizable context term and a product term."""
+
+    def __init__(self, model, context_columns):
+        if not model.spec["hidden"]:
+            raise ValueError("The student has no hidden layer to split")
+        self.model = model
+        self.backend = model.backend
+        n_inputs = model.spec["hidden"][0]["kernel"].shape[0]
+        self.context_columns = np.asarray(sorted(set(int(c) for c in context_columns)), dtype=np.int64)
+        if len(self.context_columns) and (self.context_columns[0] < 0 or self.context_columns[-1] >= n_inputs):
+            raise ValueError(f"Context columns must lie in [0, {n_inputs})")
+        self.product_columns = np.setdiff1d(np.arange(n_inputs), self.context_columns)
+
+        if self.backend == "int8":
+            first = model.engine.layers[0]
+            self.first = first
+            self.input_scale = model.engine.input_scale
+            self.rest = model.engine.layers[1:]
+            operand = first._w
+        else:
+            first = model.spec["hidden"][0]
+            self.first = first
+            self.rest = model.spec["hidden"][1:]
+            operand = first["kernel"]
+        self.w_context = np.ascontiguousarray(operand[self.context_columns])
+        self.w_product = np.ascontiguousarray(operand[self.product_columns])
+
+    def assemble(self, x_context, x_product):
+        """Full input rows (n, n_inputs) from one context row and n product rows."""
+        x_product = np.asarray(x_product, dtype=np.float32)
+        x = np.empty((len(x_product), len(self.context_columns) + len(self.product_columns)), dtype=np.float32)
+        x[:, self.context_columns] = np.asarray(x_context, dtype=np.float32)
+        x[:, self.product_columns] = x_product
+        return x
+
+    def _matmul(self, x, w):
+        if self.backend == "int8":
+            q = quantize_input(x, self.input_scale)
+            if self.first.backend == "fp32_exact":
+                return np.matmul(q.astype(np.float32), w).astype(np.int32)
+            return np.matmul(q.astype(np.int32), w)
+        return x @ w
+
+    def context_term(self, x_context):
+        """Layer-1 contribution of the context columns plus the bias: (1, units)."""
+        x = np.asarray(x_context, dtype=np.float32).reshape(1, -1)
+        bias = self.first.q_bias if self.backend == "int8" else self.first["bias"]
+        return self._matmul(x, self.w_context) + bias
+
+    def tower(self, context_term, x_product):
+        """Shared representation of the candidates, equal to model.tower(assemble(...))."""
+        pre = self._matmul(np.asarray(x_product, dtype=np.float32), self.w_product) + context_term
+        if self.backend == "int8":
+            q = requantize(pre, self.first.m0, self.first.shift, relu=True)
+            for layer in self.rest:
+                q = layer(q)
+            return q
+        h = FLOAT_ACTIVATIONS[self.first["activation"]](pre)
+        for layer in self.rest:
+            h = FLOAT_ACTIVATIONS[layer["activation"]](h @ layer["kernel"] + layer["bias"])
+        return h
+
+    def forward(self, context_term, x_product, heads=None):
+        """Same outputs as MultiHeadModel.forward on the assembled rows."""
+        gemm, slices = self.model.fused(self.model.resolve(heads))
+        logits = gemm(self.tower(context_term, x_product))
+        outputs = {name: FLOAT_ACTIVATIONS[act](logits[:, start:stop]) for name, start, stop, act in slices}
+        outputs = _head_outputs(outputs)
+        if heads is None:
+            return outputs
+        return {h: outputs[h] for h in heads}
+
+
+
+# Cached inference
+class CachedInference(object):
+    """Auction-level inference (one context, many candidates) behind a context and a prediction cache."""
+
+    def __init__(self, model, context_columns, context_entries=DEFAULT_CONTEXT_ENTRIES,
+                 prediction_entries=DEFAULT_PREDICTION_ENTRIES, ttl_s=DEFAULT_TTL_S,
+                 cache_predictions=True, clock=time.monotonic):
+        self.split = SplitTower(model, context_columns)
+        self.context_cache = TTLCache(context_entries, ttl_s, clock)
+        self.prediction_cache = TTLCache(prediction_entries, ttl_s, clock) if cache_predictions else None
+        self._stats_lock = threading.Lock()
+        self.latency_ms = collections.deque(maxlen=LATENCY_WINDOW)
+        self.auctions = self.rows_served = self.rows_computed = 0
+
+    def context_term(self, x_context, key=None):
+        key = key if key is not None else feature_key(x_context)
+        term = self.context_cache.get(key)
+        if term is None:
+            term = self.split.context_term(x_context)
+            self.context_cache.put(key, term)
+        return term
+
+    def predict_auction(self, x_context, x_candidates, heads=None):
+        """{head: (n, width)} for n candidates sharing one query/user context.
+
+        x_context holds the context columns (in context_columns order), x_candidates the
+        product columns of each candidate (in the order of the remaining columns).
+        """
+        start = time.perf_counter()
+        x_context = np.asarray(x_context, dtype=np.float32).reshape(-1)
+        x_candidates = np.asarray(x_candidates, dtype=np.float32).reshape(-1, len(self.split.product_columns))
+        heads = tuple(heads) if heads is not None else None
+        context_key = feature_key(x_context)
+        n = len(x_candidates)
+
+        cached, keys = [None] * n, [None] * n
+        if self.prediction_cache is not None:
+            heads_tag = ",".join(heads) if heads is not None else "*"
+            for i in range(n):
+                keys[i] = feature_key(context_key, x_candidates[i], heads_tag)
+                cached[i] = self.prediction_cache.get(keys[i])
+        misses = [i for i in range(n) if cached[i] is None]
+
+        computed = None
+        if misses or not n:
+            term = self.context_term(x_context, context_key)
+            computed = self.split.forward(term, x_candidates[misses], heads)
+            if self.prediction_cache is not None:
+                for j, i in enumerate(misses):
+                    cached[i] = {h: v[j].copy() for h, v in computed.items()}
+                    self.prediction_cache.put(keys[i], cached[i])
+        if len(misses) == n:
+            outputs = computed
+        else:
+            outputs = {h: np.stack([row[h] for row in cached]) for h in cached[0]}
+
+        with self._stats_lock:
+            self.auctions += 1
+            self.rows_served += n
+            self.rows_computed += len(misses)
+            self.latency_ms.append((time.perf_counter() - start) * 1e3)
+        return outputs
+
+    def invalidate(self):
+        """Drop every cached context term and prediction (call after swapping the model)."""
+        self.context_cache.clear()
+        if self.prediction_cache is not None:
+            self.prediction_cache.clear()
+
+    def stats(self):
+        with self._stats_lock:
+            latency = np.asarray(self.latency_ms)
+            stats = {"auctions": self.auctions, "rows_served": self.rows_served,
+                     "rows_computed": self.rows_computed,
+                     "row_hit_rate": 1.0 - self.rows_computed / self.rows_served if self.rows_served else 0.0}
+        if len(latency):
+            stats.update({"latency_p50_ms": float(np.percentile(latency, 50)),
+                          "latency_p99_ms": float(np.percentile(latency, 99)),
+                          "latency_mean_ms": float(latency.mean())})
+        stats["context_cache"] = self.context_cache.stats()
+        if self.prediction_cache is not None:
+            stats["prediction_cache"] = self.prediction_cache.stats()
+        return stats
+
+
+def print_cache_stats(stats):
+    print(f"Auctions: {stats['auctions']}, rows served: {stats['rows_served']}, "
+          f"computed: {stats['rows_computed']} (row hit rate {stats['row_hit_rate']:.1%})")
+    if "latency_p50_ms" in stats:
+        print(f"Latency: p50 {stats['latency_p50_ms']:.3f} ms, p99 {stats['latency_p99_ms']:.3f} ms")
+    print(f"{'Cache':<16} | {'Entries':>8} | {'Hit rate':>8} | {'Evictions':>9} | {'Expired':>8}")
+    print("-" * 62)
+    for name in ("context_cache", "prediction_cache"):
+        if name in stats:
+            s = stats[name]
+            print(f"{name:<16} | {s['entries']:>8} | {s['hit_rate']:>8.1%} | {s['evictions']:>9} | {s['expirations']:>8}")
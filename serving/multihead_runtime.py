@@ -0,0 +1,269 @@
+"""
+multihead_runtime.py
+--------------------
+Batched multi-head inference for a shared tower with many output heads
+(TowerWithHeads / PconvsDeepNetwork in model.py: PctrHead, ClickDurationHead,
+PvaluableClickHead, RoundedLabelHead, CalibrationFactorHead, PconvsQuantilesHead, ...).
+
+Serving every head as its own model re-runs the shared tower once per head, and
+auction traffic arrives as bursts of small requests that each pay a full call.
+This runtime:
+
+    - runs the shared tower once per batch
+    - concatenates the output projections of the requested heads into one (d, sum of
+      head widths) kernel, so any subset of heads is a single GEMM (the fused kernel
+      for each head subset is built once and cached)
+    - applies each head's activation on its column slice; conv_prob is derived from
+      prob_logits as in int8_engine
+    - coalesces concurrent requests with a micro-batcher: requests queue until
+      max_batch_rows rows are waiting or the oldest one has waited max_wait_ms, then
+      run as one batch over the union of their heads and are split back per request
+
+Models are int8_engine float specs ({"hidden": [...], "heads": [...]}, head names are
+the spec's head layer names). backend="int8" runs the tower and the fused heads with
+the INT8 engine instead of FP32 NumPy.
+
+Usage (from the repo root):
+    model = MultiHeadModel(extract_keras_layers(student), backend="fp32")
+    with MicroBatcher(model, max_batch_rows=512, max_wait_ms=2.0) as server:
+        future = server.submit(x_request, heads=("conv_value",))
+        outputs = future.result()          # {"conv_value": (n, 1)}
+"""
+
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+
+from quantization.int8_engine import (FLOAT_ACTIVATIONS, INT8_MAX, UINT8_MAX, Int8Dense, Int8MLP,
+                                      _head_outputs, quantize_input)
+
+
+DEFAULT_MAX_BATCH_ROWS = 512
+DEFAULT_MAX_WAIT_MS = 2.0
+STATS_WINDOW = 10000   # most recent batches / requests kept for batcher statistics
+BACKENDS = ("fp32", "int8")
+# outputs computed from another head instead of having a projection of their own
+DERIVED_HEADS = {"conv_prob": "prob_logits"}
+
+
+
+# Model
+class MultiHeadModel(object):
+    """Shared tower run once per batch plus one fused GEMM over the requested heads."""
+
+    def __init__(self, spec, backend="fp32", x_calib=None, ranges=None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend: {backend}")
+        self.spec = spec
+        self.backend = backend
+        self.heads = {h["name"]: h for h in spec["heads"]}
+        self.n_inputs = (spec["hidden"][0] if spec["hidden"] else spec["heads"][0])["kernel"].shape[0]
+        self.head_names = tuple(self.heads)
+        self._fused = {}
+        self._lock = threading.Lock()
+        if backend == "int8":
+            self.engine = Int8MLP.build(spec, x_calib=x_calib, ranges=ranges)
+            last = self.engine.layers[-1] if self.engine.layers else None
+            self.head_in_scale = last.out_scale if last else self.engine.input_scale
+            self.head_in_qmax = UINT8_MAX if last else INT8_MAX
+
+    def resolve(self, heads):
+        """Canonical tuple of projection heads needed for the requested outputs."""
+        if heads is None:
+            return self.head_names
+        needed = set()
+        for h in heads:
+            h = DERIVED_HEADS.get(h, h)
+            if h not in self.heads:
+                raise KeyError(f"Unknown head: {h}")
+            needed.add(h)
+        return tuple(n for n in self.head_names if n in needed)
+
+    def validate(self, x, heads):
+        """Raise for a request this model cannot serve (feature width or unknown heads)."""
+        if np.shape(x)[-1] != self.n_inputs:
+            raise ValueError(f"Expected {self.n_inputs} feature columns, got {np.shape(x)[-1]}")
+        self.resolve(heads)
+
+    def fused(self, names):
+        """(gemm, [(name, start, stop, activation)]) for a head subset, built once per subset."""
+        fused = self._fused.get(names)
+        if fused is not None:
+            return fused
+        with self._lock:
+            if names in self._fused:
+                return self._fused[names]
+            heads = [self.heads[n] for n in names]
+            kernel = np.ascontiguousarray(np.concatenate([h["kernel"] for h in heads], axis=1))
+            bias = np.concatenate([h["bias"] for h in heads])
+            slices, start = [], 0
+            for h in heads:
+                stop = start + h["kernel"].shape[1]
+                slices.append((h["name"], start, stop, h["activation"]))
+                start = stop
+            if self.backend == "int8":
+                gemm = Int8Dense("heads", kernel, bias, self.head_in_scale, self.head_in_qmax,
+                                 out_scale=None, relu=False)
+            else:
+                gemm = lambda h, k=kernel, b=bias: h @ k + b
+            self._fused[names] = (gemm, slices)
+            return self._fused[names]
+
+    def tower(self, x):
+        """Shared representation (float32, or quantized codes for the int8 backend)."""
+        if self.backend == "int8":
+            q = quantize_input(np.asarray(x, dtype=np.float32), self.engine.input_scale)
+            for layer in self.engine.layers:
+                q = layer(q)
+            return q
+        h = np.asarray(x, dtype=np.float32)
+        for layer in self.spec["hidden"]:
+            h = FLOAT_ACTIVATIONS[layer["activation"]](h @ layer["kernel"] + layer["bias"])
+        return h
+
+    def forward(self, x, heads=None):
+        """{head: (n, width)} for the requested heads (all heads if None)."""
+        gemm, slices = self.fused(self.resolve(heads))
+        logits = gemm(self.tower(x))
+        outputs = {name: FLOAT_ACTIVATIONS[act](logits[:, start:stop]) for name, start, stop, act in slices}
+        outputs = _head_outputs(outputs)
+        if heads is None:
+            return outputs
+        return {h: outputs[h] for h in heads}
+
+
+
+# Micro-batching
+class _Request(object):
+    __slots__ = ("x", "heads", "future", "arrival")
+
+    def __init__(self, x, heads):
+        self.x = x
+        self.heads = heads
+        self.future = Future()
+        self.arrival = time.perf_counter()
+
+
+class MicroBatcher(object):
+    """Coalesce small concurrent requests into batches bounded by rows and wait time."""
+
+    def __init__(self, model, max_batch_rows=DEFAULT_MAX_BATCH_ROWS, max_wait_ms=DEFAULT_MAX_WAIT_MS,
+                 num_workers=1):
+        self.model = model
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms / 1e3
+        self.requests = queue.Queue()
+        self.closed = threading.Event()
+        self.stats_lock = threading.Lock()
+        self.batch_rows = collections.deque(maxlen=STATS_WINDOW)
+        self.queue_wait_ms = collections.deque(maxlen=STATS_WINDOW)
+        self.workers = [threading.Thread(target=self._run, name=f"batcher-{i}", daemon=True)
+                        for i in range(num_workers)]
+        for w in self.workers:
+            w.start()
+
+    def submit(self, x, heads=None):
+        """Queue one request (rows of features). Returns a Future of {head: array}.
+
+        Malformed requests raise here, so they never fail the requests batched with them.
+        """
+        if self.closed.is_set():
+            raise RuntimeError("MicroBatcher is closed")
+        request = _Request(np.asarray(x, dtype=np.float32).reshape(-1, np.shape(x)[-1]),
+                           tuple(heads) if heads is not None else None)
+        validate = getattr(self.model, "validate", None)
+        if validate is not None:
+            validate(request.x, request.heads)
+        self.requests.put(request)
+        return request.future
+
+    def predict(self, x, heads=None, timeout=None):
+        return self.submit(x, heads).result(timeout)
+
+    def _collect(self):
+        try:
+            first = self.requests.get(timeout=0.05)
+        except queue.Empty:
+            return []
+        batch, rows = [first], len(first.x)
+        deadline = first.arrival + self.max_wait
+        while rows < self.max_batch_rows:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            rows += len(request.x)
+        return batch
+
+    def _run(self):
+        while not (self.closed.is_set() and self.requests.empty()):
+            # callers that gave up (e.g. cascade timeouts) cancel their futures; skip that work
+            batch = [r for r in self._collect() if r.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            start = time.perf_counter()
+            try:
+                self._serve(batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0].future.set_exception(e)
+                else:
+                    # isolate the failure: rerun each request alone so only the offending one fails
+                    for r in batch:
+                        try:
+                            self._serve([r])
+                        except Exception as e:
+                            r.future.set_exception(e)
+            with self.stats_lock:
+                self.batch_rows.append(sum(len(r.x) for r in batch))
+                self.queue_wait_ms.extend((start - r.arrival) * 1e3 for r in batch)
+
+    def _serve(self, batch):
+        """Run a batch over the union of its heads and resolve every future (all or none)."""
+        if any(r.heads is None for r in batch):
+            heads = None
+        else:
+            heads = tuple(sorted({h for r in batch for h in r.heads}))
+        x = batch[0].x if len(batch) == 1 else np.concatenate([r.x for r in batch])
+        outputs = self.model.forward(x, heads)
+        results, offset = [], 0
+        for r in batch:
+            n = len(r.x)
+            names = r.heads if r.heads is not None else tuple(outputs)
+            results.append({h: outputs[h][offset:offset + n] for h in names})
+            offset += n
+        for r, result in zip(batch, results):
+            r.future.set_result(result)
+
+    def stats(self):
+        with self.stats_lock:
+            rows = np.asarray(self.batch_rows)
+            waits = np.asarray(self.queue_wait_ms)
+        if not len(rows):
+            return {"batches": 0}
+        return {
+            "batches": int(len(rows)),
+            "requests": int(len(waits)),
+            "mean_batch_rows": float(rows.mean()),
+            "max_batch_rows": int(rows.max()),
+            "queue_wait_p50_ms": float(np.percentile(waits, 50)),
+            "queue_wait_p99_ms": float(np.percentile(waits, 99)),
+        }
+
+    def close(self):
+        self.closed.set()
+        for w in self.workers:
+            w.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()